@@ -13,6 +13,7 @@ from .utils import debugtime
 from .io.file_utils import (nativepath, winpath, fix_filename,
                             increment_filename, basepath)
 from .io.escan_writer import EscanWriter
+from .io.xmap_nc import read_xmap_header
 
 from .xps.xps_trajectory import XPSTrajectory
 from .xrd_ad import PerkinElmer_AD, Dexela_AD
@@ -713,7 +714,11 @@ class TrajectoryScan(object):
         n_xps = self.xps.nlines_out
         n_xrf = -1
         if self.use_xrf and self.xrf_type.startswith('xmap'):
-            n_xrf = self.xmap.PixelsPerRun
+            # count the pixels actually written, from the buffer headers
+            try:
+                n_xrf = read_xmap_header(xrf_fname).numPixels
+            except EnvironmentError:
+                n_xrf = self.xmap.PixelsPerRun
         elif self.use_xrf and self.xrf_type.startswith('xsp'):
             n_xrf = self.xsp3.NumImages_RBV
 
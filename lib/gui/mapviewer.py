@@ -151,11 +151,14 @@ class SimpleMapPanel(wx.Panel):
         scale    = self.scale.GetValue()
         if abs(scale) < 1.e-8: scale = 1.e-8
 
-        map      = datafile.get_roimap(roiname1, det=det, dtcorrect=dtcorrect)
+        if roiname2 != '':
+            map, mapx = datafile.get_roimaps((roiname1, roiname2), det=det,
+                                             dtcorrect=dtcorrect)
+        else:
+            map = datafile.get_roimap(roiname1, det=det, dtcorrect=dtcorrect)
         title    = roiname1
 
         if roiname2 != '':
-            mapx = datafile.get_roimap(roiname2, det=det, dtcorrect=dtcorrect)
             op = self.op.GetStringSelection()
             if   op == '+': map +=  mapx/scale
             elif op == '-': map -=  mapx/scale
@@ -260,21 +263,24 @@ class TriColorMapPanel(wx.Panel):
 
         if color=='r':
             roi = self.rchoice.GetStringSelection()
-            map = datafile.get_roimap(roi, det=det, dtcorrect=dtcorrect)
+            rmin, rmax, rsum = datafile.get_roimap_stats(roi, det=det,
+                                                         dtcorrect=dtcorrect)
             self.rauto.SetValue(1)
-            self.rscale.SetValue(map.max())
+            self.rscale.SetValue(rmax)
             self.rscale.Disable()
         elif color=='g':
             roi = self.gchoice.GetStringSelection()
-            map = datafile.get_roimap(roi, det=det, dtcorrect=dtcorrect)
+            rmin, rmax, rsum = datafile.get_roimap_stats(roi, det=det,
+                                                         dtcorrect=dtcorrect)
             self.gauto.SetValue(1)
-            self.gscale.SetValue(map.max())
+            self.gscale.SetValue(rmax)
             self.gscale.Disable()
         elif color=='b':
             roi = self.bchoice.GetStringSelection()
-            map = datafile.get_roimap(roi, det=det, dtcorrect=dtcorrect)
+            rmin, rmax, rsum = datafile.get_roimap_stats(roi, det=det,
+                                                         dtcorrect=dtcorrect)
             self.bauto.SetValue(1)
-            self.bscale.SetValue(map.max())
+            self.bscale.SetValue(rmax)
             self.bscale.Disable()
 
     def onShow3ColorMap(self, event=None):
@@ -289,9 +295,8 @@ class TriColorMapPanel(wx.Panel):
         r = self.rchoice.GetStringSelection()
         g = self.gchoice.GetStringSelection()
         b = self.bchoice.GetStringSelection()
-        rmap = datafile.get_roimap(r, det=det, dtcorrect=dtcorrect)
-        gmap = datafile.get_roimap(g, det=det, dtcorrect=dtcorrect)
-        bmap = datafile.get_roimap(b, det=det, dtcorrect=dtcorrect)
+        rmap, gmap, bmap = datafile.get_roimaps((r, g, b), det=det,
+                                                dtcorrect=dtcorrect)
 
         rscale = 1.0/self.rscale.GetValue()
         gscale = 1.0/self.gscale.GetValue()
@@ -390,9 +395,10 @@ class MapViewerFrame(wx.Frame):
 
     def lassoHandler(self, data=None, selected=None, det=None, mask=None, **kws):
         mask.shape = data.shape
-        energy  = self.current_file.xrfmap['detsum/energy'].value
-        spectra = self.current_file.xrfmap['detsum/data'].value
-        spectra = spectra.swapaxes(0, 1)[mask].sum(axis=0)
+        # the mask is over the displayed map, which is transposed
+        energy  = self.current_file.get_energy(det=det)
+        spectra = self.current_file.get_spectra_by_points(mask.transpose(),
+                                                          det=det)
         self.show_PlotFrame()
         spectra[np.where(spectra<1)] = 1
         self.plotframe.plot(energy, spectra, ylog_scale=True)
@@ -665,7 +671,7 @@ class MapViewerFrame(wx.Frame):
                 time.sleep(.001)
                 wx.Yield()
 
-        xrm_map.resize_arrays(xrm_map.last_row+1)
+        xrm_map.flush_rows()
         xrm_map.h5root.flush()
 
     def OLDprocess_file(self, filename):
@@ -9,9 +9,11 @@ import xrm_mapfile
 import xrf_writer
 
 from escan_writer import EscanWriter
-from xmap_nc import read_xmap_netcdf
+from xmap_nc import read_xmap_netcdf, xMAPReaderPool
+from xsp3_hdf5 import read_xsp3_hdf5
 from xrf_writer import WriteFullXRF
 
-from xrm_mapfile import GSEXRM_MapFile, GSEXRM_Exception, GSEXRM_NotOwner
+from xrm_mapfile import (GSEXRM_MapFile, GSEXRM_MapReader, GSEXRM_Exception,
+                         GSEXRM_NotOwner)
 
 
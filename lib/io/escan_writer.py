@@ -14,36 +14,13 @@ except:
 from string import printable
 from ConfigParser import  ConfigParser
 
-from .xmap_nc import read_xmap_netcdf
+from .folder_watcher import get_watcher
+from .mapfolder import readASCII, readMasterFile, readEnvironFile
+from .xmap_nc import read_xmap_netcdf, xmap_file_complete, xMAPReaderPool
 from ..utils import debugtime
 from .file_utils import nativepath
 from ..config import FastMapConfig
 
-def readASCII(fname, nskip=0, isnumeric=True):
-    dat, header = [], []
-    for line in open(fname,'r').readlines():
-        if line.startswith('#') or line.startswith(';'):
-            header.append(line[:-1])
-            continue
-        if nskip > 0:
-            nskip -= 1
-            header.append(line[:-1])
-            continue
-        if isnumeric:
-            dat.append([float(x) for x in line[:-1].split()])
-        else:
-            dat.append(line[:-1].split())
-    if isnumeric:
-        dat = numpy.array(dat)
-    return header, dat
-
-def readMasterFile(fname):
-    return readASCII(fname, nskip=0, isnumeric=False)
-
-def readEnvironFile(fname):
-    h, d = readASCII(fname, nskip=0, isnumeric=False)
-    return h
-
 def readScanConfig(folder):
     sfiles = [os.path.join(folder, 'Scan.ini'),
               os.path.join(folder, 'Scan.cnf')]
@@ -80,8 +57,7 @@ def readROIFile(hfile):
             iroi = int(a[3:])
             name, dat = cp.get('rois',a).split('|')
             xdat = [int(i) for i in dat.split()]
-            dat = [(xdat[0], xdat[1]), (xdat[2], xdat[3]),
-                   (xdat[4], xdat[5]), (xdat[6], xdat[7])]
+            dat = zip(xdat[0::2], xdat[1::2])
             output.append((iroi, name.strip(), dat))
     output = sorted(output)
     print 'Read ROI data: %i ROIS ' % len(output)
@@ -96,8 +72,9 @@ class EscanWriter(object):
     ROIFile    = 'ROI.dat'
     MasterFile = 'Master.dat'
 
-    def __init__(self, folder=None, **kw):
+    def __init__(self, folder=None, nworkers=1, **kw):
         self.folder = folder
+        self.nworkers = nworkers
         self.master_header = None
         self.environ = None
         self.roidata = None
@@ -184,14 +161,27 @@ class EscanWriter(object):
         if self.last_row >= len(self.rowdata):
             return 0
 
-        def add(x):
-            self.buff.append(x)
-
         if self.last_row == 0 and len(self.rowdata)>0:
             self.make_header()
 
         if maxrow is None:
             maxrow = len(self.rowdata)
+        # with several rows to write, decode the xmap files in parallel
+        pool, xmapdats = None, None
+        try:
+            if self.nworkers > 1 and maxrow - self.last_row > 1:
+                pool = xMAPReaderPool(nworkers=self.nworkers)
+                xmapdats = pool.imap([os.path.join(self.folder, row[1]) for
+                                      row in self.rowdata[self.last_row:maxrow]])
+            return self._process_rows(maxrow, xmapdats, verbose=verbose)
+        finally:
+            if pool is not None:
+                pool.close()
+
+    def _process_rows(self, maxrow, xmapdats=None, verbose=False):
+        def add(x):
+            self.buff.append(x)
+
         while self.last_row <  maxrow:
             irow = self.last_row
             if verbose:
@@ -207,17 +197,25 @@ class EscanWriter(object):
             ghead,gdata = readASCII(os.path.join(self.folder,gatherfile))
             t0 = time.time()
             atime = -1
+            xmfile = os.path.join(self.folder, xmapfile)
+            if xmapdats is not None:
+                xmapdat = next(xmapdats, None)
+                if xmapdat is not None:
+                    atime = time.ctime(os.stat(xmfile).st_ctime)
+            watcher = get_watcher(self.folder)
             while atime < 0 and time.time()-t0 < 10:
+                if not watcher.wait(xmfile, complete=xmap_file_complete,
+                                    timeout=10-(time.time()-t0)):
+                    break
                 try:
-                    atime = time.ctime(os.stat(os.path.join(self.folder,
-                                                            xmapfile)).st_ctime)
-                    xmapdat     = read_xmap_netcdf(os.path.join(self.folder,xmapfile),verbose=False)
+                    atime = time.ctime(os.stat(xmfile).st_ctime)
+                    xmapdat     = read_xmap_netcdf(xmfile,verbose=False)
 
                 except:
                     print 'xmap data failed to read'
                     self.clear()
                     atime = -1
-                time.sleep(0.03)
+                    time.sleep(0.03)
             if atime < 0:
                 return 0
 
@@ -300,7 +298,7 @@ class EscanWriter(object):
                 icr_corr = xmicr[ipt+off_xmap,:] /  (1.e-10 + 1.0*xmocr[ipt+off_xmap,:])
                 raw,cor = [],[]
                 for iroi,lab,rb in self.roidata:
-                    intens = numpy.array([xmdat[ipt+off_xmap, i, rb[i][0]:rb[i][1]].sum()  for i in range(4)])
+                    intens = numpy.array([xmdat[ipt+off_xmap, i, rb[i][0]:rb[i][1]].sum()  for i in range(len(rb))])
                     raw.append( intens.sum() )
                     cor.append((intens*icr_corr).sum())
                 x.extend(["%i"   % r for r in raw])
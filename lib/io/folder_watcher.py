@@ -0,0 +1,123 @@
+#!/usr/bin/python
+"""
+watch a raw data folder for files that have been completely written
+
+On Linux, inotify (through ctypes) reports when files in the folder
+are closed after writing, so that readers waiting for a row file wake
+up as soon as it is written.  Elsewhere, or if inotify is unavailable,
+the watcher falls back to polling.
+"""
+import os
+import sys
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_EVENT_HEAD  = struct.Struct('iIII')   # wd, mask, cookie, len
+
+_libc = None
+def _get_libc():
+    "return libc with inotify functions, or None"
+    global _libc
+    if _libc is None and sys.platform.startswith('linux'):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            libc.inotify_init, libc.inotify_add_watch
+        except (OSError, AttributeError):
+            libc = False
+        _libc = libc
+    return _libc or None
+
+class FolderWatcher(object):
+    """wait for files in a folder to be completely written
+
+    >>> watcher = FolderWatcher('MapFolder')
+    >>> if watcher.wait('MapFolder/xmap.0010', complete=xmap_file_complete):
+    ...     data = read_xmap_netcdf('MapFolder/xmap.0010')
+
+    wait() returns as soon as complete(fname) is True, checking it
+    when the file is closed after writing and, as inotify does not see
+    writes from other hosts to network file systems, at least every
+    recheck seconds.  Without inotify, complete() is checked every
+    poll seconds.
+    """
+    def __init__(self, folder, recheck=0.5, poll=0.05):
+        self.folder  = os.path.abspath(folder)
+        self.recheck = recheck
+        self.poll    = poll
+        self.closed  = set()
+        self.fd      = None
+        libc = _get_libc()
+        if libc is not None:
+            fd = libc.inotify_init()
+            if fd >= 0:
+                wd = libc.inotify_add_watch(fd, self.folder,
+                                            IN_CLOSE_WRITE | IN_MOVED_TO)
+                if wd >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+
+    def close(self):
+        "stop watching"
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        self.close()
+
+    def _read_events(self, timeout):
+        """wait up to timeout seconds for inotify events, adding the
+        names of closed files to self.closed"""
+        ready, w, x = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        buff = os.read(self.fd, 65536)
+        pos = 0
+        while pos + IN_EVENT_HEAD.size <= len(buff):
+            wd, mask, cookie, nlen = IN_EVENT_HEAD.unpack_from(buff, pos)
+            pos += IN_EVENT_HEAD.size
+            name = buff[pos:pos+nlen].rstrip('\0')
+            pos += nlen
+            if name:
+                self.closed.add(name)
+
+    def has_closed(self, fname):
+        "return whether fname has been closed after writing while watched"
+        return os.path.basename(fname) in self.closed
+
+    def wait(self, fname, complete=os.path.exists, timeout=10):
+        """wait up to timeout seconds for complete(fname) to be True,
+        returning whether it is."""
+        t0 = time.time()
+        name = os.path.basename(fname)
+        while True:
+            if complete(fname):
+                return True
+            remaining = timeout - (time.time() - t0)
+            if remaining <= 0:
+                return False
+            if self.fd is None:
+                time.sleep(min(self.poll, remaining))
+                continue
+            # wait for this file to be closed, or to recheck
+            tnext = time.time() + min(self.recheck, remaining)
+            self.closed.discard(name)
+            while name not in self.closed and time.time() < tnext:
+                self._read_events(max(0, tnext - time.time()))
+
+_watchers = {}
+def get_watcher(folder):
+    """return a FolderWatcher for a folder, shared within this process:
+    worker processes forked from it get their own, as they would
+    otherwise read each other's events"""
+    key = (os.getpid(), os.path.abspath(folder))
+    if key not in _watchers:
+        _watchers[key] = FolderWatcher(key[1])
+    return _watchers[key]
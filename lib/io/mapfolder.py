@@ -6,28 +6,91 @@ import numpy
 from ConfigParser import  ConfigParser
 
 def readASCII(fname, nskip=0, isnumeric=True):
-    dat, header = [], []
+    """read a column file, such as the struck.NNNN and xps.NNNN files
+    of a map folder, returning (header, data)
+
+    header is the list of lines starting with '#' or ';' and the first
+    nskip other lines.  With isnumeric=True, data is a 2d float array,
+    parsed from the text of all data lines with one call to
+    numpy.fromstring.  Otherwise data is a list of split lines.
+    """
     with open(fname,'r') as fh:
-        lines = fh.readlines()
-    for line in lines:
+        text = fh.read()
+    dat, header = [], []
+    for line in text.splitlines():
         if line.startswith('#') or line.startswith(';'):
-            header.append(line[:-1])
+            header.append(line)
             continue
         if nskip > 0:
             nskip -= 1
-            header.append(line[:-1])
+            header.append(line)
             continue
-        if isnumeric:
-            dat.append([float(x) for x in line[:-1].split()])
-        else:
-            dat.append(line[:-1].split())
-    if isnumeric:
-        dat = numpy.array(dat)
-    return header, dat
+        if len(line.strip()) > 0:
+            dat.append(line)
+    if not isnumeric:
+        return header, [line.split() for line in dat]
+    if len(dat) < 1:
+        return header, numpy.array([])
+    ncols = len(dat[0].split())
+    values = None
+    if all(len(line.split()) == ncols for line in dat):
+        values = numpy.fromstring('\n'.join(dat), dtype=numpy.float64,
+                                  sep=' ')
+    if values is None or values.size != ncols*len(dat):
+        # ragged or non-numeric lines: parse line by line
+        return header, numpy.array([[float(x) for x in line.split()]
+                                    for line in dat])
+    return header, values.reshape((len(dat), ncols))
 
 def readMasterFile(fname):
     return readASCII(fname, nskip=0, isnumeric=False)
 
+class MasterFileTail(object):
+    """read the Master.dat file of a map folder as rows are added to it
+
+    read() returns (header, rows) as readMasterFile() does, but only
+    parses the complete lines added since the previous call, and does
+    not read the file at all if its size and modification time have
+    not changed.  If the file is rewritten (it gets shorter, or its
+    start, with the scan start time, changes) it is read again from
+    the start.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.size = None
+        self.mtime = None
+        self.head = ''
+        self.header = []
+        self.rows = []
+
+    def read(self):
+        stat = os.stat(self.fname)
+        if stat.st_size == self.size and stat.st_mtime == self.mtime:
+            return self.header, self.rows
+        if stat.st_size < self.offset:
+            self.reset()
+        with open(self.fname, 'r') as fh:
+            if self.offset > 0 and fh.read(len(self.head)) != self.head:
+                self.reset()
+            fh.seek(self.offset)
+            text = fh.read()
+        self.size, self.mtime = stat.st_size, stat.st_mtime
+        # leave any partly written last line for the next read
+        end = text.rfind('\n') + 1
+        if self.offset == 0:
+            self.head = text[:min(end, 256)]
+        for line in text[:end].splitlines():
+            if line.startswith('#') or line.startswith(';'):
+                self.header.append(line)
+            elif len(line.strip()) > 0:
+                self.rows.append(line.split())
+        self.offset += end
+        return self.header, self.rows
+
 def readEnvironFile(fname):
     h, d = readASCII(fname, nskip=0, isnumeric=False)
     return h
@@ -76,8 +139,7 @@ def readROIFile(hfile):
             iroi = int(a[3:])
             name, dat = cp.get('rois',a).split('|')
             xdat = [int(i) for i in dat.split()]
-            dat = [(xdat[0], xdat[1]), (xdat[2], xdat[3]),
-                   (xdat[4], xdat[5]), (xdat[6], xdat[7])]
+            dat = zip(xdat[0::2], xdat[1::2])
             output.append((iroi, name.strip(), dat))
     roidata = sorted(output)
     calib = {}
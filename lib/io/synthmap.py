@@ -0,0 +1,263 @@
+#!/usr/bin/python
+"""
+write synthetic raw map folders, laid out as by the FastMap collector,
+for testing and benchmarking map conversion without a beamline:
+
+    Scan.ini, ROI.dat, Environ.dat, Master.dat, and for each row
+    xmap.NNNN (xMAP netcdf mapping buffers), struck.NNNN and xps.NNNN
+
+>>> from lib.io.synthmap import make_map_folder
+>>> make_map_folder('SynthMap', nrows=50, npts=200, nchans=2048, ndet=4)
+"""
+import os
+import time
+import numpy as np
+import scipy.io.netcdf
+
+# pixels per xMAP buffer, as assumed by the xmap_nc decoder
+XMAP_PIXELS_PER_BUFFER = 124
+
+# (name, energy in keV) of fluorescence lines for the synthetic spectra
+SYNTH_LINES = (('Ca Ka', 3.69), ('Fe Ka', 6.40), ('Cu Ka', 8.05),
+               ('Zn Ka', 8.64), ('As Ka', 10.54), ('Sr Ka', 14.16))
+
+SCAN_INI = """[general]
+mapdb = 13XRM:map:
+struck = 13IDE:SIS1:
+scaler = 13IDE:scaler1
+xmap = 13SDD1:
+[scan]
+filename = %(name)s
+dimension = 2
+comments = synthetic map: %(nrows)i rows x %(npts)i points
+pos1 = 13XRM:m1
+start1 = 0.0
+stop1 = %(stop1).4f
+step1 = %(step).4f
+time1 = %(rowtime).2f
+pos2 = 13XRM:m2
+start2 = 0.0
+stop2 = %(stop2).4f
+step2 = %(step).4f
+[fast_positioners]
+1 = 13XRM:m1 | X
+2 = 13XRM:m2 | Y
+[slow_positioners]
+1 = 13XRM:m1 | X
+2 = 13XRM:m2 | Y
+"""
+
+ENVIRON_DAT = """; Ring Current (S:SRcurrentAI.VAL) = 102.1
+; Mono Energy (13IDA:E:Energy.VAL) = 18000.0
+; Sample Stage X (13XRM:m4.VAL) = 1.2500
+; Sample Stage Y (13XRM:m6.VAL) = -0.7500
+"""
+
+MASTER_HEAD = """#SCAN.version   = 1.4
+#SCAN.starttime = %(time)s
+#SCAN.filename  = %(name)s
+#SCAN.dimension = 2
+#SCAN.nrows_expected = %(nrows)i
+#SCAN.time_per_row_expected = %(rowtime).2f
+#Y.positioner  = 13XRM:m2
+#Y.start_stop_step = 0.000000, %(stop2)f, %(step)f
+#------------------------------------
+# yposition  xmap_file  struck_file  xps_file    time
+"""
+
+def longwords(val):
+    """split an array of longs into (low, high) 16 bit words,
+    along a new last axis"""
+    val = np.asarray(val).astype(np.int64)
+    return np.array([val & 0xFFFF, (val >> 16) & 0xFFFF]).transpose(
+        range(1, val.ndim+1) + [0])
+
+def make_xmap_buffers(spectra, realtime, livetime, icr, ocr, firstpixel=0):
+    """build xMAP full-spectrum mapping buffers for one row
+
+    spectra is (npixels, ndet, nchans), and realtime (in clock ticks),
+    livetime, icr and ocr are (npixels, ndet), with ndet a multiple
+    of 4.  Returns the (narrays, nmodules, buffersize) int16 array
+    to save as 'array_data'.
+    """
+    npixels, ndet, nchans = spectra.shape
+    nmod = ndet / 4
+    modpixs = XMAP_PIXELS_PER_BUFFER
+    blocksize = 256 + 4*nchans
+    buffersize = 256 + modpixs*blocksize
+    narrays = 1 + (npixels-1)/modpixs
+    bufs = np.zeros((narrays, nmod, buffersize), dtype=np.uint16)
+
+    # buffer headers
+    npix = np.minimum(modpixs, npixels - modpixs*np.arange(narrays))
+    pix0 = firstpixel + modpixs*np.arange(narrays)
+    heads = bufs[:, :, :256]
+    heads[:, :, 0:5] = (0x55AA, 0xAA55, 256, 1, 1)
+    heads[:, :, 5:7] = longwords(np.arange(narrays))[:, np.newaxis, :]
+    heads[:, :, 7] = (np.arange(narrays) % 2)[:, np.newaxis]
+    heads[:, :, 8] = npix[:, np.newaxis]
+    heads[:, :, 9:11] = longwords(pix0)[:, np.newaxis, :]
+    heads[:, :, 12] = np.arange(nmod)[np.newaxis, :]
+    heads[:, :, 20:24] = nchans
+
+    # pixel blocks, padded to full buffers, as (array, module, pixel, word)
+    blocks = bufs[:, :, 256:].reshape((narrays, nmod, modpixs, blocksize))
+    nall = narrays*modpixs
+    def padded(arr):
+        out = np.zeros((nall,) + arr.shape[1:], dtype=arr.dtype)
+        out[:npixels] = arr
+        shape = (narrays, modpixs, nmod) + arr.shape[2:]
+        return np.rollaxis(out.reshape(shape), 2, 1)
+
+    valid = padded(np.ones((npixels, nmod), dtype=bool))
+    pixnum = padded(np.repeat((firstpixel + np.arange(npixels))[:, np.newaxis],
+                              nmod, axis=1))
+    phead = np.zeros((narrays, nmod, modpixs, 64), dtype=np.uint16)
+    phead[..., 0:4] = (0x33CC, 0xCC33, 256, 1)
+    phead[..., 4:6] = longwords(pixnum)
+    phead[..., 6:8] = longwords(blocksize)
+    stats = np.array([realtime, livetime, icr, ocr]).transpose((1, 2, 0))
+    stats = longwords(stats.reshape((npixels, nmod, 16))).reshape((npixels, nmod, 32))
+    phead[..., 32:64] = padded(stats)
+    phead[~valid] = 0
+    blocks[..., :64] = phead
+    blocks[..., 256:] = padded(spectra.reshape((npixels, nmod, 4*nchans)))
+    return bufs.view(np.int16)
+
+def write_xmap_netcdf(fname, array_data):
+    "write array_data to a netcdf file laid out like the areaDetector plugin"
+    narrays, nmodules, buffersize = array_data.shape
+    fh = scipy.io.netcdf.netcdf_file(fname, 'w')
+    fh.createDimension('numArrays', None)
+    fh.createDimension('dim0', nmodules)
+    fh.createDimension('dim1', buffersize)
+    uid = fh.createVariable('uniqueId', 'i', ('numArrays',))
+    dat = fh.createVariable('array_data', 'h', ('numArrays', 'dim0', 'dim1'))
+    uid[:] = np.arange(narrays)
+    dat[:] = array_data
+    fh.close()
+
+class SynthMap(object):
+    """synthetic map: smooth element distributions over the map, and
+    spectra of Gaussian fluorescence peaks on a background, with
+    Poisson noise and a count-rate dependent dead time"""
+    def __init__(self, nrows=10, npts=100, nchans=2048, ndet=4,
+                 dwelltime=0.010, slope=0.010, seed=0):
+        self.nrows = nrows
+        self.npts = npts
+        self.nchans = nchans
+        self.ndet = ndet
+        self.dwelltime = dwelltime
+        self.slope = slope
+        self.rand = np.random.RandomState(seed)
+
+        energy = slope*np.arange(nchans)
+        sigma = 0.060
+        self.peaks = np.array([np.exp(-(energy-en)**2/(2*sigma**2))
+                               for name, en in SYNTH_LINES])
+        self.background = 2.0*np.exp(-energy/8.0)
+        # element amplitudes: a few random blobs per element
+        self.centers = self.rand.random_sample((len(SYNTH_LINES), 3, 2))
+        self.amps = 5 + 20*self.rand.random_sample((len(SYNTH_LINES), 3))
+
+    def roi_limits(self, width=0.20):
+        "(name, lo, hi) channel limits for ROIs around each line"
+        out = []
+        for name, en in SYNTH_LINES:
+            lo = int((en-width)/self.slope)
+            hi = int((en+width)/self.slope)
+            if hi < self.nchans:
+                out.append((name, lo, hi))
+        return out
+
+    def row(self, irow):
+        """return spectra (npts, ndet, nchans), and real time, live time,
+        input and output counts (npts, ndet) for a row"""
+        npts, ndet, nchans = self.npts, self.ndet, self.nchans
+        x = np.linspace(0, 1, npts)
+        y = irow/max(1.0, self.nrows-1.0)
+        conc = np.zeros((len(SYNTH_LINES), npts))
+        for iel in range(len(SYNTH_LINES)):
+            for (cx, cy), amp in zip(self.centers[iel], self.amps[iel]):
+                conc[iel] += amp*np.exp(-((x-cx)**2 + (y-cy)**2)/0.02)
+        mean = np.dot(conc.transpose(), self.peaks) + self.background
+        mean = mean[:, np.newaxis, :] * (1 + 0.05*np.arange(ndet))[:, np.newaxis]
+        spectra = self.rand.poisson(mean).astype(np.int16)
+
+        clockticks = self.dwelltime*1.e6/0.320
+        ocr = spectra.sum(axis=2)
+        icr = (ocr*(1 + ocr/2.e4)).astype(np.int64)
+        realtime = np.ones((npts, ndet), dtype=np.int64)*int(clockticks)
+        livetime = (realtime*(1.0*ocr/np.maximum(icr, 1))).astype(np.int64)
+        return spectra, realtime, livetime, icr, ocr
+
+def make_map_folder(folder, nrows=10, npts=100, nchans=2048, ndet=4,
+                    name='synthmap', step=0.001, dwelltime=0.010, seed=0):
+    """write a synthetic raw map folder of nrows rows of npts points,
+    with xmap spectra of nchans channels for ndet (a multiple of 4)
+    detector elements"""
+    if ndet % 4 != 0:
+        raise ValueError('ndet must be a multiple of 4')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    synth = SynthMap(nrows=nrows, npts=npts, nchans=nchans, ndet=ndet,
+                     dwelltime=dwelltime, seed=seed)
+    rowtime = npts*dwelltime
+    fmt = dict(name=name, nrows=nrows, npts=npts, step=step,
+               stop1=(npts-1)*step, stop2=(nrows-1)*step,
+               rowtime=rowtime, time=time.ctime())
+
+    def write(fname, text):
+        fh = open(os.path.join(folder, fname), 'w')
+        fh.write(text)
+        fh.close()
+
+    write('Scan.ini', SCAN_INI % fmt)
+    write('Environ.dat', ENVIRON_DAT)
+
+    rois = ['[rois]']
+    for iroi, (rname, lo, hi) in enumerate(synth.roi_limits()):
+        rois.append('ROI%2.2i = %s | %s' % (iroi, rname,
+                                            ' '.join(['%i %i' % (lo, hi)]*ndet)))
+    rois.append('[calibration]')
+    for key, val in (('OFFSET', 0), ('SLOPE', synth.slope), ('QUAD', 0)):
+        rois.append('%s = %s' % (key, ' '.join([repr(val)]*ndet)))
+    rois.append('[dxp]')
+    rois.append('peaking_time = %s' % ' '.join(['0.25']*ndet))
+    write('ROI.dat', '\n'.join(rois) + '\n')
+
+    master = open(os.path.join(folder, 'Master.dat'), 'w')
+    master.write(MASTER_HEAD % fmt)
+    for irow in range(nrows):
+        fnum = irow + 1
+        spectra, rtime, ltime, icr, ocr = synth.row(irow)
+        bufs = make_xmap_buffers(spectra, rtime, ltime, icr, ocr)
+        write_xmap_netcdf(os.path.join(folder, 'xmap.%4.4i' % fnum), bufs)
+
+        # struck: count time (in 50MHz ticks) and 3 ion chambers
+        rand = synth.rand
+        i0 = rand.randint(90000, 110000, size=npts)
+        sis = np.array([np.ones(npts, dtype=int)*int(dwelltime*5.e7),
+                        i0, i0/3, i0/20]).transpose()
+        out = ['# Struck MCA data: 13IDE:SIS1: ',
+               '# Nchannels, Nmcas = %i, 4' % npts,
+               '# Time=%s' % time.ctime(),
+               '#-------------------------',
+               '# 13IDE:SIS1:mca1 | 13IDE:SIS1:mca2 | 13IDE:SIS1:mca3 | 13IDE:SIS1:mca4',
+               '# TSCALER | I0 | I1 | I2']
+        out.extend([' '.join(['%i' % v for v in p]) for p in sis])
+        write('struck.%4.4i' % fnum, '\n'.join(out) + '\n')
+
+        # xps: positions at the npts+1 pixel boundaries
+        xpos = step*(np.arange(npts+1) - 0.5)
+        if irow % 2 != 0:
+            xpos = xpos[::-1]
+        out = ['# XPS Gathering Data', '#--------------',
+               '# 13XRM:m1  13XRM:m2']
+        out.extend(['%.5f %.5f' % (xv, irow*step) for xv in xpos])
+        write('xps.%4.4i' % fnum, '\n'.join(out) + '\n')
+
+        master.write('%.4f xmap.%4.4i struck.%4.4i xps.%4.4i %9.2f\n' %
+                     (irow*step, fnum, fnum, fnum, rowtime*fnum))
+    master.close()
+    return folder
@@ -4,6 +4,10 @@ import numpy as np
 import time
 import sys
 import os
+import multiprocessing
+from collections import deque
+
+from .folder_watcher import get_watcher
 
 try:
     import scipy.io.netcdf
@@ -14,6 +18,26 @@ try:
 except ImportError:
     raise ImportError('cannot find a netcdf module')
 
+# xmap clocktick = 320 ns
+CLOCKTICK = 0.320
+
+# list mode (mappingMode=3) layout.  Each buffer has the usual 256 word
+# buffer header, with the number of events in the buffer as a long in
+# words 8:10 and the list-mode variant in word 10, followed by events of
+# LIST_EVENT_WORDS words each:
+#    word 0:     energy channel (bits 0-12) and detector channel (bits 13-14)
+#    words 1:3:  time tag, as a long (low word first).  This counts pixels
+#                (sync pulses or gates) for the 'sync' and 'gate' variants,
+#                and clock ticks for the 'clock' variant.
+LIST_NEVENTS      = slice(8, 10)
+LIST_VARIANT      = 10
+LIST_EVENT_WORDS  = 3
+LIST_ENERGY_MASK  = 0x1FFF
+LIST_ENERGY_RANGE = 8192
+LIST_CHAN_SHIFT   = 13
+LIST_CHAN_MASK    = 0x3
+LIST_VARIANTS     = {0: 'gate', 1: 'sync', 2: 'clock'}
+
 def aslong(d):
     """unravels and converts array of int16 (int) to int32 (long)"""
     # need to unravel the array!!!
@@ -21,6 +45,13 @@ def aslong(d):
     d.dtype = np.int32
     return d
 
+def words2long(d):
+    """convert pairs of 16 bit words (low word first) along the last
+    axis of an array to int32, keeping the other dimensions."""
+    lo = d[..., 0::2].astype(np.int32) & 0xFFFF
+    hi = d[..., 1::2].astype(np.int32) << 16
+    return lo | hi
+
 class xMAPBufferHeader(object):
     def __init__(self,buff):
         self.tag0          = buff[0]  # Tag word 0
@@ -51,56 +82,285 @@ class xMAPMCAPixelHeader(object):
         self.pixelNumber = aslong(buff[4:6])[0]
         self.blockSize   = aslong(buff[6:8])[0]
 
+class xMAPFileInfo(object):
+    """summary of an xMAP netcdf file, from its buffer headers only"""
+    def __init__(self, heads):
+        narrays, nmodules, nhead = heads.shape
+        self.mappingMode = heads[0, 0, 3]
+        self.numModules  = nmodules
+        self.numBuffers  = narrays
+        self.firstPixel  = aslong(heads[0, 0, 9:11])[0]
+        self.numPixels   = int(heads[:, 0, 8].sum())
+        self.channelSize = heads[0, 0, 20:24]
+
 class xMAPData(object):
-    def __init__(self,npix,nmod,nchan):
-        ndet = 4 * nmod
+    """decoded xMAP data: spectra, real and live times (microseconds),
+    and input and output counts for each pixel and detector element.
+
+    An existing xMAPData can be passed as 'out' to read_xmap_netcdf()
+    or decode_xmap_buffers() to be refilled in place: its arrays are
+    only reallocated when it cannot hold the new data.
+
+    For mappingMode=2 (ROI mode), data holds the ROI sums (int32) as
+    (pixel, detector, roi) in place of the spectra.
+    """
+    def __init__(self,npix=0,nmod=1,nchan=2048,dtype='i2'):
         self.firstPixel   = 0
         self.numPixels    = 0
-        self.data         = np.zeros((npix, ndet, nchan), dtype='i2')
-        self.realTime     = np.zeros((npix, ndet), dtype='i8')
-        self.liveTime     = np.zeros((npix, ndet), dtype='i8')
-        self.inputCounts  = np.zeros((npix, ndet), dtype='i4')
-        self.outputCounts = np.zeros((npix, ndet), dtype='i4')
+        self.mappingMode  = 1
+        self._store       = None
+        self.reserve(npix, nmod, nchan, dtype=dtype)
 
-def read_xmap_netcdf(fname, verbose=False):
-    # Reads a netCDF file created with the DXP xMAP driver
-    # with the netCDF plugin buffers
+    def reserve(self, npix, nmod, nchan, dtype='i2'):
+        """size the arrays for npix pixels of nmod modules with nchan
+        channels, reusing the current storage when it is big enough."""
+        ndet = 4 * nmod
+        store = self._store
+        if (store is None or len(store['data']) < npix or
+            store['data'].shape[1:] != (ndet, nchan) or
+            store['data'].dtype != np.dtype(dtype)):
+            store = self._store = {
+                'data':         np.zeros((npix, ndet, nchan), dtype=dtype),
+                'realTime':     np.zeros((npix, ndet), dtype='f8'),
+                'liveTime':     np.zeros((npix, ndet), dtype='f8'),
+                'inputCounts':  np.zeros((npix, ndet), dtype='i4'),
+                'outputCounts': np.zeros((npix, ndet), dtype='i4')}
+        for attr, arr in store.items():
+            setattr(self, attr, arr[:npix])
 
-    if verbose: print ' reading ', fname
+    def __getstate__(self):
+        "pickle the arrays, but not the (larger) storage behind them"
+        state = self.__dict__.copy()
+        state['_store'] = None
+        return state
 
-    t0 = time.time()
-    # read data from array_data variable of netcdf file
-    fh = netcdf_open(fname,'r')
-    array_data = fh.variables['array_data'][:]
-    fh.close()
-    t1 = time.time()
+def _xmap_array3d(array_data):
+    """return array_data as a 3d array of (narrays, nmodules, buffersize)
 
-    # array_data will normally be 3d:
-    #  shape = (narrays, nmodules, buffersize)
-    # but nmodules and narrays could be 1, so that
-    # array_data could be 1d or 2d.
-    #
-    # here we force the data to be 3d
+    array_data will normally be 3d, but nmodules and narrays could
+    be 1, so that array_data could be 1d or 2d.
+    """
     shape = array_data.shape
     if len(shape) == 1:
-        array_data.shape = (1,1,shape[0])
+        array_data = array_data.reshape((1, 1, shape[0]))
     elif len(shape) == 2:
-        array_data.shape = (1,shape[0],shape[1])
+        array_data = array_data.reshape((1, shape[0], shape[1]))
+    return array_data
+
+def decode_xmap_buffers(array_data, copy=True, out=None):
+    """decode the mapping buffers of an xMAP netcdf file in one pass
+
+    array_data is the 'array_data' variable of the netcdf file,
+    (narrays, nmodules, buffersize).  All buffer headers are read at
+    once, the pixel blocks of all buffers are viewed as a single
+    (narrays, nmodules, pixels_per_buffer, blocksize) array, and the
+    valid pixels are scattered into an xMAPData with one fancy-indexing
+    step for the times and counts and one for the spectra.
+
+    with copy=False, the spectra are returned as a view of array_data
+    (not a copy) when the pixel layout allows it: full spectra from a
+    single module, with all pixels in one buffer.  Rows of more than
+    124 pixels span several buffers, whose headers break the pixel
+    stride, and the buffers of several modules interleave the
+    detectors, so that for most rows of real detectors the spectra
+    are copied.
+
+    if out is an xMAPData, it is refilled and returned, so that
+    decoding many files of the same shape allocates no new arrays.
+    """
+    array_data = _xmap_array3d(array_data)
+    narrays, nmodules, buffersize = array_data.shape
+
+    # buffer headers (words 0:256) of all buffers
+    heads = array_data[:, :, :256].astype(np.int16)
+    if heads[0, 0, 3] == 3:
+        return decode_xmap_listmode(array_data, out=out)
+    modpixs = heads[0, 0, 8]
+    if modpixs < 124: modpixs = 124
+    blocksize = (buffersize-256)/modpixs
+    pixels = array_data[:, :, 256:256+modpixs*blocksize]
+    pixels = pixels.reshape((narrays, nmodules, modpixs, blocksize))
+
+    # mapping mode and data layout from the first pixel header
+    mapmode = pixels[0, 0, 0, 3]
+    if mapmode == 1:  # mapping, full spectra
+        nchans = heads[0, 0, 20]
+        data_slice = slice(256, 256+4*nchans)
+    elif mapmode == 2:  # ROI mode
+        # Note:  nchans = number of ROIS !!
+        nchans = max(pixels[0, 0, 0, 8:12])
+        data_slice = slice(64, 64+8*nchans)
+    else:
+        raise ValueError('unsupported xMAP mapping mode %i' % mapmode)
+    dtype = 'i2' if mapmode == 1 else 'i4'
+
+    # pixels per buffer: offsets along the row come from module 0
+    npix = heads[:, :, 8].astype(np.int64)
+    npix_mod0 = npix[:, 0]
+    npix_total = int(npix_mod0.sum())
+    offsets = np.cumsum(npix_mod0) - npix_mod0
+
+    # valid pixels, ordered by (row, module)
+    pixnum = np.arange(modpixs)
+    valid = ((pixnum[:, np.newaxis] < npix[:, np.newaxis, :]) &
+             (pixnum[:, np.newaxis] < npix_mod0[:, np.newaxis, np.newaxis]))
+    iarr, ipix, imod = np.nonzero(valid)
+    irow = offsets[iarr] + ipix
+
+    if out is None:
+        xmapdat = xMAPData(npix_total, nmodules, nchans, dtype=dtype)
+    else:
+        xmapdat = out
+        xmapdat.reserve(npix_total, nmodules, nchans, dtype=dtype)
+    xmapdat.mappingMode = mapmode
+    xmapdat.firstPixel = aslong(heads[0, 0, 9:11])[0]
+    xmapdat.numPixels = npix_total
+    dense = len(iarr) == npix_total*nmodules
+
+    # acquistion times and i/o counts data are stored
+    # as longs in locations 32:64 of each pixel header.
+    # real / live times are returned in microseconds.
+    t_times = aslong(pixels[iarr, imod, ipix, 32:64]).reshape((-1, 4, 4))
+    for attr, itime, scale in (('realTime', 0, CLOCKTICK),
+                               ('liveTime', 1, CLOCKTICK),
+                               ('inputCounts', 2, 1),
+                               ('outputCounts', 3, 1)):
+        arr = getattr(xmapdat, attr).reshape((npix_total, nmodules, 4))
+        if not dense:
+            arr[...] = 0
+        arr[irow, imod] = scale * t_times[:, :, itime]
+
+    # the data, extracted as per data_slice and mapmode.
+    # In the normal layout, every module has every pixel and all
+    # buffers but the last are full, so that the output viewed as
+    # (buffer, pixel, module, spectra) lines up with the buffers and
+    # the spectra (or ROI sums, converted from pairs of words) are
+    # copied in a single strided pass.  Otherwise, the valid pixels
+    # are gathered and scattered into place.
+    dshape = (npix_total, nmodules, 4, nchans)
+    regular = dense and np.all(npix_mod0[:-1] == modpixs)
+    convert = words2long if mapmode == 2 else lambda x: x
+    if (mapmode == 1 and regular and not copy and
+        narrays == 1 and nmodules == 1):
+        data = pixels[0, 0, :npix_total, data_slice].reshape(dshape)
+    elif regular:
+        nfull, nlast = narrays - 1, npix_mod0[-1]
+        data = xmapdat.data.reshape(dshape)
+        flat = data.reshape((npix_total, nmodules, 4*nchans))
+        full = flat[:nfull*modpixs].reshape((nfull, modpixs, nmodules, 4*nchans))
+        full[...] = convert(pixels[:nfull, :, :,
+                                   data_slice]).transpose((0, 2, 1, 3))
+        flat[nfull*modpixs:] = convert(pixels[nfull, :, :nlast,
+                                              data_slice]).transpose((1, 0, 2))
+    else:
+        data = xmapdat.data.reshape(dshape)
+        if not dense:
+            data[...] = 0
+        t_data = convert(pixels[iarr, imod, ipix, data_slice])
+        data[irow, imod] = t_data.reshape((-1, 4, nchans))
+    xmapdat.data = data.reshape((npix_total, 4*nmodules, nchans))
+    return xmapdat
+
+def iter_xmap_events(array_data):
+    """iterate over the events of list-mode (mappingMode=3) xMAP buffers,
+    one buffer at a time, so that a memory-mapped file is streamed
+    rather than read all at once.
+
+    yields (tags, dets, energies) arrays for each buffer, giving the
+    time tag, detector index (4*module + channel) and energy channel
+    of each event.  See the LIST_* constants for the event layout.
+    """
+    array_data = _xmap_array3d(array_data)
+    narrays, nmodules, buffersize = array_data.shape
+    maxevents = (buffersize-256)/LIST_EVENT_WORDS
+    for iarr in range(narrays):
+        for imod in range(nmodules):
+            buff = array_data[iarr, imod]
+            nevents = min(maxevents, aslong(buff[LIST_NEVENTS])[0])
+            if nevents < 1:
+                continue
+            events = buff[256:256+nevents*LIST_EVENT_WORDS]
+            events = events.reshape((nevents, LIST_EVENT_WORDS))
+            word0 = events[:, 0].astype(np.int32) & 0xFFFF
+            dets = 4*imod + ((word0 >> LIST_CHAN_SHIFT) & LIST_CHAN_MASK)
+            tags = words2long(events[:, 1:3])[:, 0].astype(np.int64)
+            yield tags & 0xFFFFFFFF, dets, word0 & LIST_ENERGY_MASK
+
+def decode_xmap_listmode(array_data, nchans=2048, ticks_per_pixel=None,
+                         out=None):
+    """bin the events of list-mode (mappingMode=3) xMAP buffers into
+    spectra of nchans channels for each pixel and detector.
 
+    Pixels are counted from the first time tag.  For the 'clock'
+    list-mode variant, the time tags are clock ticks, and
+    ticks_per_pixel must be given.  The buffers are decoded one at a
+    time, adding to the histograms, which grow as needed.
+
+    returns an xMAPData with int32 spectra, and with the number of
+    events as both input and output counts.  List mode has no real
+    or live times, which are returned as 0.
+    """
+    array_data = _xmap_array3d(array_data)
+    nmodules = array_data.shape[1]
+    ndet = 4*nmodules
+    variant = LIST_VARIANTS.get(array_data[0, 0, LIST_VARIANT], 'gate')
+    if variant == 'clock' and ticks_per_pixel is None:
+        raise ValueError("ticks_per_pixel needed for 'clock' list mode")
+
+    first, npix = None, 0
+    hist = np.zeros((0, ndet, nchans), dtype=np.int32)
+    for tags, dets, energies in iter_xmap_events(array_data):
+        if first is None:
+            first = tags.min()
+        pix = tags - first
+        if variant == 'clock':
+            pix = (pix // ticks_per_pixel).astype(np.int64)
+        keep = pix >= 0
+        pix, dets, energies = pix[keep], dets[keep], energies[keep]
+        if len(pix) < 1:
+            continue
+        npix = max(npix, int(pix.max()) + 1)
+        if npix > len(hist):
+            new = np.zeros((2*npix, ndet, nchans), dtype=np.int32)
+            new[:len(hist)] = hist
+            hist = new
+        # events within a buffer are time-ordered, so only count
+        # over the span of pixels in this buffer
+        index = (pix*ndet + dets)*nchans + energies*nchans/LIST_ENERGY_RANGE
+        i0 = index.min()
+        counts = np.bincount(index - i0)
+        flat = hist.reshape(-1)
+        flat[i0:i0+len(counts)] += counts.astype(np.int32)
+
+    if out is None:
+        xmapdat = xMAPData(npix, nmodules, nchans, dtype='i4')
+    else:
+        xmapdat = out
+        xmapdat.reserve(npix, nmodules, nchans, dtype='i4')
+    xmapdat.mappingMode = 3
+    xmapdat.firstPixel = 0 if first is None else first
+    xmapdat.numPixels = npix
+    xmapdat.data[...] = hist[:npix]
+    xmapdat.realTime[...] = 0
+    xmapdat.liveTime[...] = 0
+    xmapdat.inputCounts[...] = xmapdat.data.sum(axis=2)
+    xmapdat.outputCounts[...] = xmapdat.inputCounts
+    return xmapdat
+
+def decode_xmap_buffers_loop(array_data):
+    """decode the mapping buffers of an xMAP netcdf file, one buffer
+    at a time.  This is the original decoder, kept as a reference for
+    decode_xmap_buffers.
+    """
+    array_data = _xmap_array3d(array_data)
     narrays,nmodules,buffersize = array_data.shape
     modpixs    = array_data[0,0,8]
     if modpixs < 124: modpixs = 124
     npix_total = 0
-    # real / live times are returned in microseconds.
-    clocktick  = 0.320   # xmap clocktick = 320 ns
     for array in range(narrays):
         for module in range(nmodules):
             d   = array_data[array,module,:]
             bh  = xMAPBufferHeader(d)
-            #if verbose and array==0:
-            #print  ' nc data shape: ', d.shape, d.size
-            # print modpixs, (d.size-256), (d.size-256)/modpixs
-            # print modpixs*(d.size-256)/(1.0*modpixs)
             dat = d[256:].reshape(modpixs, (d.size-256)/modpixs )
 
             npix = bh.numPixels
@@ -118,7 +378,9 @@ def read_xmap_netcdf(fname, verbose=False):
                         # Note:  nchans = number of ROIS !!
                         nchans     = max(d[264:268])
                         data_slice = slice(64,64+8*nchans)
-                    xmapdat = xMAPData(narrays*modpixs, nmodules, nchans)
+                    xmapdat = xMAPData(narrays*modpixs, nmodules, nchans,
+                                       dtype='i2' if mapmode == 1 else 'i4')
+                    xmapdat.mappingMode = mapmode
                     xmapdat.firstPixel = bh.startingPixel
 
             # acquistion times and i/o counts data are stored
@@ -137,20 +399,184 @@ def read_xmap_netcdf(fname, verbose=False):
                 t_data = aslong(t_data)
             xmapdat.data[p1:p2,:,:] = t_data.reshape(npix,4,nchans)
 
-    t2 = time.time()
     xmapdat.numPixels = npix_total
     xmapdat.data = xmapdat.data[:npix_total]
-    xmapdat.realTime = clocktick * xmapdat.realTime[:npix_total]
-    xmapdat.liveTime = clocktick * xmapdat.liveTime[:npix_total]
+    xmapdat.realTime = CLOCKTICK * xmapdat.realTime[:npix_total]
+    xmapdat.liveTime = CLOCKTICK * xmapdat.liveTime[:npix_total]
     xmapdat.inputCounts  = xmapdat.inputCounts[:npix_total]
     xmapdat.outputCounts = xmapdat.outputCounts[:npix_total]
+    return xmapdat
+
+def mmap_array_data(fname):
+    """return the array_data variable of an xMAP netcdf file as a
+    read-only array mapped directly onto the file.
+
+    The returned array holds its own memory map, so it (and any views
+    of it) stay valid after the netcdf file is closed.  Returns None
+    if the file cannot be memory-mapped.
+    """
+    try:
+        fh = netcdf_open(fname, 'r', mmap=True)
+    except (TypeError, ValueError, IndexError, KeyError, EnvironmentError):
+        return None
+    try:
+        var = fh.variables['array_data'].data
+    except KeyError:
+        fh.variables.clear()
+        fh.close()
+        return None
+    shape, strides, dtype = var.shape, var.strides, var.dtype
+    # find the offset of array_data in the file from the start of
+    # the buffer (the mmap itself) that its data lives in
+    base = var
+    while isinstance(base, np.ndarray) and base.base is not None:
+        base = base.base
+    offset = None
+    if not isinstance(base, np.ndarray):
+        start = np.frombuffer(base, dtype=np.uint8)
+        offset = (var.__array_interface__['data'][0] -
+                  start.__array_interface__['data'][0])
+        del start
+    # drop all arrays referring to the netcdf file's own memory map, so
+    # that closing the file also closes that map (not all versions of
+    # scipy drop its variables on close), leaving only the map below
+    del var, base
+    fh.variables.clear()
+    fh.close()
+    if offset is None:
+        return None
+    fmap = np.memmap(fname, dtype=np.uint8, mode='r')
+    return np.ndarray(shape, dtype=dtype, buffer=fmap,
+                      offset=offset, strides=strides)
+
+def read_xmap_header(fname):
+    """read mapping mode, number of modules and buffers, and the starting
+    and total number of pixels of an xMAP netcdf file, without decoding
+    (or, when memory-mapped, even reading) the pixel data.
+
+    returns an xMAPFileInfo.  Raises IOError if the file cannot be read,
+    as for a file that is still being written.
+    """
+    try:
+        array_data = mmap_array_data(fname)
+        if array_data is None:
+            fh = netcdf_open(fname, 'r', mmap=False)
+            array_data = fh.variables['array_data'][:]
+            fh.close()
+        array_data = _xmap_array3d(array_data)
+        heads = array_data[:, :, :256].astype(np.int16)
+    except (TypeError, ValueError, IndexError, KeyError):
+        raise IOError("cannot read xMAP header from '%s'" % fname)
+    if heads.shape[0] < 1:
+        raise IOError("no xMAP buffers in '%s'" % fname)
+    return xMAPFileInfo(heads)
+
+def xmap_file_complete(fname, npixels=None):
+    """return whether an xMAP netcdf file is complete: its buffer
+    headers can be read and (if npixels is given) it holds at least
+    npixels pixels."""
+    try:
+        info = read_xmap_header(fname)
+    except EnvironmentError:
+        return False
+    return npixels is None or info.numPixels >= npixels
+
+def read_xmap_netcdf(fname, verbose=False, use_mmap=False, out=None):
+    """Reads a netCDF file created with the DXP xMAP driver
+    with the netCDF plugin buffers
+
+    with use_mmap=True, the file is memory-mapped instead of read, so
+    that it is not held in memory in addition to the decoded data.
+    The spectra are copied once, while decoding, except for rows of
+    at most 124 pixels of a single module (see decode_xmap_buffers),
+    for which they are read-only strided views into the file.
+
+    if out is an xMAPData, it is refilled in place and returned,
+    see decode_xmap_buffers.
+    """
+    if verbose: print ' reading ', fname
+
+    t0 = time.time()
+    # read data from array_data variable of netcdf file
+    array_data = None
+    if use_mmap:
+        array_data = mmap_array_data(fname)
+    if array_data is None:
+        fh = netcdf_open(fname, 'r', mmap=False)
+        array_data = fh.variables['array_data'][:]
+        fh.close()
+    t1 = time.time()
+
+    xmapdat = decode_xmap_buffers(array_data, copy=not use_mmap, out=out)
+
+    t2 = time.time()
     if verbose:
         print '   time to read file    = %5.1f ms' % ((t1-t0)*1000)
         print '   time to extract data = %5.1f ms' % ((t2-t1)*1000)
-        print '   read %i pixels ' %  npix_total
+        print '   read %i pixels ' %  xmapdat.numPixels
         print '   data shape:    ' ,  xmapdat.data.shape
     return xmapdat
 
+def _read_xmap_file(fname, timeout=10):
+    """read an xMAP file for an xMAPReaderPool, waiting up to timeout
+    seconds for it to be complete, as signaled by the folder watcher.
+    returns None on failure."""
+    watcher = get_watcher(os.path.dirname(os.path.abspath(fname)))
+    if not watcher.wait(fname, complete=xmap_file_complete, timeout=timeout):
+        return None
+    try:
+        return read_xmap_netcdf(fname, verbose=False)
+    except (IOError, IndexError, ValueError):
+        return None
+
+class xMAPReaderPool(object):
+    """decode many xMAP netcdf files in a pool of worker processes
+
+    >>> pool = xMAPReaderPool(nworkers=4)
+    >>> for xmapdat in pool.imap(filenames):
+    ...     do_something(xmapdat)
+    >>> pool.close()
+
+    files are decoded ahead of use, but are yielded in the order given,
+    with at most maxqueue files (default 2*nworkers) in flight, so that
+    memory use stays bounded when the consumer is slower than the
+    workers.  With nworkers=1, files are read in this process.
+    """
+    def __init__(self, nworkers=None, maxqueue=None, timeout=10):
+        if nworkers is None:
+            nworkers = multiprocessing.cpu_count()
+        if maxqueue is None:
+            maxqueue = 2*nworkers
+        self.nworkers = nworkers
+        self.maxqueue = max(1, maxqueue)
+        self.timeout  = timeout
+        self.pool = None
+        if nworkers > 1:
+            self.pool = multiprocessing.Pool(nworkers)
+
+    def imap(self, filenames):
+        """generate an xMAPData for each file in filenames, in order.
+        None is generated for files that cannot be read."""
+        if self.pool is None:
+            for fname in filenames:
+                yield _read_xmap_file(fname, timeout=self.timeout)
+            return
+        pending = deque()
+        for fname in filenames:
+            pending.append(self.pool.apply_async(_read_xmap_file,
+                                                 (fname, self.timeout)))
+            if len(pending) >= self.maxqueue:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+
+    def close(self):
+        "stop the worker processes"
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
 if __name__ == '__main__':
     import sys, os
     fname = sys.argv[1]
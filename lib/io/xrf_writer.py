@@ -5,7 +5,7 @@ import glob
 
 from ConfigParser import  ConfigParser
 from mapfolder import readEnvironFile, readScanConfig
-from xmap_nc import read_xmap_netcdf
+from xmap_nc import xMAPReaderPool
 
 def readROIFile(hfile):
     cp =  ConfigParser()
@@ -38,9 +38,11 @@ ROI4_TMPL ="""ROI_%i_LEFT:   %s %s %s %s
 ROI_%i_RIGHT:  %s %s %s %s
 ROI_%i_LABEL:  %s & %s & %s & %s &
 """
-def WriteFullXRF(folder):
+def WriteFullXRF(folder, nworkers=1):
+    """write the sum of all xmap spectra in a map folder to an .xrf file.
+    with nworkers > 1, the xmap files are read in parallel"""
     conf = readScanConfig(folder)
-    xrffile = "%s.xrf" % conf[0]['filename']
+    xrffile = "%s.xrf" % conf['scan']['filename']
     rois, calib = readROIFile(os.path.join(folder, 'ROI.dat'))
     env = readEnvironFile(os.path.join(folder, 'Environ.dat'))
 
@@ -54,26 +56,31 @@ def WriteFullXRF(folder):
     ltime, rtime, spectra = None, None, None
 
     filelist = glob.glob(os.path.join(folder, 'xmap.*'))
-    for xmapfile in filelist:
-        xmapdat = read_xmap_netcdf(xmapfile, verbose=False)
-        if spectra is None:
-            spectra = xmapdat.data[:]
-        else:
-            spectra = spectra + xmapdat.data[:]
-        if ltime is None:
-            ltime = xmapdat.liveTime[:]
-        else:
-            ltime = ltime + xmapdat.liveTime[:]
-        if rtime is None:
-            rtime = xmapdat.realTime[:]
-        else:
-            rtime = rtime + xmapdat.realTime[:]
+    pool = xMAPReaderPool(nworkers=nworkers)
+    try:
+        for xmapdat in pool.imap(filelist):
+            if xmapdat is None:
+                continue
+            if spectra is None:
+                spectra = xmapdat.data[:]
+            else:
+                spectra = spectra + xmapdat.data[:]
+            if ltime is None:
+                ltime = xmapdat.liveTime[:]
+            else:
+                ltime = ltime + xmapdat.liveTime[:]
+            if rtime is None:
+                rtime = xmapdat.realTime[:]
+            else:
+                rtime = rtime + xmapdat.realTime[:]
+    finally:
+        pool.close()
 
     spectra = spectra.sum(axis=0)
     rtime = rtime.sum(axis=0)
     ltime = ltime.sum(axis=0)
 
-    nchan, nelem = spectra.shape
+    nelem, nchan = spectra.shape
     nrois = len(rois)
     fp = open(xrffile, 'w')
 
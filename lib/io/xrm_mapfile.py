@@ -1,14 +1,22 @@
 import os
+import sys
 import socket
 import time
+import threading
+import Queue
 import h5py
 import numpy as np
 
 from ..utils.debugtime import debugtime
+from ..utils.lrucache import LRUCache
 from ..config import FastMapConfig
 
-from .xmap_nc import read_xmap_netcdf
-from .mapfolder import (readASCII, readMasterFile,
+from .xmap_nc import (xMAPData, xMAPReaderPool, read_xmap_netcdf,
+                      xmap_file_complete)
+from .xsp3_hdf5 import (Xspress3Data, read_xsp3_hdf5, xsp3_file_complete,
+                        is_xsp3_file)
+from .folder_watcher import get_watcher
+from .mapfolder import (readASCII, MasterFileTail,
                         readEnvironFile, parseEnviron,
                         readROIFile)
 
@@ -16,6 +24,91 @@ from .file_utils import nativepath
 
 NINIT = 16
 COMP = 4 # compression level
+# rows of map data held in memory by GSEXRM_MapFile before being
+# written, which is also the number of rows in each dataset chunk
+WRITE_BATCH = 4
+# largest size in bytes of a dataset chunk
+CHUNK_BYTES = 1024*1024
+# largest size in bytes of the ROI maps kept by GSEXRM_MapFile
+MAP_CACHE_BYTES = 32*1024*1024
+# datasets of /xrfmap/stats holding a value for each row, with the
+# name of the dataset holding the value for all rows, and the ufunc
+# used to combine them
+STATS_TOTALS = {'row_spectrum':    ('sum_spectrum', np.add),
+                'row_maxspectrum': ('max_spectrum', np.maximum),
+                'row_min': ('min', np.minimum),
+                'row_max': ('max', np.maximum),
+                'row_sum': ('sum', np.add)}
+ROIMAP_STATS = ('det_raw', 'det_cor', 'sum_raw', 'sum_cor')
+
+# storage profiles for the map datasets, which grow by row:
+#   compression, compression_opts: HDF5 filter ('gzip' or 'lzf') and level
+#   shuffle: whether to use the byte-shuffle filter
+#   layout:  'row' for chunks holding complete rows, split along energy
+#            if needed: best for writing rows and reading maps,
+#            'tiled' for chunks holding complete spectra for a tile of
+#            rows and points: best for reading spectra over an area.
+#   rows:    number of rows per chunk, and default write batch
+# 'fast' writes quickly, to larger files, and 'archive' makes smaller
+# files, at some cost in writing time.  gzip levels above 4 compress
+# map data only slightly better, at several times the cost: higher
+# levels are used only by repack_mapfile (see REPACK_LEVEL).
+STORAGE_PROFILES = {
+    'standard': dict(compression='gzip', compression_opts=COMP,
+                     shuffle=False, layout='row', rows=WRITE_BATCH),
+    'fast':     dict(compression='lzf', compression_opts=None,
+                     shuffle=False, layout='row', rows=WRITE_BATCH),
+    'archive':  dict(compression='gzip', compression_opts=COMP,
+                     shuffle=True, layout='tiled', rows=8)}
+# gzip level for repacking map files
+REPACK_LEVEL = 9
+# number of channels for the energy arrays of ROI-mode maps,
+# which have no spectra to take it from
+NCHAN_ROIMODE = 2048
+# channels per chunk of the energy index
+ECUM_CHANS = 16
+
+def chunk_shape(shape, dtype, nrows=WRITE_BATCH, layout='row',
+                maxbytes=CHUNK_BYTES):
+    """chunk shape for a map dataset of shape (rows, points, ...),
+    holding nrows rows, and no larger than maxbytes.
+
+    for layout='row', the largest of the other dimensions is halved
+    until the chunk fits.  for layout='tiled', the points are halved
+    first, so that chunks hold complete spectra if possible.
+    """
+    chunks = [nrows] + list(shape[1:])
+    size = np.dtype(dtype).itemsize * np.prod(chunks)
+    while size > maxbytes and max(chunks[1:]) > 1:
+        if layout == 'tiled' and chunks[1] > 1:
+            i = 1
+        else:
+            i = 1 + np.argmax(chunks[1:])
+        chunks[i] = (chunks[i]+1)/2
+        size = np.dtype(dtype).itemsize * np.prod(chunks)
+    return tuple(chunks)
+
+def storage_options(storage, shape, dtype, nrows=None):
+    """keyword arguments for h5py create_dataset() for a map dataset
+    of shape (rows, ...) for a storage profile (a name in
+    STORAGE_PROFILES or a dictionary like its values).
+    nrows overrides the rows per chunk of the profile."""
+    if not isinstance(storage, dict):
+        if storage not in STORAGE_PROFILES:
+            raise GSEXRM_Exception("unknown storage profile '%s'" % storage)
+        storage = STORAGE_PROFILES[storage]
+    if nrows is None:
+        nrows = storage.get('rows', WRITE_BATCH)
+    opts = {'maxshape': (None,) + tuple(shape[1:]),
+            'chunks': chunk_shape(shape, dtype, nrows=nrows,
+                                  layout=storage.get('layout', 'row'))}
+    if storage.get('compression', None) is not None:
+        opts['compression'] = storage['compression']
+        if storage.get('compression_opts', None) is not None:
+            opts['compression_opts'] = storage['compression_opts']
+    if storage.get('shuffle', False):
+        opts['shuffle'] = True
+    return opts
 
 class GSEXRM_FileStatus:
     no_xrfmap    = 'hdf5 does not have /xrfmap'
@@ -32,27 +125,29 @@ def getFileStatus(filename):
 
     # see if file is an H5 file
     try:
-        fh = h5py.File(filename)
+        fh = h5py.File(filename, 'r')
     except IOError:
         return GSEXRM_FileStatus.err_nothdf5
+    status = GSEXRM_FileStatus.created
     if 'xrfmap' not in fh:
-        return GSEXRM_FileStatus.no_xrfmap
-
-    if 'det1' in fh['/xrfmap']:
-        return GSEXRM_FileStatus.hasdata
+        status = GSEXRM_FileStatus.no_xrfmap
+    elif 'det1' in fh['/xrfmap']:
+        status = GSEXRM_FileStatus.hasdata
     fh.close()
-    return GSEXRM_FileStatus.created
+    return status
 
 def isGSEXRM_MapFolder(fname):
     "return whether folder a valid Scan Folder (raw data)"
     if (fname is None or not os.path.exists(fname) or
         not os.path.isdir(fname)):
         return False
-    flist = os.listdir(fname)
-    for f in ('Master.dat', 'Environ.dat', 'Scan.ini', 'xmap.0001'):
-        if f not in flist:
+    # checking for files, not listing the folder, which may be large
+    exists = os.path.exists
+    for f in ('Master.dat', 'Environ.dat', 'Scan.ini'):
+        if not exists(os.path.join(fname, f)):
             return False
-    return True
+    return (exists(os.path.join(fname, 'xmap.0001')) or
+            exists(os.path.join(fname, 'xsp3.0001')))
 
 H5ATTRS = {'Version': '1.3.0',
            'Title': 'Epics Scan Data',
@@ -99,6 +194,12 @@ def create_xrfmap(h5root, dimension=2, folder='', start_time=None):
         conf.create_group(name)
     h5root.flush()
 
+def xrf_file_complete(fname):
+    "return whether an xmap or xspress3 file is complete"
+    if is_xsp3_file(fname):
+        return xsp3_file_complete(fname)
+    return xmap_file_complete(fname)
+
 class GSEXRM_Exception(Exception):
     """GSEXRM Exception: General Errors"""
     def __init__(self, msg):
@@ -121,7 +222,7 @@ class GSEXRM_MapRow:
     """
     def __init__(self, yvalue, xmapfile, xpsfile, sisfile, folder,
                  reverse=False, ixaddr=0, dimension=2, npts=None,
-                 dtime=None):
+                 dtime=None, use_mmap=False, xmapbuff=None, xmapdat=None):
 
         self.npts = npts
         self.yvalue = yvalue
@@ -134,27 +235,50 @@ class GSEXRM_MapRow:
         self.sishead = shead
         if dtime is not None:  dtime.add('maprow: read ascii files')
         t0 = time.time()
-        atime = -1
-        xmapdat = None
+        # xmapdat may have been decoded already (as by an xMAPReaderPool)
+        # the XRF data is read from xmap netcdf or (for files named
+        # 'xsp3.NNNN') Xspress3 HDF5 files, into xmapbuff if given.
         xmfile = os.path.join(folder, xmapfile)
-        while atime < 0 and time.time()-t0 < 10:
+        xsp3 = is_xsp3_file(xmapfile)
+        # wait (up to 10 sec) for the file to be completely written,
+        # as signaled by the folder watcher, before decoding the file
+        file_complete = xsp3_file_complete if xsp3 else xmap_file_complete
+        watcher = get_watcher(folder)
+        while xmapdat is None and time.time()-t0 < 10:
+            if not watcher.wait(xmfile, complete=file_complete,
+                                timeout=10-(time.time()-t0)):
+                break
             try:
-                atime = os.stat(xmfile).st_ctime
-                xmapdat = read_xmap_netcdf(xmfile, verbose=False)
-            except (IOError, IndexError):
+                if xsp3:
+                    xmapdat = read_xsp3_hdf5(xmfile, out=xmapbuff)
+                else:
+                    xmapdat = read_xmap_netcdf(xmfile, verbose=False,
+                                               use_mmap=use_mmap,
+                                               out=xmapbuff)
+            except (IOError, IndexError, KeyError, ValueError):
                 time.sleep(0.010)
 
-        if atime < 0 or xmapdat is None:
+        if xmapdat is None:
             print 'Failed to read xmap data from %s' % self.xmapfile
             return
         if dtime is not None:  dtime.add('maprow: read xmap files')
         #
+        # with use_mmap, spectra may be a read-only view into the
+        # xmap file (only for rows in one buffer of one module).
+        # with xmapbuff, the arrays belong to that buffer, and are
+        # only valid until it is used to read the next row.
+        # in ROI mode, spectra holds the ROI sums (npts, nmca, nrois)
+        self.roimode   = (xmapdat.mappingMode == 2)
         self.spectra   = xmapdat.data # [:]
         self.inpcounts = xmapdat.inputCounts # [:]
         self.outcounts = xmapdat.outputCounts # [:]
-        den = self.outcounts[:]
-        den[np.where(den<1)] = 1
-        self.dtfactor  = xmapdat.inputCounts/den
+        if xsp3:
+            # Xspress3 computes its own dead-time correction
+            self.dtfactor = xmapdat.dtFactor
+        else:
+            den = self.outcounts[:]
+            den[np.where(den<1)] = 1
+            self.dtfactor  = xmapdat.inputCounts/den
         # times are extracted from the netcdf file as floats of microseconds
         # here we truncate to nearest microsecond (clock tick is 0.32 microseconds)
         self.livetime  = (xmapdat.liveTime[:]).astype('int')
@@ -204,6 +328,229 @@ class GSEXRM_MapRow:
         # pform = "=Write Scan Data row=%i, npts=%i, folder=%s"
         # print pform % (irow, npts, self.folder)
 
+def xcumulative(spectra):
+    """accumulate spectra of shape (..., npts, nchan) along points,
+    returning float64 array of shape (..., npts+1, nchan), starting
+    with 0"""
+    shape = list(spectra.shape)
+    shape[-2] += 1
+    out = np.zeros(shape, dtype=np.float64)
+    np.cumsum(spectra, axis=-2, dtype=np.float64, out=out[..., 1:, :])
+    return out
+
+def roi_sums(spectra, roi_slices):
+    """return the sums of spectra of shape (npts, nmca, nchan) over ROIs,
+    given as a list of one slice of channels for each mca for each ROI,
+    as an integer array of shape (npts, nrois, nmca).
+
+    From the cumulative sum of each spectrum along energy (over the
+    channels spanned by the ROIs), each ROI is the difference of its
+    values at the ROI limits."""
+    npts, nmca, nchan = spectra.shape
+    bounds = np.array([[(s.start, s.stop) for s in slices]
+                       for slices in roi_slices])
+    bounds = np.clip(bounds, 0, nchan)
+    lo, hi = bounds.min(), bounds.max()
+    bounds = bounds - lo
+    # int16 spectra cannot overflow int32 sums
+    dtype = np.int32 if spectra.dtype.itemsize <= 2 else np.int64
+    cum = np.zeros((npts, nmca, hi-lo+1), dtype=dtype)
+    np.cumsum(spectra[:, :, lo:hi], axis=2, out=cum[:, :, 1:])
+    imca = np.arange(nmca)
+    return cum[:, imca, bounds[:, :, 1]] - cum[:, imca, bounds[:, :, 0]]
+
+def roimap_names(sis_desc, sis_addr, roi_names, roi_addrs, nmca):
+    """return the names and addresses of the columns of roimap/det_raw
+    (scalers, then each ROI for each mca), and the names of the columns
+    of roimap/sum_raw with, for each, the columns of det_raw it sums,
+    padded with -1: (det_desc, det_addr, sums_desc, sums_list)"""
+    det_desc = list(sis_desc)
+    det_addr = list(sis_addr)
+    for addr in roi_addrs:
+        det_addr.extend([addr % (i+1) for i in range(nmca)])
+
+    for desc in roi_names:
+        det_desc.extend(["%s (mca%i)" % (desc, i+1)
+                         for i in range(nmca)])
+
+    sums_map = {}
+    sums_desc = []
+    nsum = 0
+    for idet, addr in enumerate(det_desc):
+        if '(mca' in addr:
+            addr = addr.split('(mca')[0].strip()
+
+        if addr not in sums_map:
+            sums_map[addr] = []
+            sums_desc.append(addr)
+        sums_map[addr].append(idet)
+    nsum = max([len(s) for s in sums_map.values()])
+    sums_list = []
+    for sname in sums_desc:
+        slist = sums_map[sname]
+        if len(slist) < nsum:
+            slist.extend([-1]*(nsum-len(slist)))
+        sums_list.append(slist)
+    return det_desc, det_addr, sums_desc, np.array(sums_list)
+
+def roimap_stats(data):
+    """return the minimum, maximum and sum of roi map data of shape
+    (..., npts, nx) over the points of each row, as a list of
+    (name, array) for the datasets of /xrfmap/stats/roimap/<map>"""
+    return [('row_min', data.min(axis=-2)),
+            ('row_max', data.max(axis=-2)),
+            ('row_sum', data.sum(axis=-2, dtype=np.float64))]
+
+def spectra_stats(spectra):
+    """return the sum and maximum of spectra of shape (..., npts, nchan)
+    over the points of each row, as a list of (name, array) for the
+    datasets of /xrfmap/stats/<detector>"""
+    return [('row_spectrum', spectra.sum(axis=-2, dtype=np.float64)),
+            ('row_maxspectrum', spectra.max(axis=-2))]
+
+def spectra_dtype(dtype):
+    """return the dtype for storing spectra of a given dtype in a map
+    file: int16 for the int16 spectra of xMAP detectors, and the dtype
+    itself for wider spectra, such as the uint32 spectra of Xspress3"""
+    dtype = np.dtype(dtype)
+    return np.dtype(np.int16) if dtype.itemsize <= 2 else dtype
+
+def ecumulative(spectra):
+    """accumulate integer spectra of shape (..., nchan) along energy,
+    returning an array of shape (..., nchan+1), starting with 0, as
+    int32 for int16 spectra and int64 for wider spectra"""
+    shape = list(spectra.shape)
+    shape[-1] += 1
+    dtype = np.int32 if spectra.dtype.itemsize <= 2 else np.int64
+    out = np.zeros(shape, dtype=dtype)
+    np.cumsum(spectra, axis=-1, out=out[..., 1:])
+    return out
+
+class GSEXRM_SpectraView(object):
+    """spectra of one mca detector group of a GSEXRM Map File, read in
+    blocks of the pixels in one chunk of rows and points of its 'data'.
+
+    With dtcorrect=True, the spectra are multiplied by the dead-time
+    correction factor for each pixel as they are read, as float32.
+    With an LRUCache as cache, blocks of complete rows are read and
+    corrected once, and kept in the cache, so that reading the same
+    area again does not read or correct the spectra again.  Without a
+    cache, only the pixels asked for are read.
+
+    >>> view = GSEXRM_SpectraView(xrfmap['det1'], dtcorrect=True)
+    >>> spec = view.sum_region(slice(10, 20), slice(40, 50), nrows)
+    """
+    def __init__(self, group, dtcorrect=True, cache=None):
+        self.data = group['data']
+        self.dtfactor = group['dtfactor']
+        self.ecumspec = group.get('ecumspec', None)
+        self.dtcorrect = dtcorrect
+        self.cache = cache
+        chunks = self.data.chunks
+        if chunks is None:
+            chunks = (WRITE_BATCH, self.data.shape[1])
+        self.brows, self.bpts = chunks[0], chunks[1]
+        self.key = (group.file.filename, group.name, dtcorrect)
+
+    def read(self, r0, r1, p0, p1):
+        "read spectra for rows r0:r1 and points p0:p1"
+        spectra = self.data[r0:r1, p0:p1, :]
+        if self.dtcorrect:
+            spectra = spectra.astype(np.float32)
+            spectra *= self.dtfactor[r0:r1, p0:p1][:, :, np.newaxis]
+        return spectra
+
+    def iter_blocks(self, r0, r1, p0, p1, nrows, mask=None):
+        """generate (rows, points, spectra) for the blocks covering rows
+        r0:r1 and points p0:p1, where rows and points are slices of
+        the block spectra, in map pixels, for the first nrows rows.
+
+        with a boolean mask of shape (nrows, npts), blocks with no
+        pixels in the mask are skipped, and rows and points only cover
+        the pixels of the block in the mask."""
+        npts = self.data.shape[1]
+        for ib in range(r0/self.brows, (r1-1)/self.brows + 1):
+            br0 = ib*self.brows
+            br1 = min(br0 + self.brows, nrows)
+            for jb in range(p0/self.bpts, (p1-1)/self.bpts + 1):
+                bp0 = jb*self.bpts
+                bp1 = min(bp0 + self.bpts, npts)
+                rows = slice(max(r0, br0), min(r1, br1))
+                pts  = slice(max(p0, bp0), min(p1, bp1))
+                if mask is not None:
+                    irows, ipts = np.where(mask[rows, pts])
+                    if len(irows) < 1:
+                        continue
+                    rows = slice(rows.start + irows.min(),
+                                 rows.start + irows.max() + 1)
+                    pts  = slice(pts.start + ipts.min(),
+                                 pts.start + ipts.max() + 1)
+                # only blocks of rows that are complete are cached
+                if self.cache is None or br0 + self.brows > nrows:
+                    yield rows, pts, self.read(rows.start, rows.stop,
+                                               pts.start, pts.stop)
+                    continue
+                key = self.key + (ib, jb)
+                block = self.cache.get(key)
+                if block is None:
+                    block = self.read(br0, br1, bp0, bp1)
+                    self.cache[key] = block
+                yield rows, pts, block[rows.start-br0:rows.stop-br0,
+                                       pts.start-bp0:pts.stop-bp0]
+
+    def sum_region(self, rows, pts, nrows):
+        """return the spectrum summed over the pixels in the rows and
+        points slices, for the first nrows rows"""
+        r0, r1, step = rows.indices(nrows)
+        p0, p1, step = pts.indices(self.data.shape[1])
+        total = np.zeros(self.data.shape[2], dtype=self.sum_dtype())
+        if r1 <= r0 or p1 <= p0:
+            return total
+        for rows, pts, spectra in self.iter_blocks(r0, r1, p0, p1, nrows):
+            total += spectra.sum(axis=(0, 1), dtype=total.dtype)
+        return total
+
+    def sum_mask(self, mask):
+        """return the spectrum summed over the pixels where the boolean
+        array mask, of shape (nrows, npts), is True"""
+        mask = np.asarray(mask, dtype=bool)
+        total = np.zeros(self.data.shape[2], dtype=self.sum_dtype())
+        irows, ipts = np.where(mask)
+        if len(irows) < 1:
+            return total
+        r0, r1 = irows.min(), irows.max()+1
+        p0, p1 = ipts.min(), ipts.max()+1
+        for rows, pts, spectra in self.iter_blocks(r0, r1, p0, p1,
+                                                   mask.shape[0], mask=mask):
+            total += spectra[mask[rows, pts]].sum(axis=0, dtype=total.dtype)
+        return total
+
+    def sum_channels(self, c0, c1, nrows):
+        """return the map of the spectra summed over channels c0 to c1-1,
+        for the first nrows rows.  With an energy index ('ecumspec', see
+        GSEXRM_MapFile.create_energy_index), this reads two planes of the
+        index, otherwise the spectra are read and summed one block of
+        rows at a time."""
+        npts = self.data.shape[1]
+        if self.ecumspec is not None:
+            out = self.ecumspec[:nrows, :, c1].astype(np.float64)
+            out -= self.ecumspec[:nrows, :, c0]
+        else:
+            out = np.zeros((nrows, npts))
+            for r0 in range(0, nrows, self.brows):
+                r1 = min(r0 + self.brows, nrows)
+                out[r0:r1] = self.data[r0:r1, :, c0:c1].sum(axis=2,
+                                                             dtype=np.int64)
+        if self.dtcorrect:
+            out *= self.dtfactor[:nrows]
+        return out
+
+    def sum_dtype(self):
+        "dtype of summed spectra"
+        if self.dtcorrect:
+            return np.float64
+        return np.int64
+
 class GSEXRM_MapFile(object):
     """
     Access to GSECARS X-ray Microprobe Map File:
@@ -211,6 +558,7 @@ class GSEXRM_MapFile(object):
     The GSEXRM Map file is an HDF5 file built from a folder containing
     'raw' data from a set of sources
          xmap:   XRF spectra saved to NetCDF by the Epics MCA detector
+                 (or xsp3: saved to HDF5 by the Xspress3 detector)
          struck: a multichannel scaler, saved as ASCII column data
          xps:    stage positions, saved as ASCII file from the Newport XPS
 
@@ -235,6 +583,67 @@ class GSEXRM_MapFile(object):
                     None means to use the sum of all detectors
        dtcorrect:   whether to return dead-time corrected spectra     [True]
 
+    When converting from a raw folder, the xmap files are memory-mapped
+    (use_mmap=True) so that they are not read into memory before being
+    decoded, and all rows are decoded into one reusable xMAPData
+    buffer, so that converting a map does not allocate new arrays
+    for each row.
+
+    With nworkers > 1, process() runs as a pipeline (see iter_pipeline):
+    the xmap files of the rows to be added are decoded in parallel by an
+    xMAPReaderPool of nworkers processes, the row data is computed in
+    a separate thread, and rows are written to the HDF5 file, in order,
+    by the calling thread.
+
+    The compression and chunk layout of the map datasets are set by the
+    storage profile, one of STORAGE_PROFILES: 'standard', 'fast' (LZF,
+    faster to write, for converting during collection) or 'archive'
+    (gzip with shuffle, and chunks of complete spectra: smaller files,
+    but slower to write).  Rows are written in batches of write_batch
+    rows, by default the number of rows per chunk.
+    Use repack_mapfile() to convert a map file to another profile.
+
+    With spectra_index=True, an index of dead-time corrected spectra
+    accumulated along each row is stored and kept up to date as rows
+    are added, so that get_spectra() for the sum of all detectors reads
+    only two points per row (see create_spectra_index).  The index is
+    float64, so that it takes 4 times the space of the int16 spectra
+    of one detector, uncompressed, and compresses less well: expect it
+    to be about as large as the spectra of all detectors.  Use
+    add_spectra_index() to add it to an existing file.
+
+    With energy_index=True, an index of the spectra of each detector
+    accumulated along energy is stored as well, so that get_map_erange()
+    reads only two channels of each pixel (see create_energy_index).
+    Use add_energy_index() to add it to an existing file.
+
+    Spectra summed over an area of the map are read one block of pixels
+    at a time, and with dtcorrect=True corrected for dead-time as they
+    are read.  Blocks of corrected spectra are kept in an LRU cache of
+    up to cache_mbytes megabytes, shared by all detectors.  ROI maps
+    read with get_roimap() or get_roimaps() are kept in a smaller LRU
+    cache, until more rows are added.
+
+    Statistics of the map are kept in /xrfmap/stats, and updated as rows
+    are written: for each detector and detsum, the spectrum summed over
+    all pixels, the spectrum of the largest counts in each channel, and
+    the summed spectrum of each row, all dead-time corrected, and for
+    each roi map array, the minimum, maximum and sum of each map, and of
+    each row.  Use add_map_stats() to add them to an existing file.
+
+    The map arrays are allocated for the number of rows expected from
+    Master.dat.  The 'Last_Row' attribute of /xrfmap gives the last row
+    written, and the arrays are trimmed to the rows written on close().
+
+    With readonly=True, an existing map file is opened read-only, the
+    file is never claimed or modified, and the names and energies used
+    by the get_* methods are read once, when the file is opened.
+
+    With swmr=True, the HDF5 file is created with the latest file format
+    (readable with HDF5 1.10 or later), and process() writes it in SWMR
+    (single writer, multiple reader) mode, so that any number of
+    GSEXRM_MapReaders can follow the map as it is written.
+
     """
 
     ScanFile   = 'Scan.ini'
@@ -242,9 +651,35 @@ class GSEXRM_MapFile(object):
     ROIFile    = 'ROI.dat'
     MasterFile = 'Master.dat'
 
-    def __init__(self, filename=None, folder=None):
+    def __init__(self, filename=None, folder=None, use_mmap=True, nworkers=1,
+                 storage='standard', write_batch=None, swmr=False,
+                 readonly=False, cache_mbytes=128, spectra_index=False,
+                 energy_index=False):
         self.filename = filename
+        self.spectra_index = spectra_index
+        self.energy_index = energy_index
+        self.swmr     = swmr
+        self.readonly = readonly
+        self.cache    = {}
+        self.spectra_cache = None
+        self.map_cache = None
+        if cache_mbytes > 0:
+            self.spectra_cache = LRUCache(maxbytes=cache_mbytes*2**20)
+            self.map_cache = LRUCache(maxbytes=MAP_CACHE_BYTES)
+        self.roimap_index = {}
         self.folder   = folder
+        self.use_mmap = use_mmap
+        self.nworkers = nworkers
+        self.storage  = storage
+        self.write_batch = write_batch
+        self.rowbuff  = {}
+        self.rowbuff_start = 0
+        self.rowbuff_count = 0
+        # rows up to last_row may still be in the write-behind buffer:
+        # the data of the map is read only for the rows_written rows
+        self.rows_written = 0
+        self.xmapbuff = xMAPData()
+        self.xsp3buff = Xspress3Data()
         self.status   = GSEXRM_FileStatus.err_notfound
         self.dimension = None
         self.start_time = None
@@ -253,7 +688,12 @@ class GSEXRM_MapFile(object):
         self.last_row = -1
         self.rowdata = []
         self.npts = None
+        self.nrows_expected = None
+        self.master = None
+        self.mapconf = None
+        self.scan_mtime = None
         self.roi_slices = None
+        self.row_layout = None
         self.dt = debugtime()
 
         # initialize from filename or folder
@@ -273,6 +713,10 @@ class GSEXRM_MapFile(object):
             self.open(self.filename, check_status=False)
             return
 
+        if self.readonly:
+            raise GSEXRM_Exception(
+                "'%s' is not a valid GSEXRM HDF5 file" % self.filename)
+
         # file exists but is not hdf5
         if self.status ==  GSEXRM_FileStatus.err_nothdf5:
             raise GSEXRM_Exception(
@@ -282,7 +726,7 @@ class GSEXRM_MapFile(object):
         if (self.status == GSEXRM_FileStatus.err_notfound and
             self.folder is not None and isGSEXRM_MapFolder(self.folder)):
             self.read_master()
-            self.h5root = h5py.File(self.filename)
+            self.h5root = self.open_h5file()
             if self.dimension is None and isGSEXRM_MapFolder(self.folder):
                 self.read_master()
             create_xrfmap(self.h5root, dimension=self.dimension,
@@ -306,21 +750,89 @@ class GSEXRM_MapFile(object):
                     "'%s' is not a valid GSEXRM HDF5 file" % self.filename)
         self.filename = filename
         if self.h5root is None:
-            self.h5root = h5py.File(self.filename)
+            self.h5root = self.open_h5file()
         self.xrfmap = self.h5root['/xrfmap']
         if self.folder is None:
             self.folder = self.xrfmap.attrs['Map_Folder']
-        self.last_row = self.xrfmap.attrs['Last_Row']
+        self.last_row = int(self.xrfmap.attrs['Last_Row'])
+        # written in SWMR mode, and possibly not closed
+        if 'last_row' in self.xrfmap:
+            self.last_row = self.xrfmap['last_row'][0]
+        self.rows_written = self.last_row + 1
+        self.set_write_batch()
 
         try:
             self.dimension = self.xrfmap['config/scan/dimension'].value
         except:
             pass
 
+        if self.readonly:
+            # cache the names and energies used by the get_* methods
+            for path in ('roimap/det_name', 'roimap/sum_name',
+                         'roimap/pos_name'):
+                if path in self.xrfmap:
+                    self.get_cached(path)
+            for gname, group in self.xrfmap.items():
+                if isinstance(group, h5py.Group) and 'energy' in group:
+                    self.get_cached('%s/energy' % gname)
+            return
+
         if self.dimension is None and isGSEXRM_MapFolder(self.folder):
             self.read_master()
 
+    def set_write_batch(self):
+        """set the number of rows to buffer before writing: by default,
+        the rows per chunk of the existing map datasets, or of the
+        storage profile"""
+        nrows = self.write_batch
+        if nrows is None and 'det1' in self.xrfmap:
+            chunks = self.xrfmap['det1/dtfactor'].chunks
+            if chunks is not None:
+                nrows = chunks[0]
+        if nrows is None:
+            nrows = storage_options(self.storage, (1, 1), 'f4')['chunks'][0]
+        self.write_batch = max(1, nrows)
+
+    def open_h5file(self):
+        """open the HDF5 file for writing, with the latest file format
+        if it is to be written in SWMR mode, or for reading only"""
+        if self.readonly:
+            return h5py.File(self.filename, 'r')
+        if self.swmr:
+            return h5py.File(self.filename, 'a', libver='latest')
+        return h5py.File(self.filename)
+
+    def start_swmr(self):
+        """switch the HDF5 file to SWMR (single writer, multiple reader)
+        mode, so that GSEXRM_MapReader can follow the map as rows are
+        added.  No new datasets or attributes can be written in SWMR
+        mode, and readers may not see changed attributes, so the number
+        of rows written is kept in the 'last_row' dataset of /xrfmap, and
+        the attributes are only set on close()."""
+        if self.h5root.swmr_mode:
+            return
+        if not self.check_hostid():
+            raise GSEXRM_NotOwner(self.filename)
+        if 'last_row' not in self.xrfmap:
+            self.xrfmap.create_dataset('last_row', data=[self.last_row])
+        try:
+            self.h5root.swmr_mode = True
+        except ValueError:
+            raise GSEXRM_Exception(
+                "'%s' cannot be written in SWMR mode: it was not created "
+                "with swmr=True" % self.filename)
+
     def close(self):
+        """close file, first writing any buffered rows and, for the
+        owner of the file, trimming the map arrays to the rows written"""
+        if self.readonly:
+            self.h5root.close()
+            self.h5root = None
+            return
+        self.flush_rows()
+        if (self.status == GSEXRM_FileStatus.hasdata and 'det1' in self.xrfmap
+            and self.check_hostid()):
+            self.resize_arrays(self.last_row+1)
         self.xrfmap.attrs['Process_Machine'] = ''
         self.xrfmap.attrs['Process_ID'] = 0
         self.xrfmap.attrs['Last_Row'] = self.last_row
@@ -361,8 +873,8 @@ class GSEXRM_MapFile(object):
         for iroi, label, lims in roidat:
             roi_desc.append(label)
             roi_addr.append("%smca%%i.R%i" % (config['general']['xmap'], iroi))
-            roi_lim.append([lims[i] for i in range(4)])
-            roi_slices.append([slice(lims[i][0], lims[i][1]) for i in range(4)])
+            roi_lim.append([lims[i] for i in range(len(lims))])
+            roi_slices.append([slice(lo, hi) for lo, hi in lims])
         roi_lim = np.array(roi_lim)
 
         self.add_data(group['rois'], 'name',     roi_desc)
@@ -408,6 +920,7 @@ class GSEXRM_MapFile(object):
         if len(self.rowdata) < 1:
             return
         self.last_row = -1
+        self.rows_written = 0
         self.add_map_config(self.mapconf)
         row = self.read_rowdata(0)
         self.build_schema(row)
@@ -422,6 +935,9 @@ class GSEXRM_MapFile(object):
         if self.status == GSEXRM_FileStatus.created:
             self.initialize_xrfmap()
 
+        if self.swmr and self.status == GSEXRM_FileStatus.hasdata:
+            self.start_swmr()
+
         if force or (self.dimension is None and isGSEXRM_MapFolder(self.folder)):
             self.read_master()
 
@@ -430,15 +946,19 @@ class GSEXRM_MapFile(object):
             nrows = min(nrows, maxrow)
         if force or self.folder_has_newdata():
             irow = self.last_row + 1
+            if self.nworkers > 1 and nrows - irow > 1:
+                rows = self.iter_pipeline(irow, nrows)
+            else:
+                rows = ((row, None) for row in self.iter_rowdata(irow, nrows))
             while irow < nrows:
                 # self.dt.add('=>PROCESS %i' % irow)
                 if hasattr(callback, '__call__'):
                     callback(row=irow, maxrow=nrows,
                              filename=self.filename, status='reading')
-                row = self.read_rowdata(irow)
+                row, rowdata = rows.next()
                 #self.dt.add('  == read row data')
                 if row is not None:
-                    self.add_rowdata(row)
+                    self.add_rowdata(row, rowdata=rowdata)
                 #self.dt.add('  == added row data')
                 if hasattr(callback, '__call__'):
                     callback(row=irow, maxrow=nrows,
@@ -446,12 +966,127 @@ class GSEXRM_MapFile(object):
                 irow  = irow + 1
             # self.dt.show()
 
-        self.resize_arrays(self.last_row+1)
+        self.flush_rows()
         self.h5root.flush()
 
-    def read_rowdata(self, irow):
+    def iter_rowdata(self, irow, nrows, reuse=True):
+        """generate the rows from irow up to nrows from the Map Folder.
+
+        with nworkers > 1 and more than one row to read, the xmap files
+        are decoded ahead, in parallel, by an xMAPReaderPool.  Otherwise
+        the rows are read one at a time, into a reusable xmap buffer,
+        unless reuse is False.
+        """
+        xsp3 = irow < len(self.rowdata) and is_xsp3_file(self.rowdata[irow][1])
+        if self.nworkers < 2 or nrows - irow < 2 or xsp3:
+            xmapbuff = None
+            if reuse:
+                xmapbuff = self.xsp3buff if xsp3 else self.xmapbuff
+            for i in range(irow, nrows):
+                yield self.read_rowdata(i, xmapbuff=xmapbuff)
+            return
+        xmfiles = [os.path.join(self.folder, self.rowdata[i][1])
+                   for i in range(irow, min(nrows, len(self.rowdata)))]
+        pool = xMAPReaderPool(nworkers=self.nworkers)
+        try:
+            xmapdats = pool.imap(xmfiles)
+            for i in range(irow, nrows):
+                yield self.read_rowdata(i, xmapdat=next(xmapdats, None))
+        finally:
+            pool.close()
+
+    def iter_pipeline(self, irow, nrows):
+        """generate (row, rowdata) for the rows from irow up to nrows
+        from the Map Folder, with the rows read and their data computed
+        ahead, by stages connected by queues of at most nworkers rows:
+
+           reader thread:  reads the rows, with iter_rowdata(), with
+                           the xmap files decoded by nworkers processes.
+           compute thread: computes the data for each row, with
+                           compute_rowdata().
+
+        leaving the caller to write the rows to the HDF5 file, in order.
+
+        The compute thread shares the interpreter lock with the caller,
+        so computing a row only overlaps with the file reads and writes
+        and the numpy work that release the lock: the decoding of the
+        xmap files is what runs in parallel.  An error in any stage is
+        raised here, after the threads and worker processes are stopped.
+        """
+        layout = self.get_row_layout()
+        rowq  = Queue.Queue(maxsize=self.nworkers)
+        dataq = Queue.Queue(maxsize=self.nworkers)
+        stop  = threading.Event()
+        done  = object()
+
+        def put(queue, item):
+            "put item on queue, unless stopped"
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def get(queue):
+            "get item from queue, or done if stopped"
+            while not stop.is_set():
+                try:
+                    return queue.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+            return done
+
+        def reader():
+            try:
+                for row in self.iter_rowdata(irow, nrows, reuse=False):
+                    if not put(rowq, (row, None)):
+                        return
+            except:
+                put(rowq, (None, sys.exc_info()))
+            put(rowq, done)
+
+        def compute():
+            item = get(rowq)
+            while item is not done:
+                row, err = item
+                if row is not None:
+                    try:
+                        item = (row, self.compute_rowdata(row, layout))
+                    except:
+                        item = (None, sys.exc_info())
+                if not put(dataq, item):
+                    return
+                item = get(rowq)
+            put(dataq, done)
+
+        threads = [threading.Thread(target=reader, name='map reader'),
+                   threading.Thread(target=compute, name='map compute')]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            item = get(dataq)
+            while item is not done:
+                row, rowdata = item
+                if row is None and rowdata is not None:
+                    raise rowdata[0], rowdata[1], rowdata[2]
+                yield row, rowdata
+                item = get(dataq)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def read_rowdata(self, irow, xmapbuff=None, xmapdat=None):
         """read a row's worth of raw data from the Map Folder
         returns arrays of data
+
+        if xmapbuff (an xMAPData, or Xspress3Data for xspress3 files) is
+        given, the xrf data is read into it, and the row is only valid
+        until xmapbuff is reused.
+        if xmapdat is given, it is used as the already decoded xmap data.
         """
         if self.dimension is None or irow > len(self.rowdata):
             self.read_master()
@@ -463,97 +1098,204 @@ class GSEXRM_MapFile(object):
         reverse = (irow % 2 != 0)
         row = GSEXRM_MapRow(yval, xmapf, xpsf, sisf, ixaddr=self.ixaddr,
                             dimension=self.dimension, npts=self.npts,
-                            folder=self.folder, reverse=reverse)
+                            folder=self.folder, reverse=reverse,
+                            use_mmap=self.use_mmap, xmapbuff=xmapbuff,
+                            xmapdat=xmapdat)
         # dtime = self.dt)
         return row
 
-    def add_rowdata(self, row):
-        """adds a row worth of real data"""
-        if not self.check_hostid():
-            raise GSEXRM_NotOwner(self.filename)
+    def get_row_layout(self):
+        """return the layout of the rows of map data in the file, as a
+        dictionary with the names of the mca detector groups ('mcas'),
+        the number of points per row ('npts'), whether the map holds
+        only ROI sums, with no spectra ('roimode'), and whether it holds
+        the spectra index ('xcumspec'), the energy index ('ecumspec') and
+        the map statistics ('stats').
+        This also sets the ROI slices used by compute_rowdata()."""
+        if self.row_layout is None:
+            mcas = []
+            for gname in sorted(self.xrfmap.keys()):
+                g = self.xrfmap[gname]
+                if g.attrs.get('type', None) == 'mca detector':
+                    mcas.append(gname)
+                    nrows, npts = g['dtfactor'].shape
+            self.row_layout = {'mcas': mcas, 'npts': npts,
+                               'roimode': 'data' not in self.xrfmap[mcas[0]],
+                               'xcumspec': 'xcumspec' in self.xrfmap['detsum'],
+                               'ecumspec': 'ecumspec' in self.xrfmap[mcas[0]],
+                               'stats': 'stats' in self.xrfmap}
 
-        thisrow = self.last_row + 1
-        xnpts, nmca, nchan = row.spectra.shape
-        mcas = []
-        map_items = sorted(self.xrfmap.keys())
-        for gname in map_items:
-            g = self.xrfmap[gname]
-            if g.attrs.get('type', None) == 'mca detector':
-                mcas.append(g)
-                nrows, npts, nchan =  g['data'].shape
+        if self.roi_slices is None:
+            lims = self.xrfmap['config/rois/limits'].value
+            nrois, nmca, nx = lims.shape
+            self.roi_slices = []
+            for iroi in range(nrois):
+                x = [slice(lims[iroi, i, 0],
+                           lims[iroi, i, 1]) for i in range(nmca)]
+                self.roi_slices.append(x)
+        return self.row_layout
 
-        if thisrow >= nrows:
-            self.resize_arrays(32*(1+nrows/32))
+    def compute_rowdata(self, row, layout):
+        """compute the data to be stored for a row, from a GSEXRM_MapRow
+        and the row layout from get_row_layout(), returning a list of
+        (dataset name, array) for the row.
+
+        This does not use the HDF5 file, and may be run in a thread
+        other than the one writing the file.
+        """
+        xnpts, nmca, nchan = row.spectra.shape
+        npts = layout['npts']
+        roimode = layout['roimode']
+        out = []
 
         total = None
-        for imca, grp in enumerate(mcas):
+        for imca, dname in enumerate(layout['mcas']):
             dtcorr = row.dtfactor[:, imca].astype('float32')
             cor   = dtcorr.reshape((dtcorr.shape[0], 1))
             dat   = row.spectra.swapaxes(1, 2)
-            grp['dtfactor'][thisrow, :]  = dtcorr
-            grp['realtime'][thisrow, :]  = row.realtime[:,imca]
-            grp['livetime'][thisrow, :]  = row.livetime[:,imca]
-            grp['inpcounts'][thisrow, :] = row.inpcounts[:, imca]
-            grp['outcounts'][thisrow, :] = row.outcounts[:, imca]
-            grp['data'][thisrow, :, :]   = dat[:, :, imca]
+            out.append(('%s/dtfactor' % dname,  dtcorr))
+            out.append(('%s/realtime' % dname,  row.realtime[:,imca]))
+            out.append(('%s/livetime' % dname,  row.livetime[:,imca]))
+            out.append(('%s/inpcounts' % dname, row.inpcounts[:, imca]))
+            out.append(('%s/outcounts' % dname, row.outcounts[:, imca]))
+            if roimode:
+                continue
+            out.append(('%s/data' % dname, dat[:, :, imca]))
+            if layout.get('ecumspec', False):
+                out.append(('%s/ecumspec' % dname,
+                            ecumulative(row.spectra[:, imca, :])))
+            spec = row.spectra[:, imca, :] * cor
+            if layout.get('stats', False):
+                out.extend([('stats/%s/%s' % (dname, name), val)
+                            for name, val in spectra_stats(spec)])
             if total is None:
-                total = row.spectra[:, imca, :] * cor
+                total = spec
             else:
-                total = total + row.spectra[:, imca, :] * cor
+                total = total + spec
 
-        # self.dt.add('add_rowdata for mcas')
         # here, we add the total dead-time-corrected data to detsum.
-        self.xrfmap['detsum']['data'][thisrow, :] = total.astype('int16')
-        # self.dt.add('add_rowdata for detsum')
+        if not roimode:
+            out.append(('detsum/data',
+                        total.astype(spectra_dtype(row.spectra.dtype))))
+            if layout.get('stats', False):
+                out.extend([('stats/detsum/%s' % name, val)
+                            for name, val in spectra_stats(total)])
+        if layout.get('xcumspec', False):
+            out.append(('detsum/xcumspec', xcumulative(total)))
 
         # now add roi map data
-        roimap = self.xrfmap['roimap']
-        pos    = roimap['pos']
-        pos[thisrow, :, :] = np.array(row.posvals).transpose()
-
-        det_raw = roimap['det_raw']
-        det_cor = roimap['det_cor']
-        sum_raw = roimap['sum_raw']
-        sum_cor = roimap['sum_cor']
+        out.append(('roimap/pos', np.array(row.posvals).transpose()))
 
-        detraw = list(row.sisdata[:npts].transpose())
+        # ROI sums for all ROIs and detectors, as (npts, nrois, nmca):
+        # ROI-mode rows hold the ROI sums, in the order of the ROIs.
+        nrois = len(self.roi_slices)
+        if roimode:
+            iraw = row.spectra[:, :, :nrois].swapaxes(1, 2)
+        else:
+            iraw = roi_sums(row.spectra, self.roi_slices)
+        icor = iraw * row.dtfactor[:, np.newaxis, :nmca]
+
+        sisdata = row.sisdata[:npts]
+        nsis = sisdata.shape[1]
+        detraw = np.zeros((npts, nsis + nrois*nmca))
+        sumraw = np.zeros((npts, nsis + nrois))
+        detcor, sumcor = detraw.copy(), sumraw.copy()
+        for dat, sums, rois in ((detraw, sumraw, iraw),
+                                (detcor, sumcor, icor)):
+            dat[:, :nsis]  = sums[:, :nsis] = sisdata
+            dat[:, nsis:]  = rois.reshape((npts, nrois*nmca))
+            sums[:, nsis:] = rois.sum(axis=2)
+
+        out.extend([('roimap/det_raw', detraw), ('roimap/det_cor', detcor),
+                    ('roimap/sum_raw', sumraw), ('roimap/sum_cor', sumcor)])
+        if layout.get('stats', False):
+            for mname, dat in zip(ROIMAP_STATS, (detraw, detcor,
+                                                 sumraw, sumcor)):
+                out.extend([('stats/roimap/%s/%s' % (mname, name), val)
+                            for name, val in roimap_stats(dat)])
+        return out
+
+    def add_rowdata(self, row, rowdata=None):
+        """adds a row worth of real data
+
+        rowdata is the data computed for the row by compute_rowdata(),
+        which is called if it is not given.  The row is copied to the
+        write-behind buffer, and written to the HDF5 file by flush_rows()
+        when it completes a batch of write_batch rows.
+        """
+        if not self.check_hostid():
+            raise GSEXRM_NotOwner(self.filename)
 
-        pform ="Add row=%4i, yval=%s, npts=%i, xmapfile=%s"
-        print pform % (thisrow+1, row.yvalue, npts, row.xmapfile)
+        thisrow = self.last_row + 1
+        layout = self.get_row_layout()
+        if rowdata is None:
+            rowdata = self.compute_rowdata(row, layout)
 
-        detcor = detraw[:]
-        sumraw = detraw[:]
-        sumcor = detraw[:]
+        # the arrays are sized for the expected number of rows:
+        # grow them only for maps with more rows than expected.
+        nrows = self.xrfmap['%s/dtfactor' % layout['mcas'][0]].shape[0]
+        if thisrow >= nrows:
+            self.resize_arrays(max(32*(1+nrows/32), self.nrows_expected or 0))
 
-        if self.roi_slices is None:
-            lims = self.xrfmap['config/rois/limits'].value
-            nrois, nmca, nx = lims.shape
-            self.roi_slices = []
-            for iroi in range(nrois):
-                x = [slice(lims[iroi, i, 0],
-                           lims[iroi, i, 1]) for i in range(nmca)]
-                self.roi_slices.append(x)
+        if self.rowbuff_count == 0:
+            self.rowbuff_start = thisrow
+        for name, data in rowdata:
+            self.buffer_row(name, data)
 
-        for slices in self.roi_slices:
-            iraw = [row.spectra[:, i, slices[i]].sum(axis=1)
-                    for i in range(nmca)]
-            icor = [row.spectra[:, i, slices[i]].sum(axis=1)*row.dtfactor[:, i]
-                    for i in range(nmca)]
-            detraw.extend(iraw)
-            detcor.extend(icor)
-            sumraw.append(np.array(iraw).sum(axis=0))
-            sumcor.append(np.array(icor).sum(axis=0))
-
-        det_raw[thisrow, :, :] = np.array(detraw).transpose()
-        det_cor[thisrow, :, :] = np.array(detcor).transpose()
-        sum_raw[thisrow, :, :] = np.array(sumraw).transpose()
-        sum_cor[thisrow, :, :] = np.array(sumcor).transpose()
+        pform ="Add row=%4i, yval=%s, npts=%i, xmapfile=%s"
+        print pform % (thisrow+1, row.yvalue, layout['npts'], row.xmapfile)
 
         self.last_row = thisrow
-        self.xrfmap.attrs['Last_Row'] = thisrow
+        self.rowbuff_count += 1
+        if (thisrow + 1) % self.write_batch == 0:
+            self.flush_rows()
+
+    def buffer_row(self, name, data):
+        """copy a row of data for the /xrfmap dataset name to the
+        write-behind buffer, at the position of the row being added"""
+        buff = self.rowbuff.get(name, None)
+        if buff is None:
+            dset = self.xrfmap[name]
+            buff = np.zeros((self.write_batch,) + dset.shape[1:],
+                            dtype=dset.dtype)
+            self.rowbuff[name] = buff
+        buff[self.rowbuff_count] = data
+
+    def flush_rows(self):
+        """write the rows held in the write-behind buffer to the HDF5
+        file, as one slab per dataset"""
+        nrows = self.rowbuff_count
+        if nrows < 1 or self.xrfmap is None:
+            return
+        if not self.check_hostid():
+            raise GSEXRM_NotOwner(self.filename)
+        r0 = self.rowbuff_start
+        totals = []
+        for name, buff in self.rowbuff.items():
+            self.xrfmap[name][r0:r0+nrows] = buff[:nrows]
+            if name.startswith('stats/'):
+                totals.append(self.update_map_stats(name, buff[:nrows]))
+        self.rowbuff_start = r0 + nrows
+        self.rowbuff_count = 0
+        self.rows_written = r0 + nrows
+        if self.h5root.swmr_mode:
+            # make the rows visible to readers before last_row
+            for name in list(self.rowbuff.keys()) + totals:
+                self.xrfmap[name].flush()
+        else:
+            self.xrfmap.attrs['Last_Row'] = r0 + nrows - 1
+        if 'last_row' in self.xrfmap:
+            self.xrfmap['last_row'][0] = r0 + nrows - 1
+            if self.h5root.swmr_mode:
+                self.xrfmap['last_row'].flush()
 
     def build_schema(self, row):
-        """build schema for detector and scan data"""
+        """build schema for detector and scan data
+
+        for rows of ROI-mode xmap data, only the ROI maps, times and
+        counts are stored: there are no 'data' spectra for the detectors
+        or detsum.
+        """
         if not self.check_hostid():
             raise GSEXRM_NotOwner(self.filename)
 
@@ -561,6 +1303,11 @@ class GSEXRM_MapFile(object):
             self.npts = row.npts
         npts = self.npts
         xnpts, nmca, nchan = row.spectra.shape
+        # spectra wider than int16 (as from Xspress3) are stored as read
+        sdtype = spectra_dtype(row.spectra.dtype)
+        roimode = getattr(row, 'roimode', False)
+        if roimode:
+            nchan = NCHAN_ROIMODE
         en_index = np.arange(nchan)
 
         xrfmap = self.xrfmap
@@ -573,6 +1320,14 @@ class GSEXRM_MapFile(object):
         roi_names = list(conf['rois/name'])
         roi_addrs = list(conf['rois/address'])
         roi_limits = conf['rois/limits'].value
+        # arrays are sized for the number of rows expected in Master.dat
+        nrows = max(NINIT, self.nrows_expected or 0)
+        # chunks hold whole batches of rows, so that each chunk
+        # is written (and compressed) once
+        def create_mapdata(group, name, shape, dtype):
+            group.create_dataset(name, shape, dtype,
+                                 **storage_options(self.storage, shape, dtype,
+                                                   nrows=self.write_batch))
         for imca in range(nmca):
             dname = 'det%i' % (imca+1)
             dgrp = xrfmap.create_group(dname)
@@ -586,14 +1341,15 @@ class GSEXRM_MapFile(object):
             self.add_data(dgrp, 'roi_addrs', [s % (imca+1) for s in roi_addrs])
             self.add_data(dgrp, 'roi_limits', roi_limits[:,imca,:])
 
-            dgrp.create_dataset('data', (NINIT, npts, nchan), np.int16,
-                                compression=COMP, maxshape=(None, npts, nchan))
+            if not roimode:
+                create_mapdata(dgrp, 'data', (nrows, npts, nchan), sdtype)
+                if self.energy_index:
+                    self.create_energy_index(dgrp, nrows, npts, nchan)
             for name, dtype in (('realtime', np.int),  ('livetime', np.int),
                                 ('dtfactor', np.float32),
                                 ('inpcounts', np.float32),
                                 ('outcounts', np.float32)):
-                dgrp.create_dataset(name, (NINIT, npts), dtype,
-                                    compression=COMP, maxshape=(None, npts))
+                create_mapdata(dgrp, name, (nrows, npts), dtype)
 
         # add 'virtual detector' for corrected sum:
         dgrp = xrfmap.create_group('detsum')
@@ -605,41 +1361,19 @@ class GSEXRM_MapFile(object):
         self.add_data(dgrp, 'roi_names', roi_names)
         self.add_data(dgrp, 'roi_addrs', [s % 1 for s in roi_addrs])
         self.add_data(dgrp, 'roi_limits', roi_limits[: ,0, :])
-        dgrp.create_dataset('data', (NINIT, npts, nchan), np.int16,
-                            compression=COMP, maxshape=(None, npts, nchan))
+        if not roimode:
+            create_mapdata(dgrp, 'data', (nrows, npts, nchan), sdtype)
+            if self.spectra_index:
+                self.create_spectra_index(nrows, npts, nchan)
 
         # roi map data
         scan = xrfmap['roimap']
-        det_addr = [i.strip() for i in row.sishead[-2][1:].split('|')]
-        det_desc = [i.strip() for i in row.sishead[-1][1:].split('|')]
-        for addr in roi_addrs:
-            det_addr.extend([addr % (i+1) for i in range(nmca)])
-
-        for desc in roi_names:
-            det_desc.extend(["%s (mca%i)" % (desc, i+1)
-                             for i in range(nmca)])
-
-        sums_map = {}
-        sums_desc = []
-        nsum = 0
-        for idet, addr in enumerate(det_desc):
-            if '(mca' in addr:
-                addr = addr.split('(mca')[0].strip()
-
-            if addr not in sums_map:
-                sums_map[addr] = []
-                sums_desc.append(addr)
-            sums_map[addr].append(idet)
-        nsum = max([len(s) for s in sums_map.values()])
-        sums_list = []
-        for sname in sums_desc:
-            slist = sums_map[sname]
-            if len(slist) < nsum:
-                slist.extend([-1]*(nsum-len(slist)))
-            sums_list.append(slist)
+        sis_addr = [i.strip() for i in row.sishead[-2][1:].split('|')]
+        sis_desc = [i.strip() for i in row.sishead[-1][1:].split('|')]
+        det_desc, det_addr, sums_desc, sums_list = roimap_names(
+            sis_desc, sis_addr, roi_names, roi_addrs, nmca)
 
         nsum = len(sums_list)
-        sums_list = np.array(sums_list)
         self.add_data(scan, 'det_name',    det_desc)
         self.add_data(scan, 'det_address', det_addr)
         self.add_data(scan, 'sum_name',    sums_desc)
@@ -658,8 +1392,355 @@ class GSEXRM_MapFile(object):
                                 ('sum_raw', nsum, np.int32),
                                 ('sum_cor', nsum, np.float32),
                                 ('pos',     npos, np.float32)):
-            scan.create_dataset(name, (NINIT, npts, nx), dtype,
-                                compression=COMP, maxshape=(None, npts, nx))
+            create_mapdata(scan, name, (nrows, npts, nx), dtype)
+
+        self.create_map_stats(nrows)
+
+    def create_map_stats(self, nrows):
+        """create the map statistics group, /xrfmap/stats (see the class
+        docstring), for nrows rows, with a group for each detector with
+        spectra and for each roi map array.  The datasets whose names
+        start with 'row_' hold a value for each row, and are filled by
+        compute_rowdata() as for other map data.  flush_rows() then
+        combines them with those of other rows, in the dataset given by
+        STATS_TOTALS."""
+        stats = self.xrfmap.create_group('stats')
+        groups = []
+        for gname in sorted(self.xrfmap.keys()):
+            group = self.xrfmap[gname]
+            if (group.attrs.get('type', '') in ('mca detector', 'virtual mca')
+                and 'data' in group):
+                nchan = group['data'].shape[2]
+                groups.append((stats.create_group(gname), nchan,
+                               ('row_spectrum', 'row_maxspectrum')))
+        for mname in ROIMAP_STATS:
+            nx = self.xrfmap['roimap'][mname].shape[2]
+            groups.append((stats.create_group('roimap/%s' % mname), nx,
+                           ('row_min', 'row_max', 'row_sum')))
+        for group, nx, names in groups:
+            self.create_stats_data(group, names, nrows, nx)
+
+    def create_stats_data(self, group, names, nrows, nx):
+        """create 'row_' statistics datasets names of shape (nrows, nx)
+        in group, and the datasets combining them, of size nx"""
+        for name in names:
+            shape = (nrows, nx)
+            group.create_dataset(name, shape, np.float64,
+                                 **storage_options(self.storage, shape,
+                                                   np.float64,
+                                                   nrows=self.write_batch))
+            tname, ufunc = STATS_TOTALS[name]
+            init = {np.minimum: np.inf, np.maximum: -np.inf}.get(ufunc, 0)
+            group.create_dataset(tname, data=init*np.ones(nx))
+
+    def update_map_stats(self, name, rows):
+        """combine the values of the 'row_' statistics dataset name for
+        some rows with those of the rows already written, returning the
+        name of the dataset updated"""
+        gname, rname = name.rsplit('/', 1)
+        tname, ufunc = STATS_TOTALS[rname]
+        total = self.xrfmap[gname][tname]
+        total[...] = ufunc(total[()], ufunc.reduce(rows, axis=0))
+        return '%s/%s' % (gname, tname)
+
+    def add_map_stats(self):
+        """add the map statistics (see create_map_stats) to a map file
+        without them, computing them for the rows already written.  They
+        are then updated as rows are added."""
+        if not self.check_hostid():
+            raise GSEXRM_NotOwner(self.filename)
+        if 'stats' in self.xrfmap:
+            return
+        self.flush_rows()
+        layout = self.get_row_layout()
+        nrows = self.xrfmap['%s/dtfactor' % layout['mcas'][0]].shape[0]
+        self.create_map_stats(nrows)
+        views = []
+        if not layout['roimode']:
+            views = self.get_spectra_views(dtcorrect=True)
+        for r0 in range(0, self.last_row+1, self.write_batch):
+            r1 = min(r0 + self.write_batch, self.last_row+1)
+            rowstats = []
+            total = None
+            for dname, view in zip(layout['mcas'], views):
+                spectra = view.read(r0, r1, 0, layout['npts'])
+                rowstats.extend([('%s/%s' % (dname, name), val)
+                                 for name, val in spectra_stats(spectra)])
+                if total is None:
+                    total = spectra
+                else:
+                    total = total + spectra
+            if total is not None:
+                rowstats.extend([('detsum/%s' % name, val)
+                                 for name, val in spectra_stats(total)])
+            for mname in ROIMAP_STATS:
+                dat = self.xrfmap['roimap'][mname][r0:r1]
+                rowstats.extend([('roimap/%s/%s' % (mname, name), val)
+                                 for name, val in roimap_stats(dat)])
+            for name, val in rowstats:
+                self.xrfmap['stats/%s' % name][r0:r1] = val
+                self.update_map_stats('stats/%s' % name, val)
+        self.row_layout = None
+        self.h5root.flush()
+
+    def create_spectra_index(self, nrows, npts, nchan):
+        """create the spectra index, 'xcumspec' in the detsum group: the
+        dead-time corrected spectra summed over all detectors, and
+        accumulated along each row, as float64, of shape
+        (nrows, npts+1, nchan), so that
+
+           xcumspec[i, p1, :] - xcumspec[i, p0, :]
+
+        is the summed spectrum of points p0 to p1-1 of row i, without
+        the loss of precision of float32 sums over long rows.  Chunks
+        hold one point of write_batch rows, so that summing a rectangle
+        of the map reads two chunks for each batch of rows.
+
+        This is 4 times the size of the int16 'data' of one detector
+        before compression, and the accumulated sums compress poorly.
+        A float32 index would take half the space, but would lose the
+        counts of short runs of points at the end of long rows, an index
+        of binned channels would lose energy resolution, and an int64
+        index could only hold spectra that are not corrected for
+        dead-time.
+        """
+        shape = (nrows, npts+1, nchan)
+        opts = storage_options(self.storage, shape, np.float64,
+                               nrows=self.write_batch)
+        opts['chunks'] = (self.write_batch, 1, nchan)
+        self.xrfmap['detsum'].create_dataset('xcumspec', shape, np.float64,
+                                             **opts)
+
+    def add_spectra_index(self):
+        """add the spectra index (see create_spectra_index) to a map file
+        without one, computing it for the rows already written.  The
+        index is then updated as rows are added."""
+        if not self.check_hostid():
+            raise GSEXRM_NotOwner(self.filename)
+        detsum = self.xrfmap['detsum']
+        if 'xcumspec' in detsum:
+            return
+        self.flush_rows()
+        layout = self.get_row_layout()
+        nrows, npts = self.xrfmap['%s/dtfactor' % layout['mcas'][0]].shape
+        views = self.get_spectra_views(dtcorrect=True)
+        self.create_spectra_index(nrows, npts, views[0].data.shape[2])
+        xcumspec = detsum['xcumspec']
+        for r0 in range(0, self.last_row+1, self.write_batch):
+            r1 = min(r0 + self.write_batch, self.last_row+1)
+            total = sum([view.read(r0, r1, 0, npts) for view in views])
+            xcumspec[r0:r1] = xcumulative(total)
+        self.row_layout = None
+        self.h5root.flush()
+
+    def create_energy_index(self, group, nrows, npts, nchan):
+        """create the energy index, 'ecumspec' in an mca detector group:
+        the spectra of the detector accumulated along energy, as int32
+        (int64 for spectra wider than int16), of shape (nrows, npts,
+        nchan+1), so that
+
+           ecumspec[:, :, c1] - ecumspec[:, :, c0]
+
+        is the map of the counts in channels c0 to c1-1.  Chunks hold
+        ECUM_CHANS channels of write_batch rows, so that such a map reads
+        two chunks for each batch of rows.
+        """
+        shape = (nrows, npts, nchan+1)
+        dtype = np.int32 if group['data'].dtype.itemsize <= 2 else np.int64
+        opts = storage_options(self.storage, shape, dtype,
+                               nrows=self.write_batch)
+        opts['chunks'] = (self.write_batch, npts, min(ECUM_CHANS, nchan+1))
+        group.create_dataset('ecumspec', shape, dtype, **opts)
+
+    def add_energy_index(self):
+        """add the energy index (see create_energy_index) to a map file
+        without one, computing it from the spectra of the rows already
+        written.  The index is then updated as rows are added."""
+        if not self.check_hostid():
+            raise GSEXRM_NotOwner(self.filename)
+        layout = self.get_row_layout()
+        if layout['roimode'] or layout['ecumspec']:
+            return
+        self.flush_rows()
+        for dname in layout['mcas']:
+            group = self.xrfmap[dname]
+            data = group['data']
+            nrows, npts, nchan = data.shape
+            self.create_energy_index(group, nrows, npts, nchan)
+            ecumspec = group['ecumspec']
+            for r0 in range(0, self.last_row+1, self.write_batch):
+                r1 = min(r0 + self.write_batch, self.last_row+1)
+                ecumspec[r0:r1] = ecumulative(data[r0:r1])
+        self.row_layout = None
+        self.h5root.flush()
+
+    def redefine_rois(self, rois):
+        """replace the ROIs of the map, recomputing the ROI maps (the
+        det_raw, det_cor, sum_raw and sum_cor arrays of /xrfmap/roimap)
+        from the stored spectra and dead-time factors, without reading
+        the raw data folder.
+
+        rois is a list of (name, limits), with limits either one
+        (lo, hi) range of channels for all detectors, or a list of one
+        (lo, hi) for each detector, as from the ROI file, and with
+        channels lo to hi-1 summed for the ROI.
+
+        The spectra are read and summed in blocks of rows, using the
+        energy index if the map has one (see create_energy_index).
+        The new ROI maps, their statistics (see create_map_stats) and the
+        ROI definitions, of /xrfmap/config and of each detector group, are
+        all written under new names first, and replace the current ones
+        only when complete.  As for any dataset removed from an HDF5 file,
+        the space of the old ROI maps is not reused: use repack_mapfile()
+        to reclaim it.
+        """
+        if not self.check_hostid():
+            raise GSEXRM_NotOwner(self.filename)
+        if self.h5root.swmr_mode:
+            raise GSEXRM_Exception("cannot change ROIs in SWMR mode")
+        layout = self.get_row_layout()
+        if layout['roimode']:
+            raise GSEXRM_Exception("'%s' has no spectra" % self.filename)
+        self.flush_rows()
+
+        mcas = layout['mcas']
+        nmca = len(mcas)
+        roi_names, roi_lims = [], []
+        for name, lims in rois:
+            lims = np.array(lims, dtype=int)
+            if lims.shape == (2,):
+                lims = np.array([lims]*nmca)
+            if lims.shape != (nmca, 2):
+                raise GSEXRM_Exception("invalid limits for ROI '%s'" % name)
+            roi_names.append(name)
+            roi_lims.append(lims)
+        roi_lims = np.array(roi_lims)
+        nrois = len(roi_names)
+        roi_slices = [[slice(lo, hi) for lo, hi in lims] for lims in roi_lims]
+        xmap = self.xrfmap['config/general/xmap'][()]
+        roi_addrs = ["%smca%%i.R%i" % (xmap, iroi) for iroi in range(nrois)]
+
+        # the scaler columns are kept from the current ROI maps
+        scan = self.xrfmap['roimap']
+        det_name = list(scan['det_name'][()])
+        nsis = len(det_name) - nmca*len(self.xrfmap['config/rois/name'])
+        det_desc, det_addr, sums_desc, sums_list = roimap_names(
+            det_name[:nsis], list(scan['det_address'][()])[:nsis],
+            roi_names, roi_addrs, nmca)
+
+        # remove what is left of an incomplete change of ROIs
+        groups = [self.xrfmap[dname] for dname in mcas]
+        roi_dsets = ('roi_names', 'roi_addrs', 'roi_limits')
+        stale = ['roimap.new', 'config/rois.new', 'stats/roimap.new']
+        for dname in mcas + ['detsum']:
+            stale.extend(['%s/%s.new' % (dname, name) for name in roi_dsets])
+        for gname in stale:
+            if gname in self.xrfmap:
+                del self.xrfmap[gname]
+        newscan = self.xrfmap.create_group('roimap.new')
+        for key, val in scan.attrs.items():
+            newscan.attrs[key] = val
+        for name in ('pos', 'pos_name', 'pos_address'):
+            # links to the unchanged datasets, not copies
+            newscan[name] = scan[name]
+        self.add_data(newscan, 'det_name',    det_desc)
+        self.add_data(newscan, 'det_address', det_addr)
+        self.add_data(newscan, 'sum_name',    sums_desc)
+        self.add_data(newscan, 'sum_list',    sums_list)
+        nrows, npts = scan['pos'].shape[:2]
+        for name, nx in (('det_raw', len(det_desc)),
+                         ('det_cor', len(det_desc)),
+                         ('sum_raw', len(sums_desc)),
+                         ('sum_cor', len(sums_desc))):
+            dtype = scan[name].dtype
+            newscan.create_dataset(name, (nrows, npts, nx), dtype,
+                                   **storage_options(self.storage,
+                                                     (nrows, npts, nx), dtype,
+                                                     nrows=self.write_batch))
+
+        bounds = np.clip(roi_lims, 0, groups[0]['data'].shape[2])
+        def roi_block(r0, r1):
+            "ROI sums for a block of rows, as (nrows, npts, nrois, nmca)"
+            iraw = np.zeros((r1-r0, npts, nrois, nmca), dtype=np.int64)
+            dtfactor = np.zeros((r1-r0, npts, 1, nmca), dtype=np.float32)
+            for imca, group in enumerate(groups):
+                dtfactor[:, :, 0, imca] = group['dtfactor'][r0:r1]
+                if 'ecumspec' in group:
+                    chans = sorted(set(bounds[:, imca, :].ravel()))
+                    cum = group['ecumspec'][r0:r1, :, chans]
+                    ilo = [chans.index(c) for c in bounds[:, imca, 0]]
+                    ihi = [chans.index(c) for c in bounds[:, imca, 1]]
+                    iraw[..., imca] = cum[:, :, ihi] - cum[:, :, ilo]
+                else:
+                    spectra = group['data'][r0:r1]
+                    spectra = spectra.reshape((-1, 1, spectra.shape[2]))
+                    slices = [[sl[imca]] for sl in roi_slices]
+                    iraw[..., imca] = roi_sums(spectra, slices).reshape(
+                        (r1-r0, npts, nrois))
+            return iraw, iraw * dtfactor
+
+        newstats = None
+        if 'stats' in self.xrfmap:
+            newstats = self.xrfmap['stats'].create_group('roimap.new')
+            for name in ROIMAP_STATS:
+                self.create_stats_data(newstats.create_group(name),
+                                       ('row_min', 'row_max', 'row_sum'),
+                                       nrows, newscan[name].shape[2])
+
+        for r0 in range(0, self.last_row+1, self.write_batch):
+            r1 = min(r0 + self.write_batch, self.last_row+1)
+            iraw, icor = roi_block(r0, r1)
+            for name, rois in (('det_raw', iraw.reshape((r1-r0, npts, -1))),
+                               ('det_cor', icor.reshape((r1-r0, npts, -1))),
+                               ('sum_raw', iraw.sum(axis=3)),
+                               ('sum_cor', icor.sum(axis=3))):
+                dset = newscan[name]
+                out = np.zeros((r1-r0,) + dset.shape[1:], dset.dtype)
+                out[:, :, :nsis] = scan[name][r0:r1, :, :nsis]
+                out[:, :, nsis:] = rois
+                dset[r0:r1] = out
+                if newstats is not None:
+                    for sname, val in roimap_stats(out):
+                        newstats[name][sname][r0:r1] = val
+                        self.update_map_stats('stats/roimap.new/%s/%s' %
+                                              (name, sname), val)
+
+        newrois = self.xrfmap['config'].create_group('rois.new')
+        self.add_data(newrois, 'name',    roi_names)
+        self.add_data(newrois, 'address', roi_addrs)
+        self.add_data(newrois, 'limits',  roi_lims)
+        # the ROI definitions of each detector: detsum has those of det1
+        for imca, group in enumerate(groups + [self.xrfmap['detsum']]):
+            imca = imca % nmca
+            addrs = [a % (imca+1) for a in roi_addrs]
+            for name, data in (('roi_names', roi_names),
+                               ('roi_addrs', addrs),
+                               ('roi_limits', roi_lims[:, imca, :])):
+                self.add_data(group, '%s.new' % name, data)
+        self.h5root.flush()
+
+        # with everything written, replace the ROI definitions and maps
+        for group in groups + [self.xrfmap['detsum']]:
+            for name in roi_dsets:
+                del group[name]
+                group.move('%s.new' % name, name)
+        del self.xrfmap['config/rois']
+        self.xrfmap['config'].move('rois.new', 'rois')
+        del self.xrfmap['roimap']
+        self.xrfmap.move('roimap.new', 'roimap')
+        if newstats is not None:
+            del self.xrfmap['stats/roimap']
+            self.xrfmap['stats'].move('roimap.new', 'roimap')
+        self.h5root.flush()
+
+        self.roi_slices = None
+        self.rowbuff = {}
+        for path in list(self.cache.keys()):
+            if path.startswith('roimap/') or path.startswith('config/rois'):
+                self.cache.pop(path)
+        self.roimap_index = {}
+        if self.map_cache is not None:
+            self.map_cache.clear()
 
     def resize_arrays(self, nrow):
         "resize all arrays for new nrow size"
@@ -673,24 +1754,36 @@ class GSEXRM_MapFile(object):
                 realmca_groups.append(g)
             elif g.attrs.get('type', '').startswith('virtual mca'):
                 virtmca_groups.append(g)
-        oldnrow, npts, nchan = realmca_groups[0]['data'].shape
+        oldnrow, npts = realmca_groups[0]['dtfactor'].shape
+        # buffered rows are written before arrays are trimmed
+        if nrow <= oldnrow:
+            self.flush_rows()
+        for g in realmca_groups + virtmca_groups:
+            for aname in ('data', 'xcumspec', 'ecumspec'):
+                if aname in g:
+                    g[aname].resize((nrow,) + g[aname].shape[1:])
         for g in realmca_groups:
-            g['data'].resize((nrow, npts, nchan))
             for aname in ('livetime', 'realtime',
                           'inpcounts', 'outcounts', 'dtfactor'):
                 g[aname].resize((nrow, npts))
 
-        for g in virtmca_groups:
-            g['data'].resize((nrow, npts, nchan))
-
         for bname in ('pos', 'det_raw', 'det_cor', 'sum_raw', 'sum_cor'):
             g = self.xrfmap['roimap'][bname]
             old, npts, nx = g.shape
             g.resize((nrow, npts, nx))
 
+        if 'stats' in self.xrfmap:
+            stats = self.xrfmap['stats']
+            groups = [stats[gname] for gname in stats if gname != 'roimap']
+            groups.extend(stats['roimap'].values())
+            for g in groups:
+                for aname in g:
+                    if aname in STATS_TOTALS:
+                        g[aname].resize((nrow, g[aname].shape[1]))
+
     def claim_hostid(self):
         "claim ownershipf of file"
-        if self.xrfmap is None:
+        if self.xrfmap is None or self.readonly:
             return
         self.xrfmap.attrs['Process_Machine'] = socket.gethostname()
         self.xrfmap.attrs['Process_ID'] = os.getpid()
@@ -700,8 +1793,8 @@ class GSEXRM_MapFile(object):
         """checks host and id of file:
         returns True if this process the owner of the file
         """
-        if self.xrfmap is None:
-            return
+        if self.xrfmap is None or self.readonly:
+            return False
         attrs = self.xrfmap.attrs
         self.folder = attrs['Map_Folder']
 
@@ -714,34 +1807,52 @@ class GSEXRM_MapFile(object):
                 file_pid == os.getpid())
 
     def folder_has_newdata(self):
+        """return whether the map folder has a new, complete row of data"""
         if self.folder is not None and isGSEXRM_MapFolder(self.folder):
             self.read_master()
-            return (self.last_row < len(self.rowdata)-1)
+            if self.last_row < len(self.rowdata)-1:
+                xmapfile = self.rowdata[self.last_row+1][1]
+                return xrf_file_complete(os.path.join(self.folder, xmapfile))
         return False
 
     def read_master(self):
-        "reads master file for toplevel scan info"
+        """reads master file for toplevel scan info
+
+        Master.dat is read with a MasterFileTail, so that only new rows
+        are parsed, and Scan.ini is only read again if it changes."""
         if self.folder is None or not isGSEXRM_MapFolder(self.folder):
             return
         self.masterfile = os.path.join(nativepath(self.folder),
                                        self.MasterFile)
+        if self.master is None or self.master.fname != self.masterfile:
+            self.master = MasterFileTail(self.masterfile)
         try:
-            header, rows = readMasterFile(self.masterfile)
-        except IOError:
+            header, rows = self.master.read()
+        except (IOError, OSError):
             raise GSEXRM_Exception(
                 "cannot read Master file from '%s'" % self.masterfile)
 
         self.master_header = header
         self.rowdata = rows
+        for line in header:
+            if line.startswith('#SCAN.nrows_expected'):
+                try:
+                    self.nrows_expected = int(line.split('=')[1])
+                except (IndexError, ValueError):
+                    pass
         stime = self.master_header[0][6:]
         self.start_time = stime.replace('started at','').strip()
 
-        self.folder_modtime = os.stat(self.masterfile).st_mtime
+        self.folder_modtime = self.master.mtime
         self.stop_time = time.ctime(self.folder_modtime)
 
-        cfile = FastMapConfig()
-        cfile.Read(os.path.join(self.folder, self.ScanFile))
-        self.mapconf = cfile.config
+        scanfile = os.path.join(self.folder, self.ScanFile)
+        scan_mtime = os.stat(scanfile).st_mtime
+        if self.mapconf is None or scan_mtime != self.scan_mtime:
+            cfile = FastMapConfig()
+            cfile.Read(scanfile)
+            self.mapconf = cfile.config
+            self.scan_mtime = scan_mtime
 
         if self.filename is None:
             self.filename = self.mapconf['scan']['filename']
@@ -773,36 +1884,116 @@ class GSEXRM_MapFile(object):
             self.pos_desc.append(slow_pos[yaddr])
 
 
+    def get_cached(self, path):
+        """return the value of a /xrfmap dataset that does not change
+        as rows are added, such as ROI names, reading it only once"""
+        if path not in self.cache:
+            self.cache[path] = self.xrfmap[path][()]
+        return self.cache[path]
+
     def get_energy(self, det=None):
         """return energy array for a detector"""
-        if not self.check_hostid():
+        if not (self.readonly or self.check_hostid()):
             raise GSEXRM_NotOwner(self.filename)
 
         dgroup= 'detsum'
         if det in (1, 2, 3, 4):
             dgroup = 'det%i' % det
 
-        return self.xrfmap["%s/energy" % dgroup].value
+        return self.get_cached("%s/energy" % dgroup).copy()
+
+    def get_spectra_views(self, det=None, dtcorrect=True):
+        """return list of GSEXRM_SpectraViews for a detector, or for
+        all detectors for det=None, sharing the spectra cache"""
+        layout = self.get_row_layout()
+        if layout['roimode']:
+            raise GSEXRM_Exception("'%s' has no spectra" % self.filename)
+        dnames = layout['mcas']
+        if det is not None:
+            dnames = ['det%i' % det]
+        return [GSEXRM_SpectraView(self.xrfmap[dname], dtcorrect=dtcorrect,
+                                   cache=self.spectra_cache)
+                for dname in dnames]
 
     def get_spectra(self, det=None, dtcorrect=True,
                     xmin=None, xmax=None, ymin=None, ymax=None):
         """return XRF spectra, summed over a given rectangle.
         xmin/xmax/ymin/ymax given in pixel units of the map
+
+        For det=None, this is the sum of the spectra of all detectors.
+        With dtcorrect=True, the spectra of each pixel are corrected for
+        dead-time as they are read (see GSEXRM_SpectraView).
         """
+        # arrays may be allocated beyond the last row written
+        nrows = self.rows_written
         xslice = slice(xmin, xmax)
         yslice = slice(ymin, ymax)
-        dgroup= 'detsum'
-        if det in (1, 2, 3, 4):
-            dgroup = 'det%i' % det
+        detsum = self.xrfmap['detsum']
+        if det is None and dtcorrect and 'xcumspec' in detsum:
+            # from the spectra index: the sum over each row of the
+            # accumulated spectra at the end minus at the start
+            xcumspec = detsum['xcumspec']
+            r0, r1, step = xslice.indices(nrows)
+            p0, p1, step = yslice.indices(xcumspec.shape[1]-1)
+            if r1 <= r0 or p1 <= p0:
+                return np.zeros(xcumspec.shape[2])
+            total = xcumspec[r0:r1, p1, :].sum(axis=0, dtype=np.float64)
+            return total - xcumspec[r0:r1, p0, :].sum(axis=0, dtype=np.float64)
 
-        spectra = self.xrfmap["%s/data" % dgroup]
-        return spectra[xslice, yslice, :].sum(axis=0).sum(axis=0)
+        total = None
+        for view in self.get_spectra_views(det=det, dtcorrect=dtcorrect):
+            spec = view.sum_region(xslice, yslice, nrows)
+            if total is None:
+                total = spec
+            else:
+                total += spec
+        return total
 
 
     def get_spectra_by_points(self, points, det=None, dtcorrect=True):
         """return XRF spectra, summed over a set of ix, iy points
+
+        points is a sequence of (ix, iy) pixels, with ix the row and iy
+        the point in the row, as for get_spectra(), or a boolean mask
+        of shape (nrows, npts).  Only the blocks of spectra holding the
+        selected pixels are read (see GSEXRM_SpectraView.sum_mask), or,
+        for the sum of detectors with dtcorrect=True and a spectra index,
+        the index at the ends of the runs of selected points of each row.
         """
-        pass
+        nrows = self.rows_written
+        npts = self.get_row_layout()['npts']
+        points = np.asarray(points)
+        if points.dtype == bool:
+            mask = points[:nrows, :npts]
+        else:
+            mask = np.zeros((nrows, npts), dtype=bool)
+            if points.size > 0:
+                points = points.reshape((-1, 2))
+                mask[points[:, 0], points[:, 1]] = True
+
+        detsum = self.xrfmap['detsum']
+        if det is None and dtcorrect and 'xcumspec' in detsum:
+            xcumspec = detsum['xcumspec']
+            total = np.zeros(xcumspec.shape[2])
+            # runs of selected points start and end at changes in mask
+            edges = np.diff(np.concatenate((np.zeros((len(mask), 1), bool),
+                                            mask,
+                                            np.zeros((len(mask), 1), bool)),
+                                           axis=1).astype('i1'), axis=1)
+            for irow in np.where(mask.any(axis=1))[0]:
+                ipts = list(np.where(edges[irow] != 0)[0])
+                cum = xcumspec[irow, ipts, :]
+                total += cum[1::2].sum(axis=0) - cum[0::2].sum(axis=0)
+            return total
+
+        total = None
+        for view in self.get_spectra_views(det=det, dtcorrect=dtcorrect):
+            spec = view.sum_mask(mask)
+            if total is None:
+                total = spec
+            else:
+                total += spec
+        return total
 
     def get_map_erange(self, det=None, dtcorrect=True,
                        emin=None, emax=None, by_energy=True):
@@ -810,10 +2001,43 @@ class GSEXRM_MapFile(object):
 
         if by_energy is True, emin/emax are taken to be in keV (Energy units)
         otherwise, they are taken to be integer energy channel numbers
+
+        the map is of the counts in the channels from emin to emax,
+        inclusive, for a detector or, for det=None, summed over all
+        detectors.  With an energy index (see create_energy_index), this
+        reads only the index at the channels at the ends of the range,
+        otherwise the spectra are read one block of rows at a time.
         """
-        if not self.check_hostid():
+        if not (self.readonly or self.check_hostid()):
             raise GSEXRM_NotOwner(self.filename)
 
+        nrows = self.rows_written
+        views = self.get_spectra_views(det=det, dtcorrect=dtcorrect)
+        nchan = views[0].data.shape[2]
+        c0, c1 = 0, nchan
+        if by_energy:
+            energy = self.get_energy(det=det)
+            if emin is not None:
+                c0 = np.searchsorted(energy, emin, side='left')
+            if emax is not None:
+                c1 = np.searchsorted(energy, emax, side='right')
+        else:
+            if emin is not None:
+                c0 = int(emin)
+            if emax is not None:
+                c1 = int(emax) + 1
+        c0, c1 = max(0, min(c0, nchan)), max(0, min(c1, nchan))
+        c1 = max(c0, c1)
+
+        out = None
+        for view in views:
+            dmap = view.sum_channels(c0, c1, nrows)
+            if out is None:
+                out = dmap
+            else:
+                out += dmap
+        return out
+
     def get_pos(self, name, mean=True):
         """return  position by name (matching 'roimap/pos_name' if
         name is a string, or using name as an index if it is an integer
@@ -824,52 +2048,131 @@ class GSEXRM_MapFile(object):
         with mean=False, and a positioner in the first two position,
         returns a 2-d array of x values for each pixel
         """
-        if not self.check_hostid():
+        if not (self.readonly or self.check_hostid()):
             raise GSEXRM_NotOwner(self.filename)
         index = -1
         if isinstance(name, int):
             index = name
         else: 
-            for ix, nam in enumerae( self.xrfmap['roimap/pos_name']):
-                if nam.lower() == nam.lower():
+            for ix, nam in enumerate(self.get_cached('roimap/pos_name')):
+                if nam.lower() == name.lower():
                     index = ix
                     break
                 
         if index == -1:
             raise GSEXRM_Exception("Could not find position '%s'" % repr(name))
-        pos = self.xrfmap['roimap/pos'][:, :, index]
+        pos = self.xrfmap['roimap/pos'][:self.rows_written, :, index]
         if index in (0, 1) and mean:
             pos = pos.sum(axis=index)/pos.shape[index]
         return pos
 
-    def get_roimap(self, name, det=None, dtcorrect=True):
-        """extract roi map for a pre-defined roi by name
-        """
-        if not self.check_hostid():
-            raise GSEXRM_NotOwner(self.filename)
-
-        imap = -1
+    def get_roimap_index(self, name, det=None, dtcorrect=True):
+        """return (dataset name, index) of the roi map for a pre-defined
+        roi by name, as used by get_roimap()"""
         if det in (1, 2, 3, 4):
             mcaname = '(mca%i)' % det
-            names = list(self.xrfmap['roimap/det_name'])
             dat = 'roimap/det_raw'
             if dtcorrect:
                 dat = 'roimap/det_cor'
         else:
             mcaname = ''
-            names = list(self.xrfmap['roimap/sum_name'])
             dat = 'roimap/sum_raw'
             if dtcorrect:
                 dat = 'roimap/sum_cor'
 
-        for i, roiname in enumerate(names):
-            if roiname.startswith(name) and roiname.endswith(mcaname):
-                imap = i
-                break
-        if imap == -1:
-            raise GSEXRM_Exception("Could not find ROI '%s'" % name)
+        key = (name, mcaname)
+        if key not in self.roimap_index:
+            if mcaname == '':
+                names = self.get_cached('roimap/sum_name')
+            else:
+                names = self.get_cached('roimap/det_name')
+            imap = -1
+            for i, roiname in enumerate(names):
+                if roiname.startswith(name) and roiname.endswith(mcaname):
+                    imap = i
+                    break
+            if imap == -1:
+                raise GSEXRM_Exception("Could not find ROI '%s'" % name)
+            self.roimap_index[key] = imap
+        return dat, self.roimap_index[key]
+
+    def get_roimap(self, name, det=None, dtcorrect=True):
+        """extract roi map for a pre-defined roi by name
+        """
+        return self.get_roimaps([name], det=det, dtcorrect=dtcorrect)[0]
+
+    def get_roimaps(self, names, det=None, dtcorrect=True):
+        """extract roi maps for a list of pre-defined rois by name,
+        returning a list of maps, as from get_roimap().
+
+        The maps that are not in the map cache are read in one pass over
+        the roi map dataset.  Maps are cached until rows are written, and
+        the maps returned are copies, which may be changed.
+        """
+        if not (self.readonly or self.check_hostid()):
+            raise GSEXRM_NotOwner(self.filename)
+
+        nrows = self.rows_written
+        dat = None
+        index = []
+        for name in names:
+            dat, imap = self.get_roimap_index(name, det=det,
+                                              dtcorrect=dtcorrect)
+            index.append(imap)
+
+        maps = {}
+        for imap in index:
+            key = (self.filename, dat, imap, nrows)
+            if self.map_cache is not None and imap not in maps:
+                rmap = self.map_cache.get(key)
+                if rmap is not None:
+                    maps[imap] = rmap
+
+        toread = sorted(set(index) - set(maps.keys()))
+        if len(toread) > 0:
+            data = self.xrfmap[dat][:nrows, :, toread]
+            for i, imap in enumerate(toread):
+                rmap = np.ascontiguousarray(data[:, :, i])
+                maps[imap] = rmap
+                if self.map_cache is not None:
+                    key = (self.filename, dat, imap, nrows)
+                    self.map_cache[key] = rmap
+        return [maps[imap].copy() for imap in index]
+
+    def get_roimap_stats(self, name, det=None, dtcorrect=True):
+        """return (min, max, sum) of the roi map for a pre-defined roi by
+        name, as from get_roimap(), from the map statistics, or from the
+        map for a file without them"""
+        if not (self.readonly or self.check_hostid()):
+            raise GSEXRM_NotOwner(self.filename)
+
+        dat, imap = self.get_roimap_index(name, det=det, dtcorrect=dtcorrect)
+        sname = 'stats/%s' % dat
+        if sname not in self.xrfmap:
+            rmap = self.get_roimap(name, det=det, dtcorrect=dtcorrect)
+            return rmap.min(), rmap.max(), rmap.sum(dtype=np.float64)
+        stats = self.xrfmap[sname]
+        return tuple([stats[key][imap] for key in ('min', 'max', 'sum')])
+
+    def get_map_stats(self, det=None):
+        """return the statistics of the dead-time corrected spectra of
+        a detector, or of the sum of detectors for det=None, as a
+        dictionary of 'sum_spectrum' (summed over the map),
+        'max_spectrum' (largest counts in each channel of any pixel)
+        and 'row_spectra' (summed over each row written)"""
+        if not (self.readonly or self.check_hostid()):
+            raise GSEXRM_NotOwner(self.filename)
 
-        return self.xrfmap[dat][:, :, imap]
+        dgroup = 'stats/detsum'
+        if det in (1, 2, 3, 4):
+            dgroup = 'stats/det%i' % det
+        if dgroup not in self.xrfmap:
+            raise GSEXRM_Exception("'%s' has no map statistics" %
+                                   self.filename)
+        stats = self.xrfmap[dgroup]
+        return {'sum_spectrum': stats['sum_spectrum'][()],
+                'max_spectrum': stats['max_spectrum'][()],
+                'row_spectra': stats['row_spectrum'][:self.rows_written]}
 
     def get_rgbmap(self, rroi, groi, broi, det=None,
                    dtcorrect=True, scale_each=True, scales=None):
@@ -890,12 +2193,11 @@ class GSEXRM_MapFile(object):
         (1/max intensity of all maps)
 
         """
-        if not self.check_hostid():
+        if not (self.readonly or self.check_hostid()):
             raise GSEXRM_NotOwner(self.filename)
 
-        rmap = self.get_roimap(rroi, det=det, dtcorrect=dtcorrect)
-        gmap = self.get_roimap(groi, det=det, dtcorrect=dtcorrect)
-        bmap = self.get_roimap(broi, det=det, dtcorrect=dtcorrect)
+        rmap, gmap, bmap = self.get_roimaps((rroi, groi, broi), det=det,
+                                            dtcorrect=dtcorrect)
 
         if scales is None or len(scales) != 3:
             scales = (1./rmap.max(), 1./gmap.max(), 1./bmap.max())
@@ -911,3 +2213,103 @@ class GSEXRM_MapFile(object):
 
         return np.array([rmap, gmap, bmap]).swapaxes(0, 2).swapaxes(0, 1)
 
+
+class GSEXRM_MapReader(object):
+    """read-only access to the rows of a GSEXRM Map File as they are
+    written, without claiming the file:
+
+    >>> reader = GSEXRM_MapReader('MyMap.h5')
+    >>> first, rows = reader.read_newrows(('roimap/sum_cor', 'roimap/pos'))
+    >>> sum_cor = rows.get('roimap/sum_cor')   # (nrows, npts, nsum) or None
+
+    Files written with GSEXRM_MapFile(..., swmr=True) are opened in SWMR
+    mode, and each read_newrows() returns only the rows written since the
+    previous call.  Other files are read as they were when opened.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            self.h5root = h5py.File(filename, 'r', libver='latest', swmr=True)
+        except IOError:
+            self.h5root = h5py.File(filename, 'r')
+        self.xrfmap = self.h5root['/xrfmap']
+        self.last_row = -1
+
+    def get_last_row(self):
+        "return the last row written to the file"
+        if 'last_row' in self.xrfmap:
+            dset = self.xrfmap['last_row']
+            if self.h5root.swmr_mode:
+                dset.refresh()
+            return int(dset[0])
+        return int(self.xrfmap.attrs['Last_Row'])
+
+    def read_newrows(self, names):
+        """read the rows written since the previous call for the
+        /xrfmap datasets names, returning (first_row, rows) where rows
+        is a dictionary of arrays by name, empty if no rows are new"""
+        first = self.last_row + 1
+        last = self.get_last_row()
+        rows = {}
+        if last < first:
+            return first, rows
+        for name in names:
+            dset = self.xrfmap[name]
+            if self.h5root.swmr_mode:
+                dset.refresh()
+            rows[name] = dset[first:last+1]
+        self.last_row = last
+        return first, rows
+
+    def close(self):
+        self.h5root.close()
+        self.h5root = None
+
+def repack_mapfile(filename, outfile, storage='archive', level=REPACK_LEVEL):
+    """copy a GSEXRM Map File to outfile, with the map datasets (those
+    that grow by row) stored with the given storage profile, and all
+    other datasets and attributes copied unchanged.
+
+    For profiles using gzip, level (if not None) replaces the gzip
+    level of the profile.  The default, REPACK_LEVEL, makes files
+    slightly smaller than the profile's own level, but takes much
+    longer to write: use level=None for a quick repack."""
+    if not isinstance(storage, dict):
+        if storage not in STORAGE_PROFILES:
+            raise GSEXRM_Exception("unknown storage profile '%s'" % storage)
+        storage = STORAGE_PROFILES[storage]
+    storage = dict(storage)
+    if level is not None and storage.get('compression', None) == 'gzip':
+        storage['compression_opts'] = level
+    src = h5py.File(filename, 'r')
+    out = h5py.File(outfile, 'w')
+
+    def copy_attrs(src, dest):
+        for key, val in src.attrs.items():
+            dest.attrs[key] = val
+
+    def copy_group(sgrp, dgrp):
+        copy_attrs(sgrp, dgrp)
+        for name, item in sgrp.items():
+            if isinstance(item, h5py.Group):
+                copy_group(item, dgrp.create_group(name))
+            elif (item.maxshape and item.maxshape[0] is None and
+                  len(item.shape) > 1):
+                opts = storage_options(storage, item.shape, item.dtype)
+                if name in ('xcumspec', 'ecumspec'):
+                    # the indices are chunked for reading a few planes
+                    opts['chunks'] = opts['chunks'][:1] + item.chunks[1:]
+                dset = dgrp.create_dataset(name, item.shape, item.dtype,
+                                           **opts)
+                copy_attrs(item, dset)
+                step = opts['chunks'][0]
+                for irow in range(0, item.shape[0], step):
+                    dset[irow:irow+step] = item[irow:irow+step]
+            else:
+                sgrp.copy(item, dgrp, name=name)
+
+    try:
+        copy_group(src, out)
+    finally:
+        src.close()
+        out.close()
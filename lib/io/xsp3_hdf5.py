@@ -0,0 +1,142 @@
+#!/usr/bin/python
+"""
+read Xspress3 HDF5 files, as written by the areaDetector HDF5 plugin
+"""
+import os
+import time
+import numpy as np
+import h5py
+
+# locations of spectra and per-channel NDAttributes in the HDF5 file
+XSP3_DATA  = 'entry/instrument/detector/data'
+XSP3_ATTRS = 'entry/instrument/NDAttributes'
+
+# scaler (SCA) attributes for each channel:
+#   SCA0: clock ticks,  SCA3: all events,  SCA4: all good events
+# and the dead-time correction factor computed by the detector
+XSP3_CLOCK  = 'CHAN%iSCA0'
+XSP3_INPUT  = 'CHAN%iSCA3'
+XSP3_OUTPUT = 'CHAN%iSCA4'
+XSP3_DTFACT = 'CHAN%iDTFACTOR'
+
+# xspress3 clock: 80 MHz, or 80 ticks per microsecond
+XSP3_CLOCKRATE = 80.0
+
+def is_xsp3_file(fname):
+    "return whether a raw data file name is for an Xspress3 HDF5 file"
+    return os.path.basename(fname).lower().startswith('xsp3')
+
+class Xspress3Data(object):
+    """Xspress3 data: spectra, real and live times (microseconds),
+    input and output counts, and dead-time correction factors for
+    each pixel and detector element.
+
+    As for xMAPData, an existing Xspress3Data can be passed as 'out'
+    to read_xsp3_hdf5() to be refilled in place.
+    """
+    def __init__(self, npix=0, ndet=4, nchan=4096, dtype='u4'):
+        self.firstPixel   = 0
+        self.numPixels    = 0
+        self.mappingMode  = 1
+        self._store       = None
+        self.reserve(npix, ndet, nchan, dtype=dtype)
+
+    def reserve(self, npix, ndet, nchan, dtype='u4'):
+        """size the arrays for npix pixels of ndet detector elements with
+        nchan channels, reusing the current storage when it is big enough."""
+        store = self._store
+        if (store is None or len(store['data']) < npix or
+            store['data'].shape[1:] != (ndet, nchan) or
+            store['data'].dtype != np.dtype(dtype)):
+            store = self._store = {
+                'data':         np.zeros((npix, ndet, nchan), dtype=dtype),
+                'realTime':     np.zeros((npix, ndet), dtype='f8'),
+                'liveTime':     np.zeros((npix, ndet), dtype='f8'),
+                'inputCounts':  np.zeros((npix, ndet), dtype='f8'),
+                'outputCounts': np.zeros((npix, ndet), dtype='f8'),
+                'dtFactor':     np.ones((npix, ndet), dtype='f8')}
+        for attr, arr in store.items():
+            setattr(self, attr, arr[:npix])
+
+    def __getstate__(self):
+        "pickle the arrays, but not the (larger) storage behind them"
+        state = self.__dict__.copy()
+        state['_store'] = None
+        return state
+
+def xsp3_file_complete(fname, npixels=None):
+    """return whether an Xspress3 HDF5 file is complete: it can be opened
+    and (if npixels is given) it holds at least npixels frames."""
+    try:
+        fh = h5py.File(fname, 'r')
+    except (IOError, OSError):
+        return False
+    try:
+        nframes = fh[XSP3_DATA].shape[0]
+    except (KeyError, ValueError):
+        return False
+    finally:
+        fh.close()
+    return npixels is None or nframes >= npixels
+
+def read_xsp3_hdf5(fname, verbose=False, out=None):
+    """read an Xspress3 HDF5 file, returning an Xspress3Data
+
+    The spectra are read with h5py read_direct, one storage chunk of
+    frames at a time, straight into the arrays of the Xspress3Data.
+    Times, counts, and dead-time factors come from the detector's
+    own NDAttributes, and are left at 0 (or 1 for the dead-time
+    factor) when not saved.
+
+    if out is an Xspress3Data, it is refilled in place and returned.
+    """
+    if verbose: print ' reading ', fname
+    t0 = time.time()
+    fh = h5py.File(fname, 'r')
+    try:
+        dset = fh[XSP3_DATA]
+        npix = dset.shape[0]
+        ndet, nchan = dset.shape[-2:]
+        if out is None:
+            xsp3dat = Xspress3Data(npix, ndet, nchan, dtype=dset.dtype)
+        else:
+            xsp3dat = out
+            xsp3dat.reserve(npix, ndet, nchan, dtype=dset.dtype)
+        xsp3dat.numPixels = npix
+
+        dest = xsp3dat.data.reshape(dset.shape)
+        step = npix
+        if dset.chunks is not None:
+            step = dset.chunks[0]
+        for i0 in range(0, npix, step):
+            sel = np.s_[i0:min(npix, i0+step)]
+            dset.read_direct(dest, source_sel=sel, dest_sel=sel)
+
+        attrs = fh.get(XSP3_ATTRS, {})
+        for attr, name, scale, default in (
+            ('realTime',     XSP3_CLOCK,  1.0/XSP3_CLOCKRATE, 0),
+            ('inputCounts',  XSP3_INPUT,  1, 0),
+            ('outputCounts', XSP3_OUTPUT, 1, 0),
+            ('dtFactor',     XSP3_DTFACT, 1, 1)):
+            arr = getattr(xsp3dat, attr)
+            for idet in range(ndet):
+                key = name % (idet+1)
+                if key in attrs:
+                    arr[:, idet] = scale * attrs[key][...].ravel()[:npix]
+                else:
+                    arr[:, idet] = default
+    finally:
+        fh.close()
+    dtf = xsp3dat.dtFactor
+    xsp3dat.liveTime[...] = xsp3dat.realTime / np.where(dtf > 0, dtf, 1)
+
+    if verbose:
+        print '   time to read file    = %5.1f ms' % ((time.time()-t0)*1000)
+        print '   read %i pixels ' %  xsp3dat.numPixels
+        print '   data shape:    ' ,  xsp3dat.data.shape
+    return xsp3dat
+
+if __name__ == '__main__':
+    import sys
+    fd = read_xsp3_hdf5(sys.argv[1], verbose=True)
+    print fd.data.shape
@@ -1,3 +1,4 @@
 
 from .ordereddict import OrderedDict
 from .debugtime import debugtime
+from .lrucache import LRUCache
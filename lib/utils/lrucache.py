@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""
+least-recently-used cache of arrays, limited by total size in bytes
+"""
+import threading
+from .ordereddict import OrderedDict
+
+class LRUCache(object):
+    """dictionary-like cache holding at most maxbytes bytes of values,
+    discarding the least recently used values when full.
+
+    The size of a value is its nbytes attribute (as for numpy arrays),
+    or 1 for other values.  A value larger than maxbytes is not kept.
+
+    >>> cache = LRUCache(maxbytes=2**26)
+    >>> block = cache.get(key)
+    >>> if block is None:
+    ...     block = read_block(key)
+    ...     cache[key] = block
+    """
+    def __init__(self, maxbytes=2**26):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        "return value for key, marking it as recently used, or default"
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value = self._data.pop(key)
+            self._data[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        size = getattr(value, 'nbytes', 1)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= getattr(self._data.pop(key), 'nbytes', 1)
+            if size > self.maxbytes:
+                return
+            self._data[key] = value
+            self.nbytes += size
+            while self.nbytes > self.maxbytes:
+                oldkey, old = self._data.popitem(last=False)
+                self.nbytes -= getattr(old, 'nbytes', 1)
+
+    def pop(self, key, default=None):
+        "remove key, returning its value or default"
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data.pop(key)
+            self.nbytes -= getattr(value, 'nbytes', 1)
+            return value
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
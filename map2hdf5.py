@@ -1,10 +1,11 @@
 import sys
+import multiprocessing
 from lib.io.xrm_mapfile import GSEXRM_MapFile
 
 mapdir = sys.argv[1]
 print sys.argv
 
-g = GSEXRM_MapFile(folder=mapdir)
+g = GSEXRM_MapFile(folder=mapdir, nworkers=multiprocessing.cpu_count())
 g.process() # maxrow=100)
 g.close()
 
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""
+repack a GSEXRM Map File with a different storage profile
+(compression and chunk layout), one of 'standard', 'fast', 'archive'
+
+   python repack_map.py [--storage archive] MyMap.h5 MyMap_archive.h5
+
+by default, gzip level 9 is used, which makes files a few percent
+smaller than the profile's own level, but is about 20 times slower:
+use --level=0 for the profile's level.
+"""
+import sys
+from optparse import OptionParser
+from lib.io.xrm_mapfile import repack_mapfile, STORAGE_PROFILES, REPACK_LEVEL
+
+parser = OptionParser(usage='%prog [--storage PROFILE] infile outfile')
+parser.add_option('--storage', default='archive',
+                  help='storage profile, one of %s [archive]' %
+                  ', '.join(sorted(STORAGE_PROFILES)))
+parser.add_option('--level', type='int', default=REPACK_LEVEL,
+                  help='gzip level, or 0 for that of the profile '
+                  '(level 9 is about 20 times slower than 4) [%i]' % REPACK_LEVEL)
+opts, args = parser.parse_args()
+if len(args) != 2 or opts.storage not in STORAGE_PROFILES:
+    parser.print_help()
+    sys.exit(1)
+
+repack_mapfile(args[0], args[1], storage=opts.storage,
+               level=opts.level or None)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+benchmark reading and converting raw map folders, using a synthetic
+map folder (see lib/io/synthmap.py) or an existing one.
+
+Each stage is run in its own process, and reports the time taken,
+rows per second, and the peak memory (RSS) of that process.
+
+run from the top-level folder:
+   python test/bench_ingest.py --rows 20 --npts 200
+   python test/bench_ingest.py --folder /path/to/MapFolder --stages process
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import resource
+import multiprocessing
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.io.synthmap import make_map_folder
+from lib.io.mapfolder import readMasterFile
+from lib.io.xmap_nc import read_xmap_netcdf
+from lib.io.xrm_mapfile import GSEXRM_MapRow, GSEXRM_MapFile
+from lib.io.escan_writer import EscanWriter
+from lib.io.xrf_writer import WriteFullXRF
+
+def master_rows(folder):
+    "rows of Master.dat: (yval, xmapfile, struckfile, xpsfile, time)"
+    header, rows = readMasterFile(os.path.join(folder, 'Master.dat'))
+    return rows
+
+def bench_read_xmap(folder, opts):
+    rows = master_rows(folder)
+    for row in rows:
+        read_xmap_netcdf(os.path.join(folder, row[1]))
+    return len(rows)
+
+def bench_maprow(folder, opts):
+    rows = master_rows(folder)
+    for irow, (yval, xmapf, sisf, xpsf, etime) in enumerate(rows):
+        GSEXRM_MapRow(yval, xmapf, xpsf, sisf, folder=folder,
+                      reverse=(irow % 2 != 0))
+    return len(rows)
+
+def bench_process(folder, opts):
+    xrmfile = GSEXRM_MapFile(folder=folder, nworkers=opts.nworkers)
+    xrmfile.process()
+    nrows = xrmfile.last_row + 1
+    xrmfile.close()
+    return nrows
+
+def bench_escan(folder, opts):
+    writer = EscanWriter(folder=folder, nworkers=opts.nworkers)
+    writer.process()
+    return writer.last_row
+
+def bench_fullxrf(folder, opts):
+    WriteFullXRF(folder, nworkers=opts.nworkers)
+    return len(master_rows(folder))
+
+STAGES = (('read_xmap', 'read_xmap_netcdf',        bench_read_xmap),
+          ('maprow',    'GSEXRM_MapRow',           bench_maprow),
+          ('process',   'GSEXRM_MapFile.process',  bench_process),
+          ('escan',     'EscanWriter.process',     bench_escan),
+          ('fullxrf',   'WriteFullXRF',            bench_fullxrf))
+
+def run_stage(func, folder, opts, outdir, queue):
+    "run one stage in the output folder, reporting to queue"
+    os.chdir(outdir)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        t0 = time.time()
+        nrows = func(folder, opts)
+        elapsed = time.time() - t0
+    finally:
+        sys.stdout = stdout
+    # ru_maxrss is in kilobytes on linux, bytes on mac os x
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss = maxrss/1024
+    queue.put((nrows, elapsed, maxrss/1024.0))
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--rows', type='int', default=20,
+                      help='number of rows for synthetic map [20]')
+    parser.add_option('--npts', type='int', default=200,
+                      help='number of points per row for synthetic map [200]')
+    parser.add_option('--nchans', type='int', default=2048,
+                      help='number of mca channels for synthetic map [2048]')
+    parser.add_option('--ndet', type='int', default=4,
+                      help='number of detector elements for synthetic map [4]')
+    parser.add_option('--folder', default=None,
+                      help='use existing raw map folder, not a synthetic map')
+    parser.add_option('--stages', default=','.join([s[0] for s in STAGES]),
+                      help='comma-separated stages to run [all]')
+    parser.add_option('--nworkers', type='int', default=1,
+                      help='number of xmap reader processes [1]')
+    parser.add_option('--keep', action='store_true', default=False,
+                      help='keep synthetic map and output files')
+    opts, args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_ingest_')
+    folder = opts.folder
+    if folder is None:
+        folder = os.path.join(workdir, 'SynthMap')
+        t0 = time.time()
+        make_map_folder(folder, nrows=opts.rows, npts=opts.npts,
+                        nchans=opts.nchans, ndet=opts.ndet)
+        print 'wrote synthetic map: %i rows x %i points, %i dets x %i chans (%.1f s)' % (
+            opts.rows, opts.npts, opts.ndet, opts.nchans, time.time()-t0)
+    folder = os.path.abspath(folder)
+    print 'folder: %s' % folder
+
+    stages = [s.strip() for s in opts.stages.split(',')]
+    print '%-26s %8s %8s %10s %12s' % ('stage', 'rows', 'time(s)',
+                                       'rows/s', 'peak RSS(MB)')
+    try:
+        for key, desc, func in STAGES:
+            if key not in stages:
+                continue
+            outdir = os.path.join(workdir, key)
+            os.mkdir(outdir)
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=run_stage,
+                                           args=(func, folder, opts, outdir, queue))
+            proc.start()
+            proc.join()
+            if proc.exitcode != 0:
+                print '%-26s failed' % desc
+                continue
+            nrows, elapsed, maxrss = queue.get()
+            print '%-26s %8i %8.2f %10.2f %12.1f' % (desc, nrows, elapsed,
+                                                     nrows/max(elapsed, 1.e-6),
+                                                     maxrss)
+    finally:
+        if opts.keep:
+            print 'kept files in %s' % workdir
+        else:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+wait for files to be written with the inotify-based FolderWatcher,
+and with its polling fallback.
+
+run from the top-level folder:
+   python test/test_folder_watcher.py
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.io.folder_watcher import FolderWatcher
+from lib.io.xmap_nc import xMAPReaderPool
+from lib.io.synthmap import SynthMap, make_xmap_buffers, write_xmap_netcdf
+
+def write_later(fname, delay, text='data'):
+    "write a file from a thread, after delay seconds"
+    def writer():
+        time.sleep(delay)
+        fh = open(fname, 'w')
+        fh.write(text)
+        fh.close()
+    thread = threading.Thread(target=writer)
+    thread.start()
+    return thread
+
+def check_wait(watcher, folder):
+    fname = os.path.join(folder, 'xmap.0001')
+    thread = write_later(fname, 0.3)
+    t0 = time.time()
+    assert watcher.wait(fname, timeout=5)
+    assert time.time() - t0 < 1.0
+    thread.join()
+    # already complete
+    assert watcher.wait(fname, timeout=0)
+    # never written
+    t0 = time.time()
+    assert not watcher.wait(os.path.join(folder, 'xmap.0002'), timeout=0.3)
+    assert time.time() - t0 >= 0.3
+
+def test_inotify():
+    folder = tempfile.mkdtemp()
+    try:
+        # recheck longer than the wait, so only inotify can wake it
+        watcher = FolderWatcher(folder, recheck=5)
+        if sys.platform.startswith('linux'):
+            assert watcher.fd is not None
+        check_wait(watcher, folder)
+        assert watcher.has_closed('xmap.0001')
+        watcher.close()
+    finally:
+        shutil.rmtree(folder)
+
+def test_polling():
+    folder = tempfile.mkdtemp()
+    try:
+        watcher = FolderWatcher(folder)
+        watcher.close()
+        check_wait(watcher, folder)
+    finally:
+        shutil.rmtree(folder)
+
+def test_reader_pool():
+    "xMAPReaderPool workers wait for files with their own watchers"
+    folder = tempfile.mkdtemp()
+    try:
+        smap = SynthMap(npts=20)
+        fnames = []
+        for irow in range(2):
+            fname = os.path.join(folder, 'xmap.%4.4i' % (irow+1))
+            tmpname = os.path.join(folder, 'tmp.%i' % irow)
+            write_xmap_netcdf(tmpname, make_xmap_buffers(*smap.row(irow)))
+            fnames.append((tmpname, fname))
+        pool = xMAPReaderPool(nworkers=2, timeout=5)
+        # the second file is moved into place after the workers wait
+        os.rename(*fnames[0])
+        thread = threading.Thread(target=lambda: (time.sleep(0.3),
+                                                  os.rename(*fnames[1])))
+        thread.start()
+        t0 = time.time()
+        out = list(pool.imap([f[1] for f in fnames]))
+        thread.join()
+        pool.close()
+        assert time.time() - t0 < 2.0
+        assert [x.numPixels for x in out] == [20, 20]
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print '%s: ok' % name
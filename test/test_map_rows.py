@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+"""
+read the maps of a map file while rows are being added to it, with
+rows held in the write-behind buffer.
+
+run from the top-level folder:
+   python test/test_map_rows.py
+"""
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.io.synthmap import make_map_folder
+from lib.utils.lrucache import LRUCache
+from lib.io.xrm_mapfile import (GSEXRM_MapFile, GSEXRM_SpectraView,
+                                STORAGE_PROFILES, REPACK_LEVEL,
+                                ROIMAP_STATS, chunk_shape, repack_mapfile,
+                                xcumulative)
+
+NROWS, NPTS, BATCH = 6, 20, 4
+
+def convert(check, maxrow=None, done=None, nrows=NROWS, expected=None,
+            resume=False, **kws):
+    """convert a synthetic map folder of nrows rows, up to maxrow rows,
+    calling check(xrmfile, irow) after each row is added, and
+    done(xrmfile) when the rows are processed, returning the temporary
+    folder.  expected replaces the number of rows expected in Master.dat.
+    With resume=True, the map file is closed after maxrow rows, and
+    reopened to convert the remaining rows."""
+    tmpdir = tempfile.mkdtemp()
+    folder = os.path.join(tmpdir, 'SynthMap')
+    make_map_folder(folder, nrows=nrows, npts=NPTS)
+    if expected is not None:
+        master = os.path.join(folder, 'Master.dat')
+        lines = open(master).readlines()
+        for i, line in enumerate(lines):
+            if line.startswith('#SCAN.nrows_expected'):
+                lines[i] = '#SCAN.nrows_expected = %i\n' % expected
+        open(master, 'w').writelines(lines)
+    cwd, stdout = os.getcwd(), sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        os.chdir(tmpdir)
+        xrmfile = GSEXRM_MapFile(folder=folder, write_batch=BATCH, **kws)
+        def callback(row=None, status=None, **kws):
+            if status == 'complete' and check is not None:
+                check(xrmfile, row)
+        xrmfile.process(maxrow=maxrow, callback=callback)
+        if resume:
+            xrmfile.close()
+            xrmfile = GSEXRM_MapFile(filename=xrmfile.filename)
+            xrmfile.process(force=True, callback=callback)
+        if done is not None:
+            done(xrmfile)
+        xrmfile.close()
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+    return tmpdir
+
+def test_rows_written():
+    seen = []
+    def check(xrmfile, irow):
+        assert xrmfile.last_row == irow
+        nwritten = xrmfile.rows_written
+        assert nwritten == BATCH*((irow+1)/BATCH)
+        rmap = xrmfile.get_roimap('Fe Ka')
+        assert rmap.shape == (nwritten, NPTS)
+        assert np.all(rmap.sum(axis=1) > 0)
+        spectrum = xrmfile.get_spectra(dtcorrect=False)
+        assert (spectrum.sum() > 0) == (nwritten > 0)
+        seen.append(nwritten)
+    tmpdir = convert(check)
+    try:
+        # the first row is added as the file is initialized
+        assert seen == [0, 0, 4, 4, 4]
+        xrmfile = GSEXRM_MapFile(filename=os.path.join(tmpdir, 'synthmap.h5'),
+                                 readonly=True)
+        assert xrmfile.rows_written == NROWS
+        assert xrmfile.get_roimap('Fe Ka').shape == (NROWS, NPTS)
+        xrmfile.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_map_cache():
+    "maps read before rows are written are not read from the cache"
+    def check(xrmfile, irow):
+        assert xrmfile.get_roimap('Fe Ka').shape == (0, NPTS)
+    def done(xrmfile):
+        # the rows are written at the end of process()
+        assert xrmfile.last_row == 2 and xrmfile.rows_written == 3
+        rmap = xrmfile.get_roimap('Fe Ka')
+        assert rmap.shape == (3, NPTS)
+        dat, imap = xrmfile.get_roimap_index('Fe Ka')
+        assert np.all(rmap == xrmfile.xrfmap[dat][:3, :, imap])
+    shutil.rmtree(convert(check, maxrow=3, done=done))
+
+def test_spectra_index():
+    "spectra summed from the spectra index match the spectra"
+    def done(xrmfile):
+        for xmin, xmax, ymin, ymax in ((0, 6, 0, NPTS), (1, 3, 5, 12),
+                                       (5, 6, NPTS-1, NPTS)):
+            kws = dict(xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax)
+            total = sum([xrmfile.get_spectra(det=det, **kws)
+                         for det in (1, 2, 3, 4)])
+            spectrum = xrmfile.get_spectra(**kws)
+            assert np.allclose(spectrum, total, rtol=1.e-9, atol=1.e-9)
+    shutil.rmtree(convert(None, done=done, spectra_index=True))
+
+def spectra(xrmfile, det=None, dtcorrect=True):
+    """spectra of the rows written, as float64, for a detector or the
+    sum of detectors, read from detN/data and detN/dtfactor"""
+    dets = (1, 2, 3, 4) if det is None else (det,)
+    nrows = xrmfile.rows_written
+    total = 0
+    for det in dets:
+        group = xrmfile.xrfmap['det%i' % det]
+        data = group['data'][:nrows].astype(np.float64)
+        if dtcorrect:
+            data = data * group['dtfactor'][:nrows][:, :, None]
+        total = total + data
+    return total
+
+def test_spectra_by_points():
+    "spectra summed over points match those of the points' spectra"
+    rand = np.random.RandomState(3)
+    mask = rand.random_sample((NROWS, NPTS)) > 0.7
+    mask[:, 5:12] = True
+    mask[2] = False
+    mask[4, -1] = True
+    points = zip(*np.where(mask))
+    def done(xrmfile):
+        assert xrmfile.rows_written == NROWS
+        for det in (None, 2):
+            for dtcorrect in (True, False):
+                data = spectra(xrmfile, det=det, dtcorrect=dtcorrect)
+                total = data[mask].sum(axis=0)
+                for arg in (mask, points):
+                    spectrum = xrmfile.get_spectra_by_points(arg, det=det,
+                                                         dtcorrect=dtcorrect)
+                    assert np.allclose(spectrum, total, rtol=1.e-6)
+        assert xrmfile.get_spectra_by_points([]).sum() == 0
+    for kws in ({}, {'spectra_index': True}, {'cache_mbytes': 0}):
+        shutil.rmtree(convert(None, done=done, **kws))
+        shutil.rmtree(convert(None, maxrow=3, done=done, resume=True, **kws))
+
+def test_map_erange():
+    "maps of energy ranges match the spectra summed over the channels"
+    indexed = []
+    def done(xrmfile):
+        assert xrmfile.rows_written == NROWS
+        indexed.append(xrmfile.get_row_layout()['ecumspec'])
+        energy = xrmfile.get_energy()
+        nchan = len(energy)
+        ranges = (((energy[300], energy[500]), True, (300, 501)),
+                  ((100, 220), False, (100, 221)),
+                  ((nchan-10, None), False, (nchan-10, nchan)),
+                  ((50, 40), False, (50, 50)),
+                  ((None, None), True, (0, nchan)))
+        for det in (None, 2):
+            for dtcorrect in (True, False):
+                data = spectra(xrmfile, det=det, dtcorrect=dtcorrect)
+                for (emin, emax), by_energy, (c0, c1) in ranges:
+                    dmap = xrmfile.get_map_erange(det=det, dtcorrect=dtcorrect,
+                                                  emin=emin, emax=emax,
+                                                  by_energy=by_energy)
+                    total = data[:, :, c0:c1].sum(axis=2)
+                    assert dmap.shape == (NROWS, NPTS)
+                    assert np.allclose(dmap, total, rtol=1.e-6)
+    for energy_index in (False, True):
+        shutil.rmtree(convert(None, done=done, energy_index=energy_index))
+        shutil.rmtree(convert(None, maxrow=3, done=done, resume=True,
+                              energy_index=energy_index))
+    assert indexed == [False, False, True, True]
+
+def test_map_stats():
+    "map statistics match those of the spectra and ROI maps"
+    def done(xrmfile):
+        assert xrmfile.rows_written == NROWS
+        xrfmap = xrmfile.xrfmap
+        for det in (None, 1, 2, 3, 4):
+            data = spectra(xrmfile, det=det)
+            stats = xrmfile.get_map_stats(det=det)
+            assert np.allclose(stats['sum_spectrum'], data.sum(axis=(0, 1)),
+                               rtol=1.e-6)
+            assert np.allclose(stats['max_spectrum'], data.max(axis=(0, 1)),
+                               rtol=1.e-6)
+            assert np.allclose(stats['row_spectra'], data.sum(axis=1),
+                               rtol=1.e-6)
+            gname = 'stats/%s' % ('detsum' if det is None else 'det%i' % det)
+            rowmax = xrfmap[gname]['row_maxspectrum'][:NROWS]
+            assert np.allclose(rowmax, data.max(axis=1), rtol=1.e-6)
+        for mname in ROIMAP_STATS:
+            rmap = xrfmap['roimap'][mname][:NROWS].astype(np.float64)
+            stats = xrfmap['stats/roimap'][mname]
+            for key, func in (('min', np.min), ('max', np.max),
+                              ('sum', np.sum)):
+                assert np.allclose(stats['row_%s' % key][:NROWS],
+                                   func(rmap, axis=1), rtol=1.e-6)
+                assert np.allclose(stats[key], func(rmap, axis=(0, 1)),
+                                   rtol=1.e-6)
+        for det in (None, 1):
+            for dtcorrect in (True, False):
+                for name in ('Fe Ka', 'Zn Ka'):
+                    rmap = xrmfile.get_roimap(name, det=det,
+                                              dtcorrect=dtcorrect)
+                    expected = (rmap.min(), rmap.max(),
+                                rmap.sum(dtype=np.float64))
+                    found = xrmfile.get_roimap_stats(name, det=det,
+                                                     dtcorrect=dtcorrect)
+                    assert np.allclose(found, expected, rtol=1.e-6)
+    shutil.rmtree(convert(None, done=done))
+    shutil.rmtree(convert(None, maxrow=3, done=done, resume=True))
+
+def test_spectra_view():
+    "corrected spectra summed by a spectra view match those of the data"
+    def done(xrmfile):
+        group = xrmfile.xrfmap['det3']
+        dtfactor = group['dtfactor'][:NROWS]
+        data = group['data'][:NROWS] * dtfactor[:, :, None]
+        assert group['data'].chunks[0] == BATCH
+        rand = np.random.RandomState(5)
+        mask = rand.random_sample((NROWS, NPTS)) > 0.6
+        # only the last rows, in the incomplete block of rows
+        tail = np.zeros((NROWS, NPTS), dtype=bool)
+        tail[BATCH:, 3:9] = True
+        regions = ((slice(0, NROWS), slice(0, NPTS)),
+                   (slice(1, 3), slice(5, 12)),
+                   (slice(2, NROWS), slice(NPTS-4, NPTS)),
+                   (slice(BATCH, NROWS), slice(0, 7)),
+                   (slice(3, 3), slice(0, NPTS)))
+        for cache in (None, LRUCache()):
+            view = GSEXRM_SpectraView(group, dtcorrect=True, cache=cache)
+            # read twice, the second time from the cache
+            for repeat in (0, 1):
+                for rows, pts in regions:
+                    total = data[rows, pts].sum(axis=(0, 1), dtype=np.float64)
+                    spectrum = view.sum_region(rows, pts, NROWS)
+                    assert spectrum.dtype == np.float64
+                    assert np.allclose(spectrum, total, rtol=1.e-6)
+                for pixels in (mask, tail):
+                    total = data[pixels].sum(axis=0, dtype=np.float64)
+                    spectrum = view.sum_mask(pixels)
+                    assert np.allclose(spectrum, total, rtol=1.e-6)
+            if cache is not None:
+                # only the complete block of rows is cached
+                keys = [key[-2:] for key in cache.keys()]
+                assert keys == [(0, 0)]
+                assert cache.hits > 0
+        view = GSEXRM_SpectraView(group, dtcorrect=False, cache=LRUCache())
+        raw = group['data'][:NROWS]
+        spectrum = view.sum_mask(mask)
+        assert spectrum.dtype == np.int64
+        assert np.all(spectrum == raw[mask].sum(axis=0))
+    shutil.rmtree(convert(None, done=done))
+
+def test_xcumulative():
+    "sums of a few points from the end of long rows keep their precision"
+    rand = np.random.RandomState(1)
+    spectra = (rand.randint(0, 30000, size=(2, 2000, 64)) *
+               (1 + rand.random_sample((2, 2000, 1))/10)).astype('float32')
+    xcum = xcumulative(spectra)
+    assert xcum.shape == (2, 2001, 64)
+    for p0, p1 in ((0, 2000), (1990, 1995), (1999, 2000)):
+        total = spectra[:, p0:p1, :].sum(axis=1, dtype=np.float64)
+        assert np.allclose(xcum[:, p1] - xcum[:, p0], total, rtol=1.e-12)
+
+def test_redefine_rois():
+    "new ROIs replace all the ROI definitions, leaving no temporary data"
+    rois = [('Wide', (100, 1900)),
+            ('Narrow', [(500, 510), (501, 511), (502, 512), (503, 513)]),
+            ('Ends', [(0, 40), (0, 1), (2000, 2048), (2040, 2100)])]
+    names = [name for name, lims in rois]
+    indexed = []
+    def done(xrmfile):
+        # as left by an incomplete change of ROIs
+        xrmfile.xrfmap['det2'].create_dataset('roi_names.new', data=['X'])
+        indexed.append(xrmfile.get_row_layout()['ecumspec'])
+        xrmfile.redefine_rois(rois)
+        for gname in ('det1', 'det2', 'det3', 'det4', 'detsum'):
+            group = xrmfile.xrfmap[gname]
+            assert [k for k in group.keys() if k.endswith('.new')] == []
+            assert list(group['roi_names'][()]) == names
+        assert 'roimap.new' not in xrmfile.xrfmap
+        assert list(xrmfile.xrfmap['config/rois/name'][()]) == names
+        # the ROI maps, summed from the spectra
+        for name, lims in rois:
+            lims = np.array(lims).reshape((-1, 2))
+            for dtcorrect in (False, True):
+                total = 0
+                for det in (1, 2, 3, 4):
+                    lo, hi = lims[(det-1) % len(lims)]
+                    data = spectra(xrmfile, det=det, dtcorrect=dtcorrect)
+                    dmap = data[:, :, lo:hi].sum(axis=2)
+                    rmap = xrmfile.get_roimap(name, det=det,
+                                              dtcorrect=dtcorrect)
+                    assert np.allclose(rmap, dmap, rtol=1.e-6)
+                    total = total + dmap
+                rmap = xrmfile.get_roimap(name, dtcorrect=dtcorrect)
+                assert np.allclose(rmap, total, rtol=1.e-6)
+    for energy_index in (False, True):
+        shutil.rmtree(convert(None, done=done, energy_index=energy_index))
+    assert indexed == [False, True]
+
+def array_rows(xrmfile):
+    "numbers of rows of the arrays that grow by row"
+    xrfmap = xrmfile.xrfmap
+    return set([xrfmap[name].shape[0]
+                for name in ('det1/data', 'det1/dtfactor', 'det4/livetime',
+                             'detsum/data', 'roimap/pos', 'roimap/det_raw',
+                             'roimap/sum_cor', 'stats/det1/row_spectrum',
+                             'stats/roimap/det_raw/row_sum')])
+
+def test_nrows_expected():
+    "arrays are sized for the rows expected, and trimmed on closing"
+    sizes = []
+    def check(xrmfile, irow):
+        sizes.append(array_rows(xrmfile))
+    # more rows expected than the initial size, or fewer than the map has
+    for nrows, expected, grown in ((NROWS, 40, []), (20, 18, [32, 32])):
+        del sizes[:]
+        tmpdir = convert(check, nrows=nrows, expected=expected)
+        try:
+            # the first row is added as the file is initialized
+            assert sizes == ([set([expected])]*(min(nrows, expected)-1) +
+                             [set([n]) for n in grown])
+            xrmfile = GSEXRM_MapFile(filename=os.path.join(tmpdir,
+                                                           'synthmap.h5'),
+                                     readonly=True)
+            assert array_rows(xrmfile) == set([nrows])
+            rmap = xrmfile.get_roimap('Fe Ka')
+            assert rmap.shape == (nrows, NPTS)
+            assert np.all(rmap.sum(axis=1) > 0)
+            xrmfile.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+def compare_maps(fname1, fname2):
+    "assert that all datasets of /xrfmap of two map files are equal"
+    map1 = h5py.File(fname1, 'r')['xrfmap']
+    map2 = h5py.File(fname2, 'r')['xrfmap']
+    names = []
+    map1.visit(names.append)
+    for name in names:
+        if isinstance(map1[name], h5py.Dataset):
+            assert name in map2, name
+            assert np.all(map1[name][()] == map2[name][()]), name
+    map1.file.close()
+    map2.file.close()
+
+def test_storage():
+    "maps of each storage profile, and repacked, hold the same data"
+    def check_storage(dset, storage, nrows, level=None):
+        profile = STORAGE_PROFILES[storage]
+        assert dset.compression == profile['compression']
+        if level is None:
+            level = profile['compression_opts']
+        assert dset.compression_opts == level
+        assert dset.shuffle == profile['shuffle']
+        assert dset.chunks == chunk_shape(dset.shape, dset.dtype, nrows=nrows,
+                                          layout=profile['layout'])
+    tmpdirs = [convert(None, storage=storage)
+               for storage in ('standard', 'fast', 'archive')]
+    try:
+        fnames = [os.path.join(tmpdir, 'synthmap.h5') for tmpdir in tmpdirs]
+        for fname, storage in zip(fnames, ('standard', 'fast', 'archive')):
+            fh = h5py.File(fname, 'r')
+            for name in ('det1/data', 'detsum/data', 'roimap/det_raw'):
+                check_storage(fh['xrfmap'][name], storage, BATCH)
+            fh.close()
+        compare_maps(fnames[0], fnames[1])
+        compare_maps(fnames[0], fnames[2])
+
+        repacked = os.path.join(tmpdirs[1], 'repacked.h5')
+        repack_mapfile(fnames[1], repacked)
+        compare_maps(fnames[1], repacked)
+        fh = h5py.File(repacked, 'r')
+        archive = STORAGE_PROFILES['archive']
+        for name in ('det1/data', 'detsum/data', 'roimap/det_raw'):
+            check_storage(fh['xrfmap'][name], 'archive', archive['rows'],
+                          level=REPACK_LEVEL)
+        # datasets that do not grow by row are copied unchanged
+        src = h5py.File(fnames[1], 'r')
+        for name in ('config/rois/limits', 'det1/energy'):
+            dset, sdset = fh['xrfmap'][name], src['xrfmap'][name]
+            assert dset.compression == sdset.compression
+            assert dset.chunks == sdset.chunks
+        src.close()
+        fh.close()
+
+        repack_mapfile(fnames[2], repacked, storage='fast')
+        compare_maps(fnames[2], repacked)
+        fh = h5py.File(repacked, 'r')
+        check_storage(fh['xrfmap/det1/data'], 'fast',
+                      STORAGE_PROFILES['fast']['rows'])
+        fh.close()
+    finally:
+        for tmpdir in tmpdirs:
+            shutil.rmtree(tmpdir)
+
+def test_pipeline():
+    "maps converted by the pipeline of nworkers are as converted in turn"
+    tmpdirs = [convert(None, nworkers=nworkers) for nworkers in (1, 3)]
+    try:
+        compare_maps(*[os.path.join(tmpdir, 'synthmap.h5')
+                       for tmpdir in tmpdirs])
+    finally:
+        for tmpdir in tmpdirs:
+            shutil.rmtree(tmpdir)
+
+def test_pipeline_error():
+    "errors of the pipeline stages are raised by process(), and stop it"
+    def fail_on(method, ncalls):
+        "wrap a method of xrmfile to raise on its ncalls-th call"
+        calls = []
+        def failing(*args, **kws):
+            calls.append(1)
+            if len(calls) == ncalls:
+                raise ValueError('failed %s' % method.__name__)
+            return method(*args, **kws)
+        return failing
+    for stage in ('read_rowdata', 'compute_rowdata'):
+        tmpdir = tempfile.mkdtemp()
+        folder = os.path.join(tmpdir, 'SynthMap')
+        make_map_folder(folder, nrows=NROWS, npts=NPTS)
+        cwd, stdout = os.getcwd(), sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            os.chdir(tmpdir)
+            xrmfile = GSEXRM_MapFile(folder=folder, write_batch=BATCH,
+                                     nworkers=3)
+            # the first row is read and computed as the file is initialized
+            setattr(xrmfile, stage, fail_on(getattr(xrmfile, stage), 4))
+            try:
+                xrmfile.process()
+            except ValueError, err:
+                assert str(err) == 'failed %s' % stage
+            else:
+                raise AssertionError('no error from %s' % stage)
+            names = [t.name for t in threading.enumerate()]
+            assert 'map reader' not in names and 'map compute' not in names
+            assert multiprocessing.active_children() == []
+            assert xrmfile.last_row < NROWS-1
+            xrmfile.close()
+        finally:
+            sys.stdout = stdout
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print '%s: ok' % name
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+read a growing Master.dat file with MasterFileTail, comparing with
+readMasterFile.
+
+run from the top-level folder:
+   python test/test_master_tail.py
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.io.mapfolder import readMasterFile, MasterFileTail
+
+HEADER = """#SCAN.version   = 1.0
+#SCAN.starttime = %s
+#SCAN.filename  = test
+#SCAN.nrows_expected = 10
+#------------------------------------
+#   yposition  xmapfile  struckfile  gatheringfile  walltime
+"""
+ROW = "%.4f   xmap.%4.4i  struck.%4.4i  xps.%4.4i  %.2f\n"
+
+def append(fname, text):
+    fh = open(fname, 'a')
+    fh.write(text)
+    fh.close()
+
+def test_tail():
+    fname = os.path.join(tempfile.mkdtemp(), 'Master.dat')
+    try:
+        append(fname, HEADER % 'Mon Jan  1 00:00:00 2024')
+        tail = MasterFileTail(fname)
+        header, rows = tail.read()
+        assert len(header) == 6 and rows == []
+        for i in range(1, 5):
+            append(fname, ROW % (i*0.01, i, i, i, i*10.0))
+            assert tail.read() == readMasterFile(fname)
+        # a partly written line is left for the next read
+        line = ROW % (0.05, 5, 5, 5, 50.0)
+        append(fname, line[:12])
+        header, rows = tail.read()
+        assert len(rows) == 4
+        append(fname, line[12:])
+        header, rows = tail.read()
+        assert len(rows) == 5 and rows == readMasterFile(fname)[1]
+        offset = tail.offset
+        assert tail.read()[1] == rows and tail.offset == offset
+
+        # rewritten for a new scan
+        time.sleep(0.01)
+        fh = open(fname, 'w')
+        fh.write(HEADER % 'Tue Jan  2 00:00:00 2024')
+        for i in range(1, 8):
+            fh.write(ROW % (i*0.02, i, i, i, i*20.0))
+        fh.close()
+        assert tail.read() == readMasterFile(fname)
+    finally:
+        os.unlink(fname)
+        os.rmdir(os.path.dirname(fname))
+
+if __name__ == '__main__':
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print '%s: ok' % name
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+compare mapfolder.readASCII with the original line-by-line parser,
+on the struck, xps and Master files of a synthetic map folder.
+
+run from the top-level folder:
+   python test/test_read_ascii.py
+"""
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.io.mapfolder import readASCII
+from lib.io.synthmap import make_map_folder
+
+def readASCII_lines(fname, nskip=0, isnumeric=True):
+    "the original readASCII, parsing one line at a time"
+    dat, header = [], []
+    with open(fname,'r') as fh:
+        lines = fh.readlines()
+    for line in lines:
+        if line.startswith('#') or line.startswith(';'):
+            header.append(line[:-1])
+            continue
+        if nskip > 0:
+            nskip -= 1
+            header.append(line[:-1])
+            continue
+        if isnumeric:
+            dat.append([float(x) for x in line[:-1].split()])
+        else:
+            dat.append(line[:-1].split())
+    if isnumeric:
+        dat = np.array(dat)
+    return header, dat
+
+def assert_same(fname, **kws):
+    header, dat = readASCII(fname, **kws)
+    old_header, old_dat = readASCII_lines(fname, **kws)
+    assert header == old_header
+    if kws.get('isnumeric', True):
+        assert dat.dtype == old_dat.dtype
+        assert dat.shape == old_dat.shape
+        assert np.all(dat == old_dat)
+    else:
+        assert dat == old_dat
+
+def write(fname, text):
+    fh = open(fname, 'w')
+    fh.write(text)
+    fh.close()
+
+def test_map_folder():
+    tmpdir = tempfile.mkdtemp()
+    folder = os.path.join(tmpdir, 'SynthMap')
+    try:
+        make_map_folder(folder, nrows=2, npts=30, nchans=256)
+        for name in ('struck.0001', 'struck.0002', 'xps.0001', 'xps.0002'):
+            fname = os.path.join(folder, name)
+            for nskip in (0, 1):
+                assert_same(fname, nskip=nskip)
+        header, dat = readASCII(os.path.join(folder, 'struck.0001'))
+        assert dat.shape == (30, 4)
+        assert header[-1].startswith('# TSCALER')
+        assert_same(os.path.join(folder, 'Master.dat'), isnumeric=False)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_blank_lines():
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, 'xps.0001')
+    try:
+        write(fname, '# a header\n1 2 3\n4 5 6\n7 8 9\n')
+        header, dat = readASCII(fname)
+        write(fname, '# a header\n1 2 3\n\n4 5 6\n   \n7 8 9\n\n')
+        assert readASCII(fname)[0] == header
+        assert np.all(readASCII(fname)[1] == dat)
+        # only header lines
+        write(fname, '# a header\n; another\n')
+        header, dat = readASCII(fname)
+        assert header == ['# a header', '; another']
+        assert dat.shape == (0,)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_fallback():
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, 'struck.0001')
+    try:
+        # ragged lines are parsed one at a time, as before
+        write(fname, '# ragged\n1 2 3\n4 5\n6 7 8 9\n')
+        header, dat = readASCII(fname)
+        assert [list(row) for row in dat] == [[1, 2, 3], [4, 5], [6, 7, 8, 9]]
+        assert_same(fname)
+        # with the same number of words, but one of them is not a number
+        write(fname, '# bad\n1 2 3\n4 x 6\n')
+        for reader in (readASCII, readASCII_lines):
+            try:
+                reader(fname)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('non-numeric data read')
+        assert readASCII(fname, isnumeric=False)[1] == [['1', '2', '3'],
+                                                        ['4', 'x', '6']]
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print '%s: ok' % name
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+follow a map file written in SWMR mode with GSEXRM_MapReader, while
+another process converts a synthetic map folder.
+
+run from the top-level folder:
+   python test/test_swmr_map.py
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.io.synthmap import make_map_folder
+from lib.io.xrm_mapfile import GSEXRM_MapFile, GSEXRM_MapReader
+
+NROWS = 6
+NAMES = ('roimap/sum_cor', 'roimap/pos', 'det1/dtfactor')
+
+def write_map(folder, started, go):
+    "convert the map in two steps, waiting for the reader in between"
+    os.chdir(os.path.dirname(folder))
+    xrmfile = GSEXRM_MapFile(folder=folder, swmr=True, write_batch=2)
+    xrmfile.process(maxrow=2)
+    started.set()
+    go.wait(10)
+    xrmfile.process()
+    xrmfile.close()
+
+def test_swmr_reader():
+    tmpdir = tempfile.mkdtemp()
+    folder = os.path.join(tmpdir, 'SynthMap')
+    make_map_folder(folder, nrows=NROWS, npts=20)
+    started, go = multiprocessing.Event(), multiprocessing.Event()
+    writer = multiprocessing.Process(target=write_map,
+                                     args=(folder, started, go))
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        writer.start()
+        assert started.wait(30)
+        reader = GSEXRM_MapReader(os.path.join(tmpdir, 'synthmap.h5'))
+        assert reader.h5root.swmr_mode
+        first, rows = reader.read_newrows(NAMES)
+        assert first == 0 and len(rows['roimap/pos']) == 2
+        seen = [rows]
+        go.set()
+        t0 = time.time()
+        while reader.last_row < NROWS-1 and time.time() - t0 < 30:
+            first, rows = reader.read_newrows(NAMES)
+            if rows:
+                seen.append(rows)
+            time.sleep(0.01)
+        reader.close()
+        writer.join()
+        assert writer.exitcode == 0
+
+        final = h5py.File(os.path.join(tmpdir, 'synthmap.h5'), 'r')
+        assert final['xrfmap'].attrs['Last_Row'] == NROWS-1
+        for name in NAMES:
+            read = np.concatenate([rows[name] for rows in seen])
+            assert read.shape[0] == NROWS
+            assert np.all(read == final['xrfmap'][name][:])
+        final.close()
+    finally:
+        sys.stdout = stdout
+        if writer.is_alive():
+            writer.terminate()
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print '%s: ok' % name
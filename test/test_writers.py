@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+read the ROI file and write .xrf and escan files from synthetic map
+folders, for detectors of 4 and 8 elements.
+
+run from the top-level folder:
+   python test/test_writers.py
+"""
+import os
+import sys
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.io.synthmap import SynthMap, make_map_folder
+from lib.io.xmap_nc import read_xmap_netcdf
+from lib.io import mapfolder, escan_writer
+from lib.io.xrf_writer import WriteFullXRF
+from lib.io.xrm_mapfile import GSEXRM_MapFile
+
+NROWS, NPTS, NCHANS = 3, 20, 1024
+
+def synth_folder(ndet):
+    "write a synthetic map folder, returning (tmpdir, folder)"
+    tmpdir = tempfile.mkdtemp()
+    folder = os.path.join(tmpdir, 'SynthMap')
+    make_map_folder(folder, nrows=NROWS, npts=NPTS, nchans=NCHANS, ndet=ndet)
+    return tmpdir, folder
+
+def run_quietly(func, tmpdir, *args, **kws):
+    "run func in tmpdir, without printing"
+    cwd, stdout = os.getcwd(), sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        os.chdir(tmpdir)
+        return func(*args, **kws)
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+
+def test_read_roi_file():
+    "ROI limits are read for each detector element"
+    for ndet in (4, 8):
+        tmpdir, folder = synth_folder(ndet)
+        try:
+            expected = SynthMap(nchans=NCHANS, ndet=ndet).roi_limits()
+            roifile = os.path.join(folder, 'ROI.dat')
+            rois = mapfolder.readROIFile(roifile)[0]
+            escan_rois = run_quietly(escan_writer.readROIFile, tmpdir, roifile)
+            for found in (rois, escan_rois):
+                assert len(found) == len(expected)
+                for (iroi, name, lims), (ename, lo, hi) in zip(found, expected):
+                    assert name == ename
+                    assert lims == [(lo, hi)]*ndet
+        finally:
+            shutil.rmtree(tmpdir)
+
+def test_full_xrf():
+    "the .xrf file is named for the scan, with a column per element"
+    tmpdir, folder = synth_folder(4)
+    try:
+        run_quietly(WriteFullXRF, tmpdir, folder)
+        lines = open(os.path.join(tmpdir, 'synthmap.xrf')).readlines()
+        head = dict([l.split(':', 1) for l in lines if ':' in l])
+        assert int(head['ELEMENTS']) == 4
+        assert int(head['CHANNELS']) == NCHANS
+        data = np.array([[int(x) for x in l.split()]
+                         for l in lines[lines.index('DATA:\n')+1:]])
+        assert data.shape == (NCHANS, 4)
+        total = 0
+        for irow in range(NROWS):
+            xmapfile = os.path.join(folder, 'xmap.%4.4i' % (irow+1))
+            total = total + read_xmap_netcdf(xmapfile).data.sum(axis=0)
+        assert np.all(data == total.transpose())
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_escan_rois():
+    "escan ROI columns sum all detector elements"
+    tmpdir, folder = synth_folder(8)
+    try:
+        writer = escan_writer.EscanWriter(folder=folder)
+        run_quietly(writer.process, tmpdir)
+        rows = [l for l in writer.buff if not l.startswith(';')]
+        rois = SynthMap(nchans=NCHANS, ndet=8).roi_limits()
+        spectra = read_xmap_netcdf(os.path.join(folder, 'xmap.0001')).data
+        # row 1: time, struck scalers, then raw and corrected ROIs
+        for ipt, line in enumerate(rows[:NPTS]):
+            raw = [int(x) for x in line.split()[8:8+len(rois)]]
+            assert raw == [spectra[ipt, :, lo:hi].sum()
+                           for name, lo, hi in rois]
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_map_rois():
+    "map files of 8 element detectors have ROI limits for each element"
+    tmpdir, folder = synth_folder(8)
+    try:
+        def convert():
+            xrmfile = GSEXRM_MapFile(folder=folder)
+            xrmfile.process()
+            return xrmfile
+        xrmfile = run_quietly(convert, tmpdir)
+        rois = SynthMap(nchans=NCHANS, ndet=8).roi_limits()
+        limits = xrmfile.xrfmap['config/rois/limits'][()]
+        assert limits.shape == (len(rois), 8, 2)
+        name, lo, hi = rois[1]
+        data = xrmfile.xrfmap['det8/data'][:NROWS, :, lo:hi]
+        names = list(xrmfile.xrfmap['roimap/det_name'][()])
+        imap = names.index('%s (mca8)' % name)
+        rmap = xrmfile.xrfmap['roimap/det_raw'][:NROWS, :, imap]
+        assert np.all(rmap == data.sum(axis=2))
+        xrmfile.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_pool_closed_on_error():
+    "the xmap reader processes are stopped when writing fails"
+    tmpdir, folder = synth_folder(4)
+    try:
+        # a row of another length cannot be added to the others
+        make_map_folder(os.path.join(tmpdir, 'Other'), nrows=2, npts=NPTS+5,
+                        nchans=NCHANS)
+        shutil.copy(os.path.join(tmpdir, 'Other', 'xmap.0002'),
+                    os.path.join(folder, 'xmap.0002'))
+        try:
+            run_quietly(WriteFullXRF, tmpdir, folder, nworkers=2)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('spectra of different lengths added')
+        assert multiprocessing.active_children() == []
+
+        writer = escan_writer.EscanWriter(folder=folder, nworkers=2)
+        def fail(*args, **kws):
+            raise ValueError('failed')
+        writer._process_rows = fail
+        try:
+            run_quietly(writer.process, tmpdir)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('no error from process()')
+        assert multiprocessing.active_children() == []
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print '%s: ok' % name
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+compare the vectorized xMAP buffer decoder with the original
+per-buffer decoder, on synthetic xMAP netcdf files.
+
+run from the top-level folder:
+   python test/test_xmap_decode.py
+"""
+import os
+import sys
+import tempfile
+import warnings
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.io.xmap_nc import (xMAPData, read_xmap_netcdf, decode_xmap_buffers,
+                            decode_xmap_buffers_loop, decode_xmap_listmode,
+                            read_xmap_header, xmap_file_complete,
+                            mmap_array_data)
+from lib.io.synthmap import SynthMap, write_xmap_netcdf
+from lib.io.synthmap import make_xmap_buffers as make_row_buffers
+
+def longwords(val):
+    "split a long into (low, high) 16 bit words"
+    val = int(val)
+    return [val & 0xFFFF, (val >> 16) & 0xFFFF]
+
+def make_xmap_buffers(npixels, nchans=2048, mapmode=1, nrois=8,
+                      firstpixel=0, seed=1):
+    """build a (narrays, 1, buffersize) array of xMAP mapping buffers
+    for npixels pixels, with 124 pixels per buffer"""
+    rand = np.random.RandomState(seed)
+    modpixs = 124
+    if mapmode == 1:
+        pixhead, ndat = 256, 4*nchans
+    else:
+        pixhead, ndat = 64, 8*nrois
+    blocksize = pixhead + ndat
+    buffersize = 256 + modpixs*blocksize
+    narrays = 1 + (npixels-1)/modpixs
+    bufs = np.zeros((narrays, 1, buffersize), dtype=np.uint16)
+    for iarr in range(narrays):
+        pix0 = iarr*modpixs
+        npix = min(modpixs, npixels-pix0)
+        head = bufs[iarr, 0, :256]
+        head[0:5] = (0x55AA, 0xAA55, 256, mapmode, 1)
+        head[5:7] = longwords(iarr)
+        head[7:9] = (iarr % 2, npix)
+        head[9:11] = longwords(firstpixel + pix0)
+        head[20:24] = nchans
+        for ipix in range(npix):
+            off = 256 + ipix*blocksize
+            block = bufs[iarr, 0, off:off+blocksize]
+            block[0:4] = (0x33CC, 0xCC33, pixhead, mapmode)
+            block[4:6] = longwords(firstpixel + pix0 + ipix)
+            block[6:8] = longwords(blocksize)
+            if mapmode == 2:
+                block[8:12] = nrois
+            for ichan in range(4):
+                rtime = rand.randint(1000, 1000000)
+                ltime = rtime - rand.randint(0, 1000)
+                icr = rand.randint(0, 100000)
+                ocr = icr - rand.randint(0, 1000)
+                stats = []
+                for val in (rtime, ltime, icr, ocr):
+                    stats.extend(longwords(val))
+                block[32+8*ichan:40+8*ichan] = stats
+            if mapmode == 1:
+                block[pixhead:] = rand.randint(0, 500, size=ndat)
+            else:
+                rois = rand.randint(0, 100000, size=ndat/2)
+                block[pixhead:] = np.array([longwords(r) for r in rois]).ravel()
+    return bufs.view(np.int16)
+
+def make_listmode_buffers(nevents, npixels, nmodules=2, nbuffers=3,
+                          buffersize=2048, seed=1):
+    """build list-mode buffers of random, time-ordered events, and
+    return them with the (pixel, detector, energy) of each event"""
+    rand = np.random.RandomState(seed)
+    bufs = np.zeros((nbuffers, nmodules, buffersize), dtype=np.uint16)
+    events = []
+    for imod in range(nmodules):
+        pix = np.sort(rand.randint(0, npixels, size=nevents))
+        chan = rand.randint(0, 4, size=nevents)
+        energy = rand.randint(0, 8192, size=nevents)
+        for ibuf, sel in enumerate(np.array_split(np.arange(nevents), nbuffers)):
+            buff = bufs[ibuf, imod]
+            buff[0:4] = (0x55AA, 0xAA55, 256, 3)
+            buff[8:10] = longwords(len(sel))
+            words = buff[256:256+3*len(sel)].reshape((-1, 3))
+            words[:, 0] = energy[sel] | (chan[sel] << 13)
+            words[:, 1] = (100 + pix[sel]) & 0xFFFF
+            words[:, 2] = (100 + pix[sel]) >> 16
+        events.append((pix, 4*imod + chan, energy))
+    pix, dets, energy = [np.concatenate(x) for x in zip(*events)]
+    # pixels are counted from the first time tag
+    return bufs.view(np.int16), (pix - pix.min(), dets, energy)
+
+def assert_same(xnew, xold):
+    assert xnew.firstPixel == xold.firstPixel
+    assert xnew.numPixels == xold.numPixels
+    for attr in ('data', 'realTime', 'liveTime',
+                 'inputCounts', 'outputCounts'):
+        new, old = getattr(xnew, attr), getattr(xold, attr)
+        assert new.shape == old.shape, attr
+        assert new.dtype == old.dtype, attr
+        assert np.all(new == old), attr
+
+def test_full_spectra():
+    for npixels in (1, 100, 124, 125, 301):
+        bufs = make_xmap_buffers(npixels, firstpixel=7*npixels)
+        xnew = decode_xmap_buffers(bufs)
+        assert xnew.numPixels == npixels
+        assert_same(xnew, decode_xmap_buffers_loop(bufs))
+
+def test_synthmap_row():
+    synth = SynthMap(nrows=2, npts=130, nchans=1024, ndet=8)
+    spectra, rtime, ltime, icr, ocr = synth.row(1)
+    bufs = make_row_buffers(spectra, rtime, ltime, icr, ocr, firstpixel=5)
+    xnew = decode_xmap_buffers(bufs)
+    assert xnew.firstPixel == 5
+    assert xnew.numPixels == 130
+    assert np.all(xnew.data == spectra)
+    assert np.all(xnew.outputCounts == ocr)
+    assert np.allclose(xnew.liveTime, 0.320*ltime)
+
+def test_roi_mode():
+    bufs = make_xmap_buffers(250, mapmode=2, nrois=6)
+    assert_same(decode_xmap_buffers(bufs), decode_xmap_buffers_loop(bufs))
+
+def test_roi_values():
+    bufs = make_xmap_buffers(130, mapmode=2, nrois=4, seed=3)
+    xnew = decode_xmap_buffers(bufs)
+    assert xnew.mappingMode == 2
+    assert xnew.data.dtype == np.int32
+    words = bufs[0, 0, 256+64:256+64+32].view(np.uint16)
+    expected = words[0::2].astype(int) + (words[1::2].astype(int) << 16)
+    assert np.all(xnew.data[0].ravel() == expected)
+    assert xnew.data.max() > 32767
+
+def test_listmode():
+    nchans = 1024
+    bufs, (pix, dets, energy) = make_listmode_buffers(500, 40)
+    xnew = decode_xmap_buffers(bufs)
+    assert xnew.mappingMode == 3
+    xnew = decode_xmap_listmode(bufs, nchans=nchans)
+    npix = pix.max() + 1
+    expected = np.zeros((npix, 8, nchans), dtype=int)
+    np.add.at(expected, (pix, dets, energy*nchans/8192), 1)
+    assert xnew.numPixels == npix
+    assert np.all(xnew.data == expected)
+    assert np.all(xnew.inputCounts == expected.sum(axis=2))
+
+def test_reuse_buffer():
+    xbuff = xMAPData()
+    store = None
+    for npixels in (301, 125, 100, 301):
+        bufs = make_xmap_buffers(npixels, seed=npixels)
+        xnew = decode_xmap_buffers(bufs, out=xbuff)
+        assert xnew is xbuff
+        assert_same(xnew, decode_xmap_buffers_loop(bufs))
+        # storage is allocated on first use, and then reused
+        if store is None:
+            store = xbuff.data.base
+        assert xbuff.data.base is store
+
+def test_netcdf_file():
+    bufs = make_xmap_buffers(301, nchans=2048)
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, 'xmap.0001')
+    try:
+        write_xmap_netcdf(fname, bufs)
+        xnew = read_xmap_netcdf(fname)
+        assert_same(xnew, decode_xmap_buffers_loop(bufs))
+    finally:
+        os.unlink(fname)
+        os.rmdir(tmpdir)
+
+def count_mappings(fname):
+    "number of memory maps of fname in this process, or None"
+    if not os.path.exists('/proc/self/maps'):
+        return None
+    return open('/proc/self/maps').read().count(fname)
+
+def test_netcdf_mmap():
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, 'xmap.0001')
+    try:
+        for npixels in (100, 301):
+            bufs = make_xmap_buffers(npixels)
+            write_xmap_netcdf(fname, bufs)
+            with warnings.catch_warnings(record=True) as warned:
+                warnings.simplefilter('always')
+                xnew = read_xmap_netcdf(fname, use_mmap=True)
+            assert not [w for w in warned if w.category is RuntimeWarning]
+            # only the one mapping held by the spectra is left
+            assert count_mappings(fname) in (None, int(npixels <= 124))
+            xold = decode_xmap_buffers_loop(bufs)
+            for attr in ('data', 'realTime', 'liveTime',
+                         'inputCounts', 'outputCounts'):
+                assert np.all(getattr(xnew, attr) == getattr(xold, attr)), attr
+            # a single buffer is a read-only view, not a copy
+            assert xnew.data.flags.writeable == (npixels > 124)
+            del xnew
+            assert count_mappings(fname) in (None, 0)
+    finally:
+        os.unlink(fname)
+        os.rmdir(tmpdir)
+
+def test_mmap_layouts():
+    "only rows in one buffer of one module are views of the memory map"
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, 'xmap.0001')
+    try:
+        for npts, ndet, shared in ((100, 4, True), (124, 4, True),
+                                   (100, 8, False), (130, 4, False),
+                                   (300, 16, False)):
+            synth = SynthMap(nrows=1, npts=npts, nchans=256, ndet=ndet)
+            spectra, rtime, ltime, icr, ocr = synth.row(0)
+            write_xmap_netcdf(fname, make_row_buffers(spectra, rtime, ltime,
+                                                      icr, ocr))
+            array_data = mmap_array_data(fname)
+            xnew = decode_xmap_buffers(array_data, copy=False)
+            assert np.all(xnew.data == spectra)
+            assert np.may_share_memory(xnew.data, array_data) == shared
+            del xnew, array_data
+    finally:
+        os.unlink(fname)
+        os.rmdir(tmpdir)
+
+def test_netcdf_header():
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, 'xmap.0001')
+    partial = os.path.join(tmpdir, 'xmap.0002')
+    try:
+        bufs = make_xmap_buffers(301)
+        write_xmap_netcdf(fname, bufs)
+        open(partial, 'wb').write(open(fname, 'rb').read()[:2000])
+        with warnings.catch_warnings(record=True) as warned:
+            warnings.simplefilter('always')
+            assert read_xmap_header(fname).numPixels == 301
+            assert xmap_file_complete(fname, npixels=301)
+            assert not xmap_file_complete(partial)
+            xnew = read_xmap_netcdf(fname)
+        assert_same(xnew, decode_xmap_buffers_loop(bufs))
+        assert not [w for w in warned if w.category is RuntimeWarning]
+        assert count_mappings(fname) in (None, 0)
+    finally:
+        for f in (fname, partial):
+            os.unlink(f)
+        os.rmdir(tmpdir)
+
+if __name__ == '__main__':
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print '%s: ok' % name
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+read synthetic Xspress3 HDF5 files, laid out as written by the
+areaDetector HDF5 plugin.
+
+run from the top-level folder:
+   python test/test_xsp3_read.py
+"""
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.io.xsp3_hdf5 import (Xspress3Data, read_xsp3_hdf5, xsp3_file_complete,
+                              is_xsp3_file, XSP3_CLOCKRATE)
+from lib.io.synthmap import make_map_folder
+from lib.io.xrm_mapfile import GSEXRM_MapFile
+
+def write_xsp3_hdf5(fname, npixels, ndet=4, nchans=4096, chunk=16, seed=1):
+    """write an Xspress3 file with random spectra and attributes,
+    returning the spectra and attributes written"""
+    rand = np.random.RandomState(seed)
+    data = rand.randint(0, 200, size=(npixels, ndet, nchans)).astype('u4')
+    attrs = {}
+    for idet in range(ndet):
+        clock = rand.randint(80000, 90000, size=npixels)
+        dtfact = 1.0 + rand.random_sample(npixels)/10.0
+        allevt = rand.randint(1000, 2000, size=npixels)
+        attrs['CHAN%iSCA0' % (idet+1)] = clock.astype('f8')
+        attrs['CHAN%iSCA3' % (idet+1)] = allevt.astype('f8')
+        attrs['CHAN%iSCA4' % (idet+1)] = (allevt/dtfact).astype('f8')
+        attrs['CHAN%iDTFACTOR' % (idet+1)] = dtfact
+    fh = h5py.File(fname, 'w')
+    fh.create_dataset('entry/instrument/detector/data', data=data,
+                      chunks=(chunk, ndet, nchans))
+    grp = fh.create_group('entry/instrument/NDAttributes')
+    for key, val in attrs.items():
+        grp.create_dataset(key, data=val)
+    fh.close()
+    return data, attrs
+
+def test_read():
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, 'xsp3.0001')
+    try:
+        assert is_xsp3_file(fname)
+        assert not xsp3_file_complete(fname)
+        data, attrs = write_xsp3_hdf5(fname, 50)
+        assert xsp3_file_complete(fname, npixels=50)
+        assert not xsp3_file_complete(fname, npixels=51)
+        xsp3 = read_xsp3_hdf5(fname)
+        assert xsp3.numPixels == 50
+        assert np.all(xsp3.data == data)
+        for idet in range(4):
+            clock = attrs['CHAN%iSCA0' % (idet+1)]
+            dtfact = attrs['CHAN%iDTFACTOR' % (idet+1)]
+            assert np.allclose(xsp3.realTime[:, idet], clock/XSP3_CLOCKRATE)
+            assert np.allclose(xsp3.dtFactor[:, idet], dtfact)
+            assert np.allclose(xsp3.liveTime[:, idet]*dtfact,
+                               xsp3.realTime[:, idet])
+    finally:
+        os.unlink(fname)
+        os.rmdir(tmpdir)
+
+def test_reuse_buffer():
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, 'xsp3.0001')
+    xbuff = Xspress3Data()
+    try:
+        for npixels in (40, 20, 40):
+            data, attrs = write_xsp3_hdf5(fname, npixels, seed=npixels)
+            xsp3 = read_xsp3_hdf5(fname, out=xbuff)
+            assert xsp3 is xbuff
+            assert np.all(xsp3.data == data)
+    finally:
+        os.unlink(fname)
+        os.rmdir(tmpdir)
+
+def test_convert_map():
+    "convert a map folder of Xspress3 files, with counts above int16"
+    nrows, npts, nchans, big = 3, 20, 2048, 40000
+    tmpdir = tempfile.mkdtemp()
+    folder = os.path.join(tmpdir, 'SynthMap')
+    make_map_folder(folder, nrows=nrows, npts=npts, nchans=nchans)
+    master = open(os.path.join(folder, 'Master.dat')).read()
+    fh = open(os.path.join(folder, 'Master.dat'), 'w')
+    fh.write(master.replace(' xmap.', ' xsp3.'))
+    fh.close()
+    dtfacts = []
+    for irow in range(nrows):
+        os.unlink(os.path.join(folder, 'xmap.%4.4i' % (irow+1)))
+        fname = os.path.join(folder, 'xsp3.%4.4i' % (irow+1))
+        data, attrs = write_xsp3_hdf5(fname, npts, nchans=nchans, seed=irow)
+        fh = h5py.File(fname, 'r+')
+        dset = fh['entry/instrument/detector/data']
+        for idet in range(4):
+            dset[:, idet, 1000] = big + idet
+        fh.close()
+        dtfacts.append([attrs['CHAN%iDTFACTOR' % (idet+1)]
+                        for idet in range(4)])
+
+    cwd, stdout = os.getcwd(), sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        os.chdir(tmpdir)
+        xrmfile = GSEXRM_MapFile(folder=folder)
+        xrmfile.process()
+        xrfmap = xrmfile.xrfmap
+        for idet in range(4):
+            data = xrfmap['det%i/data' % (idet+1)]
+            assert data.dtype == np.uint32
+            assert np.all(data[:nrows, :, 1000] == big + idet)
+        detsum = xrfmap['detsum/data'][:nrows, :, 1000]
+        expected = np.array(dtfacts) * (big + np.arange(4)).reshape((1, 4, 1))
+        expected = expected.astype('float32').sum(axis=1)
+        # odd rows are stored in reverse order of the pixels
+        expected[1::2] = expected[1::2, ::-1]
+        assert np.allclose(detsum, expected, rtol=1.e-5)
+        spectrum = xrmfile.get_spectra(det=1, dtcorrect=False)
+        assert spectrum[1000] == big*nrows*npts
+        xrmfile.close()
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print '%s: ok' % name